@@ -1,31 +1,48 @@
 from .objects import Person, ConditionOccurrence, VisitOccurrence, Measurement, Observation
-    
+
+
+class Definition:
+    """
+    Records a function that defines a cdm object, without creating the object.
+    The CommonDataModel indexes these by cdm table when the class is created,
+    and only creates the object (once per instance) when it is first needed.
+    """
+    def __init__(self,cdm_class,define):
+        self.cdm_class = cdm_class
+        self.define = define
+        self.name = define.__name__
+        self.table = cdm_class.name
+
+    def __set_name__(self,owner,name):
+        self.name = name
+
+    def create(self):
+        """
+        Create the cdm object for this definition
+        """
+        obj = self.cdm_class()
+        obj.define = self.define
+        obj.set_name(self.define.__name__)
+        return obj
+
+    def __get__(self,instance,owner):
+        #accessing the definition from an instance gives the cdm object
+        if instance is None:
+            return self
+        return instance.get_obj(self)
+
+
 def define_person(defs):
-    p = Person()
-    p.define = defs
-    p.set_name(defs.__name__)
-    return p
+    return Definition(Person,defs)
 
 def define_condition_occurrence(defs):
-    c = ConditionOccurrence()
-    c.define = defs
-    c.set_name(defs.__name__)
-    return c
+    return Definition(ConditionOccurrence,defs)
 
 def define_visit_occurrence(defs):
-    c = VisitOccurrence()
-    c.define = defs
-    c.set_name(defs.__name__)
-    return c
+    return Definition(VisitOccurrence,defs)
 
 def define_measurement(defs):
-    c = Measurement()
-    c.define = defs
-    c.set_name(defs.__name__)
-    return c
+    return Definition(Measurement,defs)
 
 def define_observation(defs):
-    c = Observation()
-    c.define = defs
-    c.set_name(defs.__name__)
-    return c
+    return Definition(Observation,defs)
@@ -4,10 +4,19 @@ import numpy as np
 import json
 import copy
 import collections
+import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from .operations import OperationTools
 from coconnect.tools.logger import Logger
+from coconnect.tools.partitioned_inputs import PartitionedInputs
+from coconnect.tools.person_id_masker import PersonIdMasker
+from coconnect.tools.spilled_table import SpilledTable
+from coconnect.tools.profiler import Profiler
+from coconnect.tools import writers, dates
 from .objects import Person, ConditionOccurrence, VisitOccurrence, Measurement, Observation
+from .decorators import Definition
 
 
 #lookup for name to class, e.g. "person" : Person
@@ -22,25 +31,171 @@ class NoInputFiles(Exception):
     pass
 
 
+#the cdm model and objects the workers run on
+#these are set before the pool is created, so forked workers inherit them
+#rather than having to pickle the inputs for every object
+_worker_cdm = None
+_worker_objects = None
+
+def _execute_object(class_name,i):
+    """
+    Execute a cdm object inside of a worker process
+
+    Args:
+       class_name (str): name of the cdm table, e.g. "person"
+       i (int): the position of the object in the list of objects for this table
+    Returns:
+       pandas.Dataframe: the dataframe created by the object
+       list: the profiler records of executing the object
+    """
+    obj = _worker_objects[class_name][i]
+    profiler = _worker_cdm.profiler
+    nrecords = len(profiler)
+    df = _worker_cdm.execute_object(obj)
+    return df,profiler.records[nrecords:]
+
+
 class CommonDataModelTypes(collections.OrderedDict):
-    def __init__(self):
+    """
+    Lookup of how to convert a pandas series to each of the datatypes in the CDM
+    """
+    def __init__(self,native_dates=False):
+        """
+        Args:
+           native_dates (bool): keep DATETIME and DATE fields as datetimes (with DATEs at midnight),
+                                e.g. for the binary output formats, rather than formatting them as strings
+        """
         super().__init__()
-        self['INTEGER'] = lambda x : pd.to_numeric(x,errors='coerce').astype('Int64')
-        self['FLOAT'] = lambda x : pd.to_numeric(x,errors='coerce').astype('Float64')
-        self['VARCHAR(60)'] = lambda x : x.fillna('').astype(str).apply(lambda x: x[:60])
-        self['VARCHAR(50)'] = lambda x : x.fillna('').astype(str).apply(lambda x: x[:50])
-        self['VARCHAR(20)'] = lambda x : x.fillna('').astype(str).apply(lambda x: x[:20])
-        self['VARCHAR(10)'] = lambda x : x.fillna('').astype(str).apply(lambda x: x[:10])
-        self['VARCHAR'] = lambda x : x.fillna('').astype(str).apply(lambda x: x)
-        self['STRING(50)'] = lambda x : x.fillna('').astype(str).apply(lambda x: x[:50])
-        self['DATETIME'] = lambda x : pd.to_datetime(x,errors='coerce').dt.strftime('%Y-%m-%d %H:%M:%S')
-        self['DATE'] = lambda x : pd.to_datetime(x,errors='coerce').dt.date
+        self.native_dates = native_dates
+        self['INTEGER'] = self.to_integer
+        self['FLOAT'] = self.to_float
+        self['VARCHAR(60)'] = self.to_string(60)
+        self['VARCHAR(50)'] = self.to_string(50)
+        self['VARCHAR(20)'] = self.to_string(20)
+        self['VARCHAR(10)'] = self.to_string(10)
+        self['VARCHAR'] = self.to_string()
+        self['STRING(50)'] = self.to_string(50)
+        self['DATETIME'] = self.to_datetime
+        self['DATE'] = self.to_date
+
+        #formatters that have already been compiled for each cdm table
+        self._compiled = {}
+
+    @staticmethod
+    def to_numeric(x):
+        """
+        Convert a series to numbers, trying a straight cast to float first as this is
+        much faster than pandas.to_numeric, which is only used if there are values that can't be cast
+        """
+        if pd.api.types.is_numeric_dtype(x):
+            return x
+        try:
+            values = x.astype('float64')
+        except (ValueError,TypeError):
+            return pd.to_numeric(x,errors='coerce')
+        #integers this big can't be held exactly as a float
+        if values.notnull().any() and values.abs().max() >= 2**53:
+            return pd.to_numeric(x,errors='coerce')
+        return values
+
+    @staticmethod
+    def to_integer(x):
+        return CommonDataModelTypes.to_numeric(x).astype('Int64')
+
+    @staticmethod
+    def to_float(x):
+        return CommonDataModelTypes.to_numeric(x).astype('Float64')
+
+    @staticmethod
+    def to_string(nchars=None):
+        """
+        Create a function to convert a series to strings of at most nchars
+        """
+        def convert(x):
+            x = x.fillna('')
+            #only need to cast if there are any values that aren't already strings
+            if pd.api.types.infer_dtype(x,skipna=False) != 'string':
+                x = x.astype(str)
+            if nchars is None:
+                return x
+            return pd.Series([value[:nchars] for value in x.values],
+                             index=x.index,name=x.name,dtype=object)
+        return convert
+
+    def to_datetime(self,x):
+        x = pd.to_datetime(x,errors='coerce')
+        if self.native_dates:
+            return x
+        return dates.format_datetime(x)
+
+    def to_date(self,x):
+        x = pd.to_datetime(x,errors='coerce')
+        if self.native_dates:
+            return x.dt.normalize()
+        return dates.format_date(x)
+
+    def get_converter(self,_type):
+        """
+        Get the function to convert to a CDM datatype,
+        any VARCHAR(n) or STRING(n) not already defined is created on the fly
+
+        Args:
+           _type (str): the CDM datatype, e.g. VARCHAR(50)
+        Returns:
+           function: the conversion function, or None if the datatype is not known
+        """
+        if _type in self:
+            return self[_type]
+        match = re.match(r'^(?:VARCHAR|STRING)\((\d+)\)$',str(_type))
+        if match:
+            self[_type] = self.to_string(int(match.group(1)))
+            return self[_type]
+        return None
+
+    def compile(self,name,types):
+        """
+        Compile the formatter for a CDM table, the conversion function for each field is looked up once
+        and cached, so it doesn't have to be found again each time a dataframe is formatted
+        
+        Args:
+           name (str): name of the cdm table, e.g. person
+           types (pandas.Series): the datatype of each field in the table
+        Returns:
+           dict: map of field to the datatype and the function to convert it with
+        """
+        if name not in self._compiled:
+            self._compiled[name] = {
+                field:(_type,self.get_converter(_type))
+                for field,_type in types.items()
+            }
+        return self._compiled[name]
     
 
 class CommonDataModel:
 
     inputs = None
     output_folder = "output_data/"
+    output_format = "csv"
+    #memory (in MB) the outputs of a table can use before they are spilled to disk, None for no limit
+    max_memory = None
+    #object definitions for each cdm table, e.g. {"person": {"person_0": Definition}}
+    _object_definitions = {}
+
+    def __init_subclass__(cls,**kwargs):
+        """
+        Register all the objects defined (via the define_* decorators) in a new class,
+        including those inherited, indexed by the cdm table they are for
+        """
+        super().__init_subclass__(**kwargs)
+        definitions = {}
+        for klass in reversed(cls.__mro__):
+            for name,attr in vars(klass).items():
+                if isinstance(attr,Definition):
+                    definitions[name] = attr
+
+        cls._object_definitions = {}
+        for name,definition in sorted(definitions.items()):
+            cls._object_definitions.setdefault(definition.table,{})[name] = definition
 
     
     def __init__(self,**kwargs):
@@ -56,6 +211,12 @@ class CommonDataModel:
 
         if 'output_folder' in kwargs:
             self.output_folder = kwargs['output_folder']
+
+        if 'output_format' in kwargs:
+            self.output_format = kwargs['output_format']
+
+        if 'max_memory' in kwargs:
+            self.max_memory = kwargs['max_memory']
         
         if 'inputs' in kwargs:
             inputs = kwargs['inputs']
@@ -78,13 +239,31 @@ class CommonDataModel:
         #self.__dict__.update(self.__class__.__dict__)
 
         self.person_id_masker = None
+        #writers of the output file for each table
+        self.writers = {}
+        #the number of rows in each output file saved by the last call to process()
+        self.nrows_saved = {}
+        #the number of rows with a person_id that isn't in the person table, which are dropped
+        self.nrows_unknown_person = 0
+        #cdm objects that have been created from their definitions
+        self._objects = {}
+        #allow new person_ids to be added to the masker by the next table
+        self.extend_person_id_masker = True
+        self.index_map = {}
         self.omop = {}
+        #records the time and memory used by each stage of the run
+        self.profiler = Profiler()
 
 
         
     def set_indexing(self,index_map,strict_check=False):
         if self.inputs == None:
             raise NoInputFiles('Trying to indexing before any inputs have been setup')
+
+        self.index_map = index_map
+        #when streaming, the index is set on each partition when it is loaded
+        if isinstance(self.inputs,PartitionedInputs):
+            return
         
         for key,index in index_map.items():
             if key not in self.inputs:
@@ -102,15 +281,170 @@ class CommonDataModel:
         if class_type in _classes:
             return _classes[class_type]()
     
+    def get_obj(self,definition):
+        """
+        Get the cdm object for a definition, creating it if it hasn't been needed yet
+        """
+        if definition.name not in self._objects:
+            self._objects[definition.name] = definition.create()
+        return self._objects[definition.name]
+    
     def get_objs(self,class_type):
         self.logger.debug(f"looking for {class_type}")
-        return  [
-            getattr(self,x)
-            for x in dir(self)
-            if isinstance(getattr(self,x),class_type)
-        ]
+        objs = {
+            name:self.get_obj(definition)
+            for name,definition in self._object_definitions.get(class_type.name,{}).items()
+        }
+        #objects can also be set directly on this instance
+        objs.update({
+            name:obj
+            for name,obj in self.__dict__.items()
+            if isinstance(obj,class_type)
+        })
+        return [objs[name] for name in sorted(objs)]
     
-    def run_cdm(self,class_type):
+    def execute_object(self,obj):
+        """
+        Execute a cdm object and make its dataframe, recording each stage with the profiler
+
+        Returns:
+           pandas.Dataframe: the dataframe created by the object
+        """
+        with self.profiler.stage(obj.table,obj.name,'define'):
+            obj.execute(self)
+        with self.profiler.stage(obj.table,obj.name,'get_df') as record:
+            df = obj.get_df()
+            record['rows_out'] = len(df)
+        obj.release()
+        return df
+
+    def iter_outputs(self,objects,dfs=None):
+        """
+        Yield the output dataframe of each object, executing them one at a time if they haven't been already
+        """
+        if dfs is None:
+            for obj in objects:
+                yield self.execute_object(obj)
+        else:
+            yield from dfs
+
+    def merge_outputs(self,class_type,outputs):
+        """
+        Merge and mask the outputs of some of the objects of a cdm table
+        """
+        name = class_type.name
+        nrows = sum(len(df) for df in outputs)
+
+        self.logger.info(f'Merging {len(outputs)} objects for {class_type}')
+        with self.profiler.stage(name,None,'merge',rows_in=nrows) as record:
+            df_destination = pd.concat(outputs,ignore_index=True)
+            record['rows_out'] = len(df_destination)
+
+        self.logger.info(f'Masking the person_id for {class_type}')
+        with self.profiler.stage(name,None,'mask_person_id',rows_in=nrows) as record:
+            df_destination = self.mask_person_id(df_destination)
+            record['rows_out'] = len(df_destination)
+
+        return df_destination
+
+    def finalise_outputs(self,class_type,objects,df_destination):
+        """
+        Finalise and format the merged outputs of a cdm table
+        """
+        name = class_type.name
+        nrows = len(df_destination)
+
+        self.logger.info(f'Finalising {class_type}')
+        with self.profiler.stage(name,None,'finalise',rows_in=nrows) as record:
+            df_destination = objects[0].finalise(df_destination)
+            record['rows_out'] = nrows = len(df_destination)
+        
+        self.logger.info(f'Formating the output for {class_type}')
+        with self.profiler.stage(name,None,'format',rows_in=nrows) as record:
+            df_destination = objects[0].format(df_destination,raise_error=False)
+            record['rows_out'] = len(df_destination)
+
+        return df_destination
+
+    def count_person_ids(self,df,counts):
+        """
+        Add the number of rows of each (masked) person_id in a dataframe to the counts so far,
+        rows with no person_id are counted as person_id 0
+        """
+        person_id = df['person_id'].fillna(0).values.astype('int64')
+        _counts = np.bincount(person_id)
+        if len(_counts) > len(counts):
+            counts = np.pad(counts,(0,len(_counts)-len(counts)))
+        counts[:len(_counts)] += _counts
+        return counts
+
+    def finalise_spilled(self,class_type,objects,spilled,person_counts):
+        """
+        Finalise and format a table whose merged outputs were spilled to disk
+
+        The spilled chunks are split into ranges of person_id, each holding about as many rows as a chunk. The ranges are then finalised one at a time, in order, so the rows are sorted
+        (and the _ids generated) the same way as when the whole table is finalised in memory.
+
+        Args:
+           class_type: the cdm class, e.g. Person
+           objects (list): the objects of this cdm table
+           spilled (SpilledTable): the merged and masked chunks
+           person_counts (numpy.ndarray): the number of rows of each (masked) person_id
+        Returns:
+           SpilledTable: the finalised and formatted table
+        """
+        name = class_type.name
+        #the range of each person_id, rows with no person_id are dropped when finalised
+        starts = np.cumsum(person_counts) - person_counts
+        size = max(1,len(spilled)//len(spilled.files))
+        ranges = starts//size
+        nranges = int(ranges[-1]) + 1
+        self.logger.info(f'splitting {len(spilled)} spilled rows of {name} into {nranges} ranges of person_id')
+
+        id_offset = objects[0].id_offset
+        parts = [SpilledTable(f'{name}_{i}') for i in range(nranges)]
+        output = SpilledTable(name)
+        try:
+            with self.profiler.stage(name,None,'split',rows_in=len(spilled)):
+                for df in spilled:
+                    person_id = df['person_id'].fillna(0).values.astype('int64')
+                    for i,part in df.groupby(ranges[person_id],sort=True):
+                        parts[i].append(part)
+            spilled.cleanup()
+
+            for part in parts:
+                if len(part) == 0:
+                    continue
+                objects[0].id_offset = id_offset + len(output)
+                df = self.finalise_outputs(class_type,objects,part.load())
+                part.cleanup()
+                with self.profiler.stage(name,None,'spill',rows_in=len(df)):
+                    output.append(df)
+        except Exception:
+            output.cleanup()
+            raise
+        finally:
+            objects[0].id_offset = id_offset
+            for part in parts:
+                part.cleanup()
+        return output
+
+    def run_cdm(self,class_type,dfs=None):
+        """
+        Run all the objects defined for a cdm table and merge them together
+
+        If a memory limit has been set (max_memory), once the outputs of the objects held in memory
+        go over the limit, they are merged, masked and spilled to disk. The spilled chunks are
+        then finalised and formatted in ranges of person_id (see finalise_spilled).
+
+        Args:
+           class_type: the cdm class to run on, e.g. Person
+           dfs (list): dataframes already created for each of the objects (e.g. by workers),
+                       if not set, the objects are executed here
+        Returns:
+           pandas.Dataframe: the merged, masked and formatted output for this table,
+                             or a SpilledTable if any of it was spilled to disk
+        """
         objects = self.get_objs(class_type)
         nobjects = len(objects)
         extra = ""
@@ -122,86 +456,361 @@ class CommonDataModel:
             return
         
         #execute them all
-        dfs = []
         self.logger.info(f"working on {class_type}")
-        for i,obj in enumerate(objects):
-            obj.execute(self)
-            df = obj.get_df()
-            self.logger.info(f"finished {obj.name} "
-                             f"... {i}/{len(objects)}, {len(df)} rows") 
-            if len(df) == 0:
-                self.logger.warning(f".. {i}/{len(objects)}  no outputs were found ")
-                continue
-
-            dfs.append(df)
+        if dfs is not None:
+            #objects run by workers have not picked up the dtypes of this model
+            #which are needed to format the output
+            objects[0].dtypes = self.dtypes
+
+        spilled = None
+        #the number of rows of each person_id in the spilled chunks
+        person_counts = np.zeros(0,dtype='int64')
+        outputs = []
+        nbytes = 0
+        try:
+            for i,(obj,df) in enumerate(zip(objects,self.iter_outputs(objects,dfs))):
+                self.logger.info(f"finished {obj.name} "
+                                 f"... {i}/{len(objects)}, {len(df)} rows") 
+                if len(df) == 0:
+                    self.logger.warning(f".. {i}/{len(objects)}  no outputs were found ")
+                    continue
+
+                outputs.append(df)
+                if self.max_memory is None:
+                    continue
+
+                nbytes += df.memory_usage(deep=True).sum()
+                if nbytes > self.max_memory*1024**2:
+                    if spilled is None:
+                        spilled = SpilledTable(class_type.name)
+                    df_spill = self.merge_outputs(class_type,outputs)
+                    person_counts = self.count_person_ids(df_spill,person_counts)
+                    self.logger.info(f'spilling {len(df_spill)} rows of {class_type.name} '
+                                     f'({nbytes/1024**2:.1f}MB of outputs) to disk')
+                    with self.profiler.stage(class_type.name,None,'spill',rows_in=len(df_spill)):
+                        spilled.append(df_spill)
+                    outputs = []
+                    nbytes = 0
+
+            if len(outputs) == 0 and spilled is None:
+                self.logger.warning(f"no outputs were found for any of the objects for {class_type}")
+                #this table still defines the person_ids, there just aren't any
+                self.extend_person_id_masker = False
+                return
+
+            if spilled is None:
+                df_destination = self.merge_outputs(class_type,outputs)
+                df_destination = self.finalise_outputs(class_type,objects,df_destination)
+            else:
+                if len(outputs) > 0:
+                    df_spill = self.merge_outputs(class_type,outputs)
+                    person_counts = self.count_person_ids(df_spill,person_counts)
+                    with self.profiler.stage(class_type.name,None,'spill',rows_in=len(df_spill)):
+                        spilled.append(df_spill)
+                df_destination = self.finalise_spilled(class_type,objects,spilled,person_counts)
+        except Exception:
+            if spilled is not None:
+                spilled.cleanup()
+            raise
+
+        #only the first table (including all of its spilled chunks) can add new person_ids
+        self.extend_person_id_masker = False
+        return df_destination
 
-        #merge together
-        self.logger.info(f'Merging {len(dfs)} objects for {class_type}')
-        df_destination = pd.concat(dfs,ignore_index=True)
+    def run_cdm_parallel(self,class_types,workers):
+        """
+        Execute the objects of all cdm tables in a pool of worker processes
+
+        All objects are independent of each other, so they are all sent to the pool at once.
+        The merging, masking and formatting are then done here, table by table, in the
+        same order as the serial run, so the outputs are identical.
+
+        Args:
+           class_types (list): the cdm classes to run on, in the order they should be merged
+           workers (int): the number of worker processes to use
+        Returns:
+           dict: the output dataframe for each cdm table name
+        """
+        global _worker_cdm, _worker_objects
+
+        _worker_cdm = self
+        _worker_objects = {
+            class_type.name: self.get_objs(class_type)
+            for class_type in class_types
+        }
+
+        nobjects = sum(len(objects) for objects in _worker_objects.values())
+        self.logger.info(f"executing {nobjects} objects with {workers} workers")
+
+        #fork so the workers can see the inputs without them being copied over
+        context = multiprocessing.get_context('fork')
+        try:
+            with ProcessPoolExecutor(max_workers=workers,mp_context=context) as pool:
+                futures = {
+                    name: [pool.submit(_execute_object,name,i) for i in range(len(objects))]
+                    for name,objects in _worker_objects.items()
+                }
 
-        self.logger.info(f'Masking the person_id for {class_type}')
-        df_destination = self.mask_person_id(df_destination)
-        
-        self.logger.info(f'Finalising {class_type}')
-        df_destination = objects[0].finalise(df_destination)
+                df_map = {}
+                for class_type in class_types:
+                    dfs = []
+                    for future in futures[class_type.name]:
+                        df,records = future.result()
+                        dfs.append(df)
+                        self.profiler.records.extend(records)
+                    df_map[class_type.name] = self.run_cdm(class_type,dfs=dfs)
+                    self.logger.info(f'finalised {class_type.name}')
+        finally:
+            _worker_cdm = None
+            _worker_objects = None
         
-        self.logger.info(f'Formating the output for {class_type}')
-        df_destination = objects[0].format(df_destination,raise_error=False)
-
-        return df_destination
-
+        return df_map
 
     def mask_person_id(self,df):
         if 'person_id' in df.columns:
             #if masker has not been defined, define it
             if self.person_id_masker is None:
-                self.person_id_masker = {
-                    x:i+1
-                    for i,x in enumerate(df['person_id'].unique())
-                }
-            #apply the masking
-            df['person_id'] = df['person_id'].map(self.person_id_masker)
+                self.person_id_masker = PersonIdMasker()
+            #the first table masked defines the person_ids
+            #when streaming, this is the first table in each partition
+            known = df['person_id'].notnull()
+            df['person_id'] = self.person_id_masker.mask(df['person_id'],
+                                                         extend=self.extend_person_id_masker)
+            self.nrows_unknown_person += int((known & df['person_id'].isnull()).sum())
             self.logger.info(f"Just masked person_id")
         return df
+
+    def run_tables(self,class_types,workers=1):
+        """
+        Run all the cdm tables, serially or with a pool of workers
+
+        Args:
+           class_types (list): the cdm classes to run on, in order
+           workers (int): the number of processes to execute the objects with
+        Returns:
+           dict: the output dataframe for each cdm table name
+        """
+        if workers is not None and workers > 1:
+            return self.run_cdm_parallel(class_types,workers)
+
+        df_map = {}
+        for class_type in class_types:
+            df_map[class_type.name] = self.run_cdm(class_type)
+            self.logger.info(f'finalised {class_type.name}')
+        return df_map
         
-    def process(self,output_folder='output_data/'):
+    def process_partitions(self,class_types,output_folder,workers=1,append_to=None):
+        """
+        Run all the cdm tables on the inputs one partition of person_ids at a time,
+        appending the outputs of each partition to the output files
+
+        Args:
+           class_types (list): the cdm classes to run on, in order
+           output_folder (str): where to save the outputs
+           workers (int): the number of processes to execute the objects with
+           append_to (dict): the number of rows already saved to each output file, that are appended to
+        Returns:
+           dict: the number of rows in each output file
+        """
+        partitioned_inputs = self.inputs
         
+        #keep track of how many rows have been saved for each table
+        #so the generated _ids carry on from the previous partition
+        nrows_saved = dict(append_to or {})
+        try:
+            for i,inputs in enumerate(partitioned_inputs.partitions(self.index_map)):
+                self.logger.info(f"working on partition {i+1}/{partitioned_inputs.npartitions}")
+                self.profiler.partition = i
+                self.inputs = inputs
+                self.set_indexing(self.index_map)
+                self.extend_person_id_masker = True
+
+                for class_type in class_types:
+                    objects = self.get_objs(class_type)
+                    if len(objects) > 0:
+                        objects[0].id_offset = nrows_saved.get(class_type.name,0)
+
+                df_map = self.run_tables(class_types,workers)
+
+                for name,df in df_map.items():
+                    if df is None:
+                        continue
+                    mode = 'a' if name in nrows_saved else 'w'
+                    nrows_saved[name] = nrows_saved.get(name,0) + len(df)
+                    self.save_to_file({name:df},output_folder,mode=mode)
+        finally:
+            self.inputs = partitioned_inputs
+            self.profiler.partition = None
+            for class_type in class_types:
+                for obj in self.get_objs(class_type):
+                    obj.id_offset = 0
+
+        self.logger.info(f"saved {nrows_saved} rows from {partitioned_inputs.npartitions} partitions")
+        return nrows_saved
+
+    def process(self,output_folder='output_data/',workers=1,output_format=None,max_memory=None,append_to=None):
+        """
+        Run all the cdm tables and save them to file
+
+        Args:
+           output_folder (str): where to save the outputs, if not already set
+           workers (int): the number of processes to execute the objects with,
+                          the default of 1 runs everything serially
+           output_format (str): format to save the outputs in, 'csv', 'parquet' or 'feather'
+           max_memory (int): memory (in MB) the outputs of a table can use before they are spilled to disk
+           append_to (dict): the number of rows already saved to each output file (by a previous run),
+                             to append the outputs to these files rather than replace them,
+                             the generated _ids carry on from these rows
+        """
         if not self.output_folder is None:
             output_folder = self.output_folder
-        
-        self._df_map = {}
-        self._df_map[Person.name] = self.run_cdm(Person)
-        self.logger.info(f'finalised {Person.name}')
-
-        self._df_map[ConditionOccurrence.name] = self.run_cdm(ConditionOccurrence)
-        self.logger.info(f'finalised {ConditionOccurrence.name}')
-
-        self._df_map[VisitOccurrence.name] = self.run_cdm(VisitOccurrence)
-        self.logger.info(f'finalised {VisitOccurrence.name}')
-
-        self._df_map[Measurement.name] = self.run_cdm(Measurement)
-        self.logger.info(f'finalised {Measurement.name}')
 
-        self._df_map[Observation.name] = self.run_cdm(Observation)
-        self.logger.info(f'finalised {Observation.name}')
-
-        self.save_to_file(self._df_map,output_folder)
+        if output_format is not None:
+            self.output_format = output_format
+        #the binary formats can hold the dates and datetimes without them being formatted as strings
+        self.dtypes.native_dates = self.output_format != 'csv'
+
+        if max_memory is not None:
+            self.max_memory = max_memory
+
+        #start a new report for this run
+        self.profiler = Profiler()
+        #the formats of the date columns are inferred again for these inputs
+        dates.parser.clear()
+        self.nrows_unknown_person = 0
+
+        #load the lookup of person_ids from previous runs, so the masked ids are kept the same
+        if self.person_id_masker is None:
+            self.person_id_masker = PersonIdMasker(f'{output_folder}/masks/person_id_lookup.csv')
+        #only the person_ids of this run's person table are kept in the other tables,
+        #unless the outputs are appended to, where the people saved by the previous runs are still there
+        self.person_id_masker.start_run(keep_saved=bool(append_to))
+
+        class_types = [Person, ConditionOccurrence, VisitOccurrence, Measurement, Observation]
+
+        if workers is not None and workers > 1:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                self.logger.warning("running with multiple workers needs the 'fork' start method,"
+                                    " which isn't available here, so running serially instead")
+                workers = 1
+
+        try:
+            #stream the inputs, the outputs are saved as each partition is completed
+            #so they are not kept in memory
+            if isinstance(self.inputs,PartitionedInputs):
+                self.nrows_saved = self.process_partitions(class_types,output_folder,workers,append_to)
+            elif append_to:
+                self._df_map = self.append_tables(class_types,output_folder,workers,append_to)
+            else:
+                self._df_map = self.run_tables(class_types,workers)
+                self.nrows_saved = {
+                    name:len(df)
+                    for name,df in self._df_map.items()
+                    if df is not None
+                }
+                self.save_to_file(self._df_map,output_folder)
+                #register output, tables that were spilled to disk are only in the output files
+                self.omop = {
+                    name:df
+                    for name,df in self._df_map.items()
+                    if not isinstance(df,SpilledTable)
+                }
+        finally:
+            self.close_writers()
+        self.person_id_masker.save()
 
-        #register output
-        self.omop = self._df_map
+        self.profiler.log_summary()
+        self.profiler.save(f'{output_folder}/run_report.json')
         
         
-    def save_to_file(self,df_map,f_out):
+    def append_tables(self,class_types,output_folder,workers,append_to):
+        """
+        Run all the cdm tables and append their outputs to the output files saved by a previous run
+
+        Args:
+           class_types (list): the cdm classes to run on, in order
+           output_folder (str): where the outputs are saved
+           workers (int): the number of processes to execute the objects with
+           append_to (dict): the number of rows already saved to each output file
+        Returns:
+           dict: the output dataframe for each cdm table name
+        """
+        #the generated _ids carry on from the rows already saved
+        for class_type in class_types:
+            objects = self.get_objs(class_type)
+            if len(objects) > 0:
+                objects[0].id_offset = append_to.get(class_type.name,0)
+        try:
+            df_map = self.run_tables(class_types,workers)
+        finally:
+            for class_type in class_types:
+                for obj in self.get_objs(class_type):
+                    obj.id_offset = 0
+
+        self.nrows_saved = dict(append_to)
+        for name,df in df_map.items():
+            if df is None:
+                continue
+            mode = 'a' if name in append_to else 'w'
+            self.nrows_saved[name] = self.nrows_saved.get(name,0) + len(df)
+            self.save_to_file({name:df},output_folder,mode=mode)
+        return df_map
+        
+    def save_to_file(self,df_map,f_out,mode='w'):
+        """
+        Save the output of cdm tables to file, in the output format that has been set
+
+        Args:
+           df_map (dict): map of cdm table name to output dataframe
+           f_out (str): output folder
+           mode (str): 'w' to start a new file, or 'a' to append to the file that was already started,
+                       or to the file saved by a previous run
+        """
         for name,df in df_map.items():
             if df is None:
                 continue
-            fname = f'{f_out}/{name}.csv'
             if not os.path.exists(f'{f_out}'):
                 self.logger.info(f'making output folder {f_out}')
                 os.mkdir(f'{f_out}')
-            self.logger.info(f'saving {name} to {fname}')
-            df.set_index(df.columns[0],inplace=True)
-            df.to_csv(fname,index=True)
+            if mode == 'w' or name not in self.writers:
+                self.close_writers([name])
+                self.writers[name] = writers.get_writer(self.output_format,f'{f_out}/{name}',
+                                                        append=(mode == 'a'),
+                                                        date_fields=self.get_date_fields(name))
+            self.logger.info(f'saving {name} to {self.writers[name].fname}')
+            with self.profiler.stage(name,None,'save',rows_in=len(df)):
+                if isinstance(df,SpilledTable):
+                    #write the spilled chunks one at a time, then remove them
+                    for chunk in df:
+                        chunk.set_index(chunk.columns[0],inplace=True)
+                        self.writers[name].write(chunk)
+                    nchunks = len(df.files)
+                    df.cleanup()
+                    self.logger.info(f'saved {len(df)} rows from {nchunks} spilled chunks')
+                    continue
+                df.set_index(df.columns[0],inplace=True)
+                self.writers[name].write(df)
             self.logger.info(df.dropna(axis=1,how='all'))
-        
 
+    def get_date_fields(self,name):
+        """
+        Get the fields of a cdm table that are DATEs, e.g. so they can be saved as dates rather than datetimes
+        """
+        objects = self.get_objs(_classes[name])
+        if len(objects) == 0:
+            return []
+        types = objects[0].schema.types
+        return [field for field,_type in types.items() if _type == 'DATE']
+
+    def close_writers(self,names=None):
+        """
+        Close the output files that are still open
+
+        Args:
+           names (list): names of the tables to close, the default is to close all of them
+        """
+        if names is None:
+            names = list(self.writers.keys())
+        for name in names:
+            if name in self.writers:
+                self.writers.pop(name).close()
@@ -4,6 +4,7 @@ import pandas as pd
 import numpy as np
 from coconnect.cdm.operations import OperationTools
 from coconnect.tools.logger import Logger
+from coconnect.tools import cdm_schema
 
 
 class ConvertDataType(Exception):
@@ -15,6 +16,20 @@ class FailedRequiredCheck(Exception):
 class BadInputs(Exception):
     pass
 
+class ExecutionContext:
+    """
+    Read-only view of the object (e.g. the CommonDataModel) that a cdm object is executed in
+    """
+    def __init__(self,that):
+        object.__setattr__(self,'_that',that)
+
+    def __getattr__(self,name):
+        return getattr(self._that,name)
+
+    def __setattr__(self,name,value):
+        raise AttributeError(f"cannot set '{name}', the execution context is read-only")
+
+
 class Base(object):
     """
     Common object that all CDM objects inherit from
@@ -29,32 +44,28 @@ class Base(object):
            None
         """
         self.name = _type
+        #keep the name of the cdm table, as the name of the object can be changed via set_name
+        self.table = _type
+        #offset to start any generated _ids from, e.g. when outputs are being appended to
+        self.id_offset = 0
         self.tools = OperationTools()
         self.logger = Logger(self.name)
         self.logger.debug("Initialised Class")
         
-        #load the dir path of where this file is
-        dir_path = os.path.dirname(os.path.realpath(__file__))
         #load the details of this cdm objects from the data files taken from OHDSI GitHub
-        # - set the table (e.g. person, condition_occurrence,...)  as the index
-        #   so that all values associated with the object (name) can be retrieved
-        # - then set the field (e.g. person_id, birth_datetime,,) to help with future lookups
-        # - just keep information on if the field is required (Yes/No) and what the datatype is (INTEGER,..)
-        self.cdm = pd.read_csv(f'{dir_path}/../../data/cdm/OMOP_CDM_{_version}.csv',encoding="ISO-8859-1")\
-                     .set_index('table')\
-                     .loc[self.name].set_index('field')[['required', 'type']]
-
-        self.cdm['is_source'] = self.cdm.index.str.endswith("_source_value")
+        #these are loaded once and shared between all objects of the same table
+        self.schema = cdm_schema.get_table(self.name,_version)
+        self.cdm = self.schema.df
         
         #extract all the fields (destination_fields) associated with this cdm object
-        self.fields = self.cdm.index.values
+        self.fields = self.schema.fields
         
         #create new attributes for all the fields in the CDM
         for field in self.fields:
             #extract the datatype
-            _type = self.cdm.loc[field]['type']
+            _type = self.schema.types[field]
             #extract if it is required to be filled or not
-            _required = self.cdm.loc[field]['required']
+            _required = self.schema.required[field]
             self.logger.debug(f'setting up the field {field} -- {_type} -- Required: {_required}')
             #initialise the field with value None
             setattr(self,field,None)
@@ -66,6 +77,9 @@ class Base(object):
         """
         Finalise function, expected to be overloaded by children classes
         """
+        #add any fields that haven't been mapped by any object as nulls, and order the fields
+        df = df.reindex(columns=self.fields)
+
         ninitial = len(df)
         df = df[~df['person_id'].isna()]
         nfinal = len(df)
@@ -78,6 +92,25 @@ class Base(object):
             
         return df
 
+    def sort_rows(self,df,id_field=None):
+        """
+        Sort the rows by person_id, then by the _id of the table if it has been set for every row.
+
+        The sort is stable, so when the _ids are not set (and are generated after the sort), the rows of
+        a person keep the order of the objects and the inputs. This order is the same whether the table
+        is made in one go, in partitions of person_id or in spilled chunks.
+
+        Args:
+           df (pandas.Dataframe): the merged output of the objects
+           id_field (str): the _id field of the table, e.g. 'condition_occurrence_id'
+        Returns:
+           pandas.Dataframe: the sorted dataframe
+        """
+        by = ['person_id']
+        if id_field is not None and df[id_field].notnull().all():
+            by.append(id_field)
+        return df.sort_values(by,kind='stable')
+
 
     def set_name(self,name):
         self.name = name
@@ -100,6 +133,16 @@ class Base(object):
         """
         return list(self.fields)
 
+    def __getattr__(self,name):
+        """
+        Anything not found on this object is looked up in the context it is being executed in
+        e.g. self.inputs in the define function is the inputs of the CommonDataModel
+        """
+        context = self.__dict__.get('_context')
+        if context is None or name.startswith('__'):
+            raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
+        return getattr(context,name)
+
     def execute(self,that):
         """
         execute the creation of the cdm object by passing
@@ -109,15 +152,26 @@ class Base(object):
                  and the define/finalise functions can be overloaded
         """
 
-        #extract all objects from the passed object
-        objs = {k:v for k,v in that.__dict__.items() if k!='logger' }
-        #add objects to this class
-        self.__dict__.update(objs)
-
+        #give read-only access to everything in the passed object, without copying it
+        self._context = ExecutionContext(that)
+        #keep track of what this object had before executing
+        #so anything created by the define function can be released afterwards
+        self._attributes = set(self.__dict__.keys())
         
         #execute the define function that is likely to define the cdm fields based on inputs
         self = self.define(self)
 
+    def release(self):
+        """
+        Release all the series created when executing this object, so they can be freed from memory,
+        should be called once the dataframe has been retrieved with get_df()
+        """
+        for field in self.fields:
+            setattr(self,field,None)
+        attributes = self.__dict__.get('_attributes')
+        if attributes is not None:
+            for key in set(self.__dict__.keys()) - attributes:
+                del self.__dict__[key]
 
     def check_required(self,df):
         """
@@ -130,7 +184,7 @@ class Base(object):
         """
 
         for col in df.columns:
-            _required = self.cdm.loc[col]['required']
+            _required = self.schema.required[col]
             self.logger.debug(f'checking if {col} is required')
             if _required == 'Yes':
                 self.logger.debug(f'... it is required!')
@@ -155,15 +209,19 @@ class Base(object):
         if not self.dtypes:
             return df
 
+        #get the datatype and conversion function of each field, compiled once for this table
+        formatters = self.dtypes.compile(self.table,self.schema.types)
+
         #loop over all columns (series) in the dataframe
         for col in df.columns:
             #extract the datatype associated to this colun
-            _type = self.cdm.loc[col]['type']
+            _type,convert_function = formatters[col]
             self.logger.debug(f'applying formatting to {_type} for field {col}')
 
-            #pull the function of how to convert the column and convert it
+            #convert the column
             try:
-                convert_function = self.dtypes[_type]
+                if convert_function is None:
+                    raise KeyError(_type)
                 df[col] = convert_function(df[col])
             except KeyError:
                 raise 
@@ -183,6 +241,34 @@ class Base(object):
             
         return df
         
+    def align(self,series):
+        """
+        Line up the rows of series that have the same index (person_id) values, but in a different order.
+
+        The index of each series is factorized against the first one, then the series are (stably) sorted
+        by these integer codes, so the nth row of a person_id in one series lines up with its nth row in the others.
+        If the series don't have the same index values, they are sorted by their index instead.
+
+        Args:
+           series (list): the pandas series of each field
+        Returns:
+           list: the series in the same order, with the same index
+        """
+        codes,uniques = pd.factorize(series[0].index)
+        order = np.argsort(codes,kind='stable')
+        codes = codes[order]
+        aligned = [series[0].iloc[order]]
+        index = aligned[0].index
+        for x in series[1:]:
+            _codes = uniques.get_indexer(x.index)
+            _order = np.argsort(_codes,kind='stable')
+            if not np.array_equal(_codes[_order],codes) or (codes < 0).any():
+                return [x.sort_index(kind='stable') for x in series]
+            x = x.iloc[_order]
+            x.index = index
+            aligned.append(x)
+        return aligned
+        
     def get_df(self):
         """
         Retrieve a dataframe from the current object
@@ -199,9 +285,7 @@ class Base(object):
                         
             if series is None:
                 continue
-            series = series.rename(key)
-            series = series.sort_index()
-            dfs[key] = series
+            dfs[key] = series.rename(key)
 
         # non_series = [k for k,v in dfs.items() if isinstance(v,str) ]
         # if len(non_series) == len(dfs.keys()):
@@ -239,16 +323,16 @@ class Base(object):
         #        self.logger.warning(f"      if this is synthetic data... dont worry about it")
         #        dfs[key] = df[~df.index.duplicated()]
             
-        #create a dataframe from all the series objects
-        df = pd.concat(dfs.values(),axis=1)
+        #the series usually all come from the same input, so already share the same index
+        #and can be put together as they are, even if the index (person_id) has duplicates
+        series = list(dfs.values())
+        index = series[0].index
+        if not all(x.index is index or x.index.equals(index) for x in series[1:]):
+            self.logger.debug("the fields have differently ordered indices, lining them up")
+            series = self.align(series)
 
-        #find which fields in the cdm havent been defined
-        missing_fields = set(self.fields) - set(df.columns)
-        #set these to a nan/null series
-        for field in missing_fields:
-            df[field] = np.NaN
-
-        #simply order the columns 
-        df = df[self.fields]
+        #create a dataframe from all the series objects
+        #the fields that haven't been mapped are added once the outputs of all objects are merged
+        df = pd.concat(series,axis=1)
         
         return df
@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 from .base import Base
 
 class ConditionOccurrence(Base):
@@ -21,9 +22,9 @@ class ConditionOccurrence(Base):
         """
 
         df = super().finalise(df)
-        df = df.sort_values('person_id')
+        df = self.sort_rows(df,'condition_occurrence_id')
         if df['condition_occurrence_id'].isnull().any():
-            df['condition_occurrence_id'] = df.reset_index().index + 1
+            df['condition_occurrence_id'] = df.reset_index().index + 1 + self.id_offset
 
             
         return df
@@ -42,7 +43,8 @@ class ConditionOccurrence(Base):
         df = super().get_df()
 
         #make sure the concept_ids are numeric, otherwise set them to null
-        df['condition_concept_id'] = pd.to_numeric(df['condition_concept_id'],errors='coerce')
+        #(they are all null if the concept_id hasn't been mapped)
+        df['condition_concept_id'] = pd.to_numeric(df.get('condition_concept_id',np.nan),errors='coerce')
 
         #require the condition_concept_id to be filled
         nulls = df['condition_concept_id'].isnull()
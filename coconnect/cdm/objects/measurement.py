@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 from .base import Base
 
 class Measurement(Base):
@@ -23,9 +24,9 @@ class Measurement(Base):
         """
 
         df = super().finalise(df)
-        df = df.sort_values('person_id')
+        df = self.sort_rows(df,'measurement_id')
         if df['measurement_id'].isnull().any():
-            df['measurement_id'] = df.reset_index().index + 1
+            df['measurement_id'] = df.reset_index().index + 1 + self.id_offset
 
             
         return df
@@ -44,7 +45,8 @@ class Measurement(Base):
         df = super().get_df()
 
         #make sure the concept_ids are numeric, otherwise set them to null
-        df['measurement_concept_id'] = pd.to_numeric(df['measurement_concept_id'],errors='coerce')
+        #(they are all null if the concept_id hasn't been mapped)
+        df['measurement_concept_id'] = pd.to_numeric(df.get('measurement_concept_id',np.nan),errors='coerce')
 
         #require the measurement_concept_id to be filled
         nulls = df['measurement_concept_id'].isnull()
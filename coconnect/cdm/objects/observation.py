@@ -1,4 +1,5 @@
 import pandas as pd
+import numpy as np
 from .base import Base
 
 class Observation(Base):
@@ -23,9 +24,9 @@ class Observation(Base):
         """
 
         df = super().finalise(df)
-        df = df.sort_values('person_id')
+        df = self.sort_rows(df,'observation_id')
         if df['observation_id'].isnull().any():
-            df['observation_id'] = df.reset_index().index + 1
+            df['observation_id'] = df.reset_index().index + 1 + self.id_offset
 
             
         return df
@@ -44,7 +45,8 @@ class Observation(Base):
         df = super().get_df()
 
         #make sure the concept_ids are numeric, otherwise set them to null
-        df['observation_concept_id'] = pd.to_numeric(df['observation_concept_id'],errors='coerce')
+        #(they are all null if the concept_id hasn't been mapped)
+        df['observation_concept_id'] = pd.to_numeric(df.get('observation_concept_id',np.nan),errors='coerce')
 
         #require the observation_concept_id to be filled
         nulls = df['observation_concept_id'].isnull()
@@ -10,7 +10,7 @@ class Person(Base):
 
     def finalise(self,df):
         df = super().finalise(df)
-        return df.sort_values('person_id')
+        return self.sort_rows(df)
         
     def get_df(self,do_auto_conversion=False):
         """
@@ -28,13 +28,14 @@ class Person(Base):
 
 
         #auto conversion
-        if do_auto_conversion:
+        #only the fields that have been mapped are in the dataframe
+        if do_auto_conversion and 'birth_datetime' in df:
             if not df['birth_datetime'].isnull().any():
-                if df['year_of_birth'].isnull().all():
+                if 'year_of_birth' not in df or df['year_of_birth'].isnull().all():
                     df['year_of_birth'] = self.tools.get_year(df['birth_datetime'])
-                if df['month_of_birth'].isnull().all():
+                if 'month_of_birth' not in df or df['month_of_birth'].isnull().all():
                     df['month_of_birth'] = self.tools.get_month(df['birth_datetime'])
-                if df['day_of_birth'].isnull().all():
+                if 'day_of_birth' not in df or df['day_of_birth'].isnull().all():
                     df['day_of_birth'] = self.tools.get_day(df['birth_datetime'])
         
         
@@ -21,9 +21,9 @@ class VisitOccurrence(Base):
         """
 
         df = super().finalise(df)
-        df = df.sort_values('person_id')
+        df = self.sort_rows(df,'visit_occurrence_id')
         if df['visit_occurrence_id'].isnull().any():
-            df['visit_occurrence_id'] = df.reset_index().index + 1
+            df['visit_occurrence_id'] = df.reset_index().index + 1 + self.id_offset
 
             
         return df
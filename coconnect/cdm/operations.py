@@ -1,19 +1,18 @@
 import pandas as pd
-import datetime
+from coconnect.tools import dates
 
 class OperationTools:
 
-    get_datetime = lambda self,df : pd.to_datetime(df).dt.strftime('%Y-%m-%d %H:%M:%S')
-    get_date = lambda self,df : pd.to_datetime(df).dt.strftime('%Y-%m-%d')
-    get_year = lambda self,df : pd.to_datetime(df).dt.year.astype('Int64')
-    get_month = lambda self,df : pd.to_datetime(df).dt.month.astype('Int64')
-    get_day = lambda self,df : pd.to_datetime(df).dt.day.astype('Int64')
+    #the dates are parsed by the shared parser, so each distinct date is only parsed once
+    get_datetime = lambda self,df : dates.format_datetime(dates.parse(df))
+    get_date = lambda self,df : dates.format_date(dates.parse(df))
+    get_year = lambda self,df : dates.parse(df).dt.year.astype('Int64')
+    get_month = lambda self,df : dates.parse(df).dt.month.astype('Int64')
+    get_day = lambda self,df : dates.parse(df).dt.day.astype('Int64')
 
     def get_datetime_from_age(self,df,norm=None):
-        if norm is None:
-            #set normalisation to middle of 2020
-            norm = datetime.datetime(2020, 7, 1)
-        retval = df.fillna(0).apply(lambda x: norm - datetime.timedelta(days=365*int(x)))
+        #normalised to the middle of 2020 by default
+        retval = dates.get_datetime_from_age(df,norm,whole_years=True)
         return self.get_datetime(retval)
 
     def get_source_field_name_as_value(self,series):
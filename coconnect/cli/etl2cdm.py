@@ -18,6 +18,16 @@ parser.add_argument('--chunk-size', default = None, type=int,
                     help='define how to "chunk" the dataframes, this specifies how many rows in the csv files to read in at a time')
 parser.add_argument('--max-chunks', default = None, type=int,
                     help='define the maximum nchunks of data to process')
+parser.add_argument('--workers', default = 1, type=int,
+                    help='number of processes to map the chunks of the inputs with, the outputs are the same as running with one')
+parser.add_argument('--read-ahead', default = 0, type=int,
+                    help='number of chunks of the inputs to read ahead in a background thread, the mapped chunks are then also saved in a background thread')
+parser.add_argument('--untyped-reads',help='read every column of the inputs, and infer the types of each chunk, rather than only reading the columns that are mapped',action='store_true')
+parser.add_argument('--resume',help='resume the last run into the output folder from the last chunk it completed, if it failed part of the way through',action='store_true')
+parser.add_argument('--incremental',help='only process the inputs that have changed, or the rows appended to them, since the last run into the output folder',action='store_true')
+parser.add_argument('--save-split',help='save the outputs for each input file as csv files in cdm_split, before they are merged (for debugging)',action='store_true')
+parser.add_argument('--plan-cache', default = None,
+                    help='file to save the compiled mapping (execution plan) to, it is reused by the next run if the mapping and inputs have not changed')
 parser.add_argument('-v','--verbose',help='set debugging level',action='store_true')
 parser.add_argument('--skip',type=str,nargs='+',help='pass a list of cdm destination fields to skip',default=None)
 parser.add_argument('--mask-id',type=int,choices=[0,1],help='masking of the patient id',default=1)
@@ -39,6 +49,14 @@ def main():
         runner.set_output_folder(args.output_folder)
     if args.skip != None:
         runner.set_skip_fields(args.skip)
+    runner.set_workers(args.workers)
+    runner.set_read_ahead(args.read_ahead)
+    runner.set_save_split_files(args.save_split)
+    runner.set_resume(args.resume)
+    runner.set_incremental(args.incremental)
+    runner.set_typed_reads(not args.untyped_reads)
+    if args.plan_cache != None:
+        runner.set_plan_cache(args.plan_cache)
 
     runner.set_override_source_term_mapping(args.force_source_value_mapping)
     runner.set_perform_person_id_mask(args.mask_id)
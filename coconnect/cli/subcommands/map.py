@@ -3,8 +3,11 @@ import os
 import click
 import json
 import glob
+import hashlib
 import coconnect
 import coconnect.tools as tools
+from coconnect.tools.input_state import InputState
+from coconnect.tools.logger import Logger
 
     
 @click.group()
@@ -41,6 +44,50 @@ def list_classes():
     print (json.dumps(tools.get_classes(),indent=6))
         
 
+def plan_increment(files,output_folder,key,appendable=True):
+    """
+    Compare the inputs with the state recorded by the last run into the output folder.
+    If rows have only been appended to the inputs since then, only these rows need to be processed,
+    and their outputs can be appended to the outputs of the last run.
+
+    Args:
+       files (dict): map of input name to file name
+       output_folder (str): where the outputs are saved
+       key (str): hash of the mapping and settings, the last run must have been run with the same key
+       appendable (bool): whether the outputs can be appended to, otherwise everything is processed if anything changed
+    Returns:
+       InputState: the state to record once the run has completed
+       dict: the Change of each input
+       dict: the number of rows saved to each output by the last run, to append to,
+             or None if everything needs to be processed
+    """
+    logger = Logger('map')
+    fname = f'{output_folder}/input_state.json'
+    previous = InputState.load(fname,key)
+    state = InputState(fname,key)
+    if previous is None:
+        logger.info(f'There is no record ({fname}) of a previous run with the same mapping'
+                    ' and settings, so everything will be processed')
+        return state,state.get_changes(files),None
+
+    changes = previous.get_changes(files)
+    for name,change in changes.items():
+        logger.info(f'Input "{name}" is {change.status}')
+
+    statuses = set(change.status for change in changes.values())
+    if statuses - {'unchanged','appended'}:
+        logger.info('Some of the inputs have changed, so everything will be processed')
+        return state,changes,None
+    if 'appended' in statuses and not appendable:
+        logger.info('The outputs cannot be appended to, so everything will be processed')
+        return state,changes,None
+    if 'appended' in statuses and previous.nrows_unknown_person > 0:
+        #these rows could be for people that are in the rows appended to the inputs of the person table
+        logger.info(f'The last run dropped {previous.nrows_unknown_person} rows with a person_id that was not'
+                    ' in the person table, so everything will be processed')
+        return state,changes,None
+    return state,changes,dict(previous.outputs)
+
 @click.command(help="Perform OMOP Mapping")
 @click.option("--name",
               required=True,
@@ -67,12 +114,32 @@ def list_classes():
 @click.option("--output-folder",
               default=None,
               help="define the output folder where to dump csv files to")
+@click.option("--output-format",
+              default='csv',
+              type=click.Choice(['csv','parquet','feather']),
+              help="the format to save the outputs in, parquet and feather need pyarrow to be installed")
+@click.option("--workers",
+              default=1,
+              type=int,
+              help="number of processes to use to execute the cdm objects, the default of 1 runs serially")
+@click.option("--chunk-size",
+              default=None,
+              type=int,
+              help="stream the inputs in partitions of person_id, reading this many rows at a time, to limit the memory used")
+@click.option("--max-memory",
+              default=None,
+              type=int,
+              help="memory (in MB) the outputs of a table can use before they are spilled to disk")
+@click.option("--incremental",
+              is_flag=True,
+              help="only process the rows appended to the inputs since the last run into the output folder,\
+              and append them to its outputs, if the inputs have otherwise not changed")
 @click.argument("inputs",
                 nargs=-1)
 @click.pass_context
 def run(ctx,
         name,rules,inputs,output_folder,
-        strip_name,drop_csv_from_name,type):
+        strip_name,drop_csv_from_name,type,workers,chunk_size,max_memory,output_format,incremental):
 
     if not rules is None:
         ctx.invoke(make_class,name=name,rules=rules)
@@ -110,7 +177,8 @@ def run(ctx,
             source_map[table].append(field)
 
         source_map = {
-            k:list(set(v))
+            #sorted, so the fields (and the key of the incremental state) don't depend on the hash seed
+            k:sorted(set(v))
             for k,v in source_map.items()
         }
 
@@ -136,15 +204,56 @@ def run(ctx,
             for k,v in inputs.items()
             if k in source_map
         }
-    if type == 'csv':
-        inputs = tools.load_csv(inputs)
-    else:
-        raise NotImplementedError("Can only handle inputs that are .csv so far")
-        
     available_classes = tools.get_classes()
     if name not in available_classes:
         raise KeyError(f"cannot find config for {name}")
 
+    if output_folder is None:
+        output_folder = os.getcwd()+'/output_data/'
+
+    #the outputs are replaced, unless running incrementally and rows have only been appended to the inputs
+    state = None
+    append_to = None
+    skip_rows = None
+    if incremental:
+        files = {
+            k: v if isinstance(v,str) else v['file']
+            for k,v in inputs.items()
+        }
+        #the state of the inputs is only valid for the same mapping (the class) and settings
+        with open(available_classes[name]['path'],'rb') as f:
+            key = hashlib.sha1(f.read())
+        key.update(repr((sorted(inputs.items(),key=str),output_format,chunk_size)).encode())
+
+        #the rows appended to an input can only be processed on their own
+        #if each object is made from a single input, which can be checked in the rules
+        appendable = True
+        if rules is None:
+            Logger('map').warning('Without the rules, appending assumes each object is made from a single input')
+        else:
+            appendable = all(
+                len(set(x['source_table'] for x in cdm_obj.values())) == 1
+                for cdm_obj_set in config.values()
+                for cdm_obj in cdm_obj_set
+            )
+        state,changes,append_to = plan_increment(files,output_folder,key.hexdigest(),appendable)
+
+        if all(change.status == 'unchanged' for change in changes.values()) and append_to is not None:
+            Logger('map').info('None of the inputs have changed since the last run, so there is nothing to do')
+            return
+        if append_to is not None:
+            skip_rows = {k:change.nrows for k,change in changes.items()}
+
+    #the state is recorded again once the outputs have been saved
+    #so if this run fails, the next one processes everything
+    if os.path.exists(f'{output_folder}/input_state.json'):
+        os.remove(f'{output_folder}/input_state.json')
+
+    if type == 'csv':
+        inputs = tools.load_csv(inputs,chunksize=chunk_size,skip_rows=skip_rows)
+    else:
+        raise NotImplementedError("Can only handle inputs that are .csv so far")
+
     module = __import__(available_classes[name]['module'],fromlist=[name])
     defined_classes = [
         m[0]
@@ -152,16 +261,27 @@ def run(ctx,
         if m[1].__module__ == module.__name__
     ]
 
-    
-    if output_folder is None:
-        output_folder = os.getcwd()+'/output_data/'
-
-    
+    nrows_saved = {}
+    nrows_unknown_person = 0
     for defined_class in defined_classes:
         cls = getattr(module,defined_class)
         c = cls(inputs=inputs,
                 output_folder=output_folder)
-        c.process()
+        c.process(workers=workers,output_format=output_format,max_memory=max_memory,append_to=append_to)
+        nrows_saved.update(c.nrows_saved)
+        nrows_unknown_person += c.nrows_unknown_person
+
+    if state is not None:
+        if isinstance(inputs,tools.PartitionedInputs):
+            nrows_read = inputs.nrows_read
+        else:
+            nrows_read = {k:len(df) for k,df in inputs.items()}
+        for k,change in changes.items():
+            skipped = skip_rows.get(k,0) if skip_rows is not None else 0
+            state.update_input(k,change,skipped+nrows_read.get(k,0))
+        state.outputs = nrows_saved
+        state.nrows_unknown_person = nrows_unknown_person
+        state.save()
         
     
 map.add_command(show,"show")
@@ -33,13 +33,49 @@ import copy
 import json
 import re
 import random
-
-
+import shutil
+import collections
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from coconnect.tools import cdm_schema, dates
+from coconnect.tools.spilled_table import SpilledTable
+from coconnect.tools.person_id_masker import PersonIdMasker
+from coconnect.tools.pipeline import ReadAhead, BackgroundWriter
+from coconnect.tools.input_state import InputState
 from .operations import ETLOperations
+from .manifest import RunManifest
+from .plan import ExecutionPlan, TablePlan, SourcePlan, FieldPlan, Rule, TermIndex, make_key
 from .exceptions import NoInputData, NoInputData, \
     NoTermMapping, BadStructuralMapping, MadMapping,\
     MissingRequiredMapping, BadDestinationField,\
-    BadJoin, BadPrimaryKeyDefined
+    BadPrimaryKeyDefined, NoPrimaryKeyDefined, NoStructuralMapping
+
+
+@contextlib.contextmanager
+def _noop():
+    """
+    A context manager that does nothing (contextlib.nullcontext needs python 3.7)
+    """
+    yield
+
+
+#the tool the workers map chunks with
+#this is set before the pool is created, so forked workers inherit it (and its compiled plan)
+_worker_tool = None
+
+def _map_chunk(source_table,destination_tables,df_table_data,icounter):
+    """
+    Map a chunk of a source table to all of its destination tables inside of a worker process
+
+    Returns:
+       list: the chunk of each destination table
+    """
+    return [
+        _worker_tool.map_chunk(destination_table,source_table,df_table_data,icounter)
+        for destination_table in destination_tables
+    ]
 
 
 class ETLTool:
@@ -68,21 +104,141 @@ class ETLTool:
         
         raise NotImplementedError(f"{fname} is not a .csv file. Don't know how to handle non csv files yet!")
 
-    def load_df_chunks(self,fname,chunk_size=None):
+    def load_df_chunks(self,fname,chunk_size=None,read_ahead=None,columns=None,dtype=None,skip_chunks=0,skip_rows=0):
         """
         Extract a pandas Dataframe from an input csv file
         Args:
            fname (str): the file name
            chunksize(int): specify how many rows to read in per chunk
+           read_ahead(int): how many chunks to read ahead in a background thread, 0 to not read ahead
+           columns(list): only read these columns (lower case names), the default is to read all of them
+           dtype(dict): dtypes of some of the columns (lower case names), the rest are inferred
+           skip_chunks(int): number of chunks at the start of the file to skip
+           skip_rows(int): number of rows at the start of the file to skip, before any chunks are skipped
         Returns: 
-           Pandas TextFileReader
+           Pandas TextFileReader, or an iterator of the chunks
         """
         if chunk_size == None:
             chunk_size = self.chunk_size
+        if read_ahead == None:
+            read_ahead = self.read_ahead
+
+        kwargs = {}
+        skip_rows += skip_chunks*chunk_size
+        if skip_rows > 0:
+            #skip the rows, but not the header
+            kwargs['skiprows'] = range(1,skip_rows+1)
+        if columns is not None:
+            columns = set(columns)
+            kwargs['usecols'] = lambda col: col.lower() in columns
+        if dtype:
+            #the dtypes need the names of the columns as they are in the file
+            header = pd.read_csv(fname,nrows=0).columns
+            kwargs['dtype'] = {
+                col:dtype[col.lower()]
+                for col in header
+                if col.lower() in dtype
+            }
             
-        chunks = pd.read_csv(fname,chunksize=chunk_size)
+        chunks = pd.read_csv(fname,chunksize=chunk_size,**kwargs)
+        if dtype and 'category' in dtype.values():
+            chunks = self.convert_categories(chunks)
+        if read_ahead > 0:
+            chunks = ReadAhead(chunks,read_ahead)
         return chunks
 
+    def convert_categories(self,chunks):
+        """
+        Convert the categories of categorical columns to numbers, where they all are,
+        as they would have been if the column was read without a dtype
+        """
+        for chunk in chunks:
+            for col in chunk.select_dtypes('category').columns:
+                try:
+                    categories = pd.to_numeric(chunk[col].cat.categories)
+                    chunk[col] = chunk[col].cat.rename_categories(categories)
+                except (ValueError,TypeError):
+                    #not all numbers, or different strings for the same number e.g. 1 and 01
+                    pass
+            yield chunk
+
+    def get_source_table_dtypes(self,source_table):
+        """
+        Get the columns of a source table that are used by the plan, and the dtypes to read them with
+        - the primary key is read as a string, so it has the same type in every chunk
+          (numeric keys are still ordered as numbers, see get_numeric_keys)
+        - columns that are only term mapped are read as categoricals, so each value is only mapped once
+
+        Args:
+           source_table (str): name of the source table
+        Returns:
+           list: the (lower case) names of the columns to read
+           dict: the dtypes of some of the columns
+        """
+        columns = []
+        categorical = {}
+        dtype = {}
+        for table in self.plan:
+            for source in table.sources:
+                if source.source_table != source_table:
+                    continue
+                if table.primary_key is not None:
+                    columns.append(table.primary_key)
+                    dtype[table.primary_key] = str
+                for field in source.fields:
+                    for rule in field.rules:
+                        columns.append(rule.source_field)
+                        is_categorical = rule.term_mapping
+                        if is_categorical:
+                            term_index = self.plan.get_term_index(rule.rule_id)
+                            #the temporary truncation mapping, and merging with duplicated terms,
+                            #work on the values of the column, not the categories
+                            is_categorical = term_index.is_unique and not term_index.is_truncation
+                        categorical[rule.source_field] = categorical.get(rule.source_field,True) and is_categorical
+
+        for col,is_categorical in categorical.items():
+            if is_categorical and col not in dtype:
+                dtype[col] = 'category'
+        return list(dict.fromkeys(columns)),dtype
+
+    def get_numeric_keys(self):
+        """
+        Find the primary keys that are numbers, from the first chunk of each source table,
+        so they are ordered as numbers in every chunk when they are read as strings (typed reads)
+
+        Returns:
+           dict: the set of numeric primary keys (lower case names) of each source table
+        """
+        numeric_keys = {}
+        if not self.typed_reads:
+            return numeric_keys
+        for source_table in self.plan.get_source_tables():
+            keys = [
+                table.primary_key
+                for table in self.plan
+                for source in table.sources
+                if source.source_table == source_table and table.primary_key is not None
+            ]
+            if len(keys) == 0:
+                continue
+            chunks = self.load_df_chunks(self.map_input_files[source_table],
+                                         read_ahead=0,
+                                         columns=keys,
+                                         dtype={key:str for key in keys})
+            df = next(iter(chunks),None)
+            chunks.close()
+            if df is None:
+                continue
+            df.columns = df.columns.str.lower()
+            numeric_keys[source_table] = set()
+            for key in set(keys):
+                try:
+                    pd.to_numeric(df[key])
+                except (ValueError,TypeError):
+                    continue
+                numeric_keys[source_table].add(key)
+        return numeric_keys
+
     def load_df(self,fname,lower_case=True):
         """
         Extract a pandas Dataframe from an input csv file
@@ -165,6 +321,60 @@ class ETLTool:
         """
         self.chunk_size = chunk_size
         
+    def set_plan_cache(self,fname):
+        """
+        Set a file to cache the compiled execution plan in, so it can be reused by runs with the same mapping
+        Args:
+            fname (str): the file name
+        """
+        self.plan_cache = fname
+
+    def set_workers(self,workers):
+        """
+        Set the number of processes to map the chunks of the source tables with
+        Args:
+            workers (int): the number of processes, the default (1) maps the chunks serially
+        """
+        self.workers = workers
+
+    def set_read_ahead(self,n):
+        """
+        Set how many chunks of the inputs to read ahead in a background thread while the current one is mapped.
+        When this is set, the mapped chunks are also saved in a background thread.
+        Args:
+            n (int): the number of chunks, the default (0) reads, maps and saves each chunk in turn
+        """
+        self.read_ahead = n
+
+    def set_typed_reads(self,b_value):
+        """
+        Set whether to only read the columns of the inputs that are used by the mapping,
+        with the primary key as a string and term mapped columns as categoricals.
+        Otherwise every column is read, and its type is inferred for each chunk.
+        Args:
+            b_value (bool): whether to use typed reads
+        """
+        self.typed_reads = b_value
+
+    def set_resume(self,b_value):
+        """
+        Set whether to resume the last run into the output folder, if it did not complete,
+        rather than starting again. The run can only be resumed with the same mapping, inputs and settings.
+        Args:
+            b_value (bool): whether to resume
+        """
+        self.resume = b_value
+
+    def set_incremental(self,b_value):
+        """
+        Set whether to only process what has changed since the last run into the output folder.
+        Inputs are fingerprinted, so the outputs of unchanged inputs are kept, only the rows appended to an input
+        are mapped and appended to its outputs, and the outputs of inputs that have otherwise changed are replaced.
+        Args:
+            b_value (bool): whether to run incrementally
+        """
+        self.incremental = b_value
+
     def set_max_chunks(self,n):
        """
        """
@@ -175,6 +385,15 @@ class ETLTool:
         
     def set_merge_files(self,b_save):
         self.merge_files = b_save
+
+    def set_save_split_files(self,b_save):
+        """
+        Set whether to save the mapped chunks of each source table as csv files in cdm_split,
+        which is useful for debugging. Otherwise they are only staged in temporary binary files until they are merged.
+        Args:
+            b_save (bool): whether to save the split files
+        """
+        self.save_split_files = b_save
         
         
     def load_cdm(self,f_cdm):
@@ -185,7 +404,8 @@ class ETLTool:
         Returns:
            None
         """
-        self.df_cdm = pd.read_csv(f_cdm,encoding="ISO-8859-1").set_index('table')
+        #the cdm is shared and cached, so take a copy as it gets modified here
+        self.df_cdm = cdm_schema.read_cdm(f_cdm).copy()
         self.df_cdm['required'] = self.df_cdm['required'] == 'Yes'
 
         self.logger.debug(self.df_cdm)
@@ -359,20 +579,37 @@ class ETLTool:
 
 
     def map_via_rule(self,df,df_map,source_field,destination_field):
+        """
+        Map the terms of a source field to the destination field via a term mapping
+        Args:
+           df (pandas.DataFrame): the dataframe for the original source data
+           df_map (pandas.DataFrame or TermIndex): the term mapping of the rule
+           source_field (str): the name of the field(column) in the source data 
+           destination_field (str): the name of the field(column) to be set as the new output
+        Returns:
+           a new pandas dataframe of the destination field
+        """
+        if not isinstance(df_map,TermIndex):
+            df_map = TermIndex(df_map)
+            
         df_orig = df[[source_field]]
 
         orig_type = df_orig[source_field].dtype
-        map_type = df_map['source_term'].dtype
+        is_categorical = isinstance(orig_type,pd.CategoricalDtype)
+        if is_categorical:
+            #the categories are the values that are mapped
+            orig_type = orig_type.categories.dtype
+        map_type = df_map.source_terms.dtype
 
         #check for truncation of terms!
-        is_truncation = any(df_map['source_term'].str.contains('List truncated'))
+        is_truncation = df_map.is_truncation
         
         
         #need this step to make sure theyre the same type
         #this isnt working by default because we dumped the csvs with "blah","blah"
         if map_type != orig_type and not is_truncation:
             try:
-                df_map['source_term'] = df_map['source_term'].astype(orig_type)
+                df_map.get_index(orig_type)
             except ValueError as err:
                 orig = df_orig[source_field]
 
@@ -387,16 +624,19 @@ class ETLTool:
                        self.logger.error(f"Mapping source type = {map_type}")
                        self.logger.error(f"Original source type = {orig_type}")
                        
-                       new = df_map['source_term']
+                       new = df_map.source_terms
                        self.logger.error("EXAMPLEs")
                        self.logger.error(f"Source : {orig}")
                        self.logger.error(f"Trying being mapped with: {new}")
                        
                        raise MadMapping(err)
                 
+        if is_categorical and (is_truncation or not df_map.is_unique):
+            df_orig = df_orig.astype(object)
+
         #this is a temp hack, we should remove this!!!
         if is_truncation:
-            new_term = df_map.iloc[0]['destination_term']
+            new_term = df_map.df_map.iloc[0]['destination_term']
             df_orig[df_orig.notnull()] = new_term
             df_orig = df_orig.rename({
                 source_field : destination_field
@@ -405,13 +645,19 @@ class ETLTool:
                                 'You would have received a pandas warning about slice copying. '
                                 'CBA to fix this as this will be removed')
 
+        elif df_map.is_unique:
+            #look up the destination term of each unique value in the hash index
+            df_orig = pd.DataFrame({
+                destination_field:df_map.lookup(df_orig[source_field])
+            },index=df_orig.index)
+            
         else:
             #pandas removes the index when using merge
             #need to preserve it for when we're chunking data
             #https://stackoverflow.com/questions/11976503/how-to-keep-index-when-using-pandas-merge
             _index = df_orig.index
             
-            df_orig = df_orig.merge(df_map,
+            df_orig = df_orig.merge(df_map.get_df_map(orig_type),
                                 left_on=source_field,
                                 right_on='source_term',
                                 how='left').set_index(_index)
@@ -495,7 +741,7 @@ class ETLTool:
         # - get the datetime object via .dt
         # - get only the year via the .dt object
         # - convert the series back into a pandas dataframe
-        return pd.to_datetime(series).dt.year
+        return dates.parse(series).dt.year
 
 
     def initialise(self):
@@ -594,6 +840,11 @@ class ETLTool:
 
         
         self.logger.info(f'Destination tables to create... {list(self.destination_tables)}')
+
+        #compile the mapping into the plan of what to do with each chunk of the inputs
+        self.plan = self.compile_plan()
+        self.build_executors()
+        
         self.logger.info(f'Done with tool initialisation...')
         self.tool_initialised = True
     
@@ -606,6 +857,22 @@ class ETLTool:
         self.verbose = False
         self.chunk_size = 10**6
         self.max_chunks = -1 
+        self.workers = 1
+        self.read_ahead = 0
+        self.typed_reads = True
+        #record of the chunks that have been completed, so a run can be resumed
+        self.resume = False
+        self.manifest = None
+        #only process the inputs that have changed, or the rows appended to them, since the last run
+        self.incremental = False
+        self.input_state = None
+        #what to do for each destination table, and the row to start reading each source table from
+        self.table_modes = {}
+        self.start_rows = {}
+        #the number of rows of each output that is being appended to, to carry on their ids from
+        self.id_offsets = {}
+        #the primary keys of each source table that are read as strings, but are ordered as numbers
+        self.numeric_keys = {}
         self.output_data_folder = None
         self.df_term_mapping = None
         self.df_structural_mapping = None
@@ -613,6 +880,9 @@ class ETLTool:
         self.map_input_files = None
         self.tool_initialised = False
         self.skip_fields = None
+        #file to save the compiled execution plan to, and load it from in the next run
+        self.plan_cache = None
+        self.plan = None
 
         #save a map for indices, this could be loaded from structural mapping
         #or we could have this as a separate input
@@ -622,9 +892,15 @@ class ETLTool:
         self.save_files = True
         self.merge_files = True
         self.record_duplicates = False
+        #save the outputs for each source table as csv files, before they are merged
+        self.save_split_files = False
+        #stage the outputs for each source table in feather files until they are merged, if pyarrow is installed
+        self.stage_split_files = None
 
         #default is to mask person_ids
         self.perform_person_id_mask = False
+        #lookup of the masked person_ids, shared by all chunks and tables
+        self.person_id_masker = None
         #default is to automatically try and map fields e.g. year_of_birth --> extract year
         self.use_auto_functions = True
         # Fill in the blanks for testing some ids
@@ -656,22 +932,25 @@ class ETLTool:
             'FLOAT' : lambda x : x.astype('Float64'),
             'VARCHAR': lambda x : x.fillna('').astype(str).apply(lambda x: x[:50]),
             'STRING(50)': lambda x : x.fillna('').astype(str).apply(lambda x: x[:50]),
-            'DATETIME': lambda x : pd.to_datetime(x,errors='coerce').dt.strftime('%Y-%m-%d %H:%M:%S'),
-            'DATE': lambda x : pd.to_datetime(x,errors='coerce').dt.date
+            'DATETIME': lambda x : dates.format_datetime(pd.to_datetime(x,errors='coerce')),
+            'DATE': lambda x : dates.format_date(pd.to_datetime(x,errors='coerce'))
         }
         
         self.allowed_operations = ETLOperations()
 
     
-    def process_destination_table(self,destination_table):
+    def compile_table(self,destination_table):
         """
-        Process a destination table (an output table in the cdm)
+        Compile the structural mapping of a destination table (an output table in the cdm)
+        into the rules to apply to each source table
+
+        Args:
+           destination_table (str): name of the cdm table
+        Returns:
+           TablePlan: the source tables, primary key and rules for each destination field
         """
-        self.logger.info(f'Now running on Table "{destination_table}"')
+        self.logger.info(f'Compiling the mapping for Table "{destination_table}"')
 
-        #create a list that will help track the output files we create
-        output_files = []
-        
         #load the CDM for this destination_table, e.g. patient
         partial_cdm = self.df_cdm.loc[destination_table]
         
@@ -696,7 +975,6 @@ class ETLTool:
             self.logger.info(indexer)
             self.map_indexer[destination_table] = indexer
 
-        
         bad = []
         for x in mapped_fields:
             if x not in list(destination_fields):
@@ -721,251 +999,644 @@ class ETLTool:
         all_source_tables = json.dumps(source_tables,indent=4)
         self.logger.debug(f'All source tables needed to map {destination_table} \n {all_source_tables}')
 
-
-        
         if len(source_tables) > 1:
             self.logger.debug(f'OK more than two tables mapping to the CDM "{destination_table}"')
-            
-        
+
+        primary_key = None
+        if destination_table in self.map_indexer:
+            indices = list(self.map_indexer[destination_table].values())
+            if len(indices)> 1:
+                self.logger.error('too many indices set')
+                raise BadPrimaryKeyDefined('Youve set multiple primary keys.'
+                                           ' Not allowed yet!')
+            elif len(indices) ==1 :
+                primary_key = indices[0]
+        else:
+            raise NoPrimaryKeyDefined(f"No primary key defined for {destination_table} "
+                                      f"in {source_tables}")
+
+        sources = []
         for source_table in source_tables:
             #structural mapping associated with the destination table and the source table
             df_mapping = self.get_structural_mapping(destination_table,source_table)
-            
-            #load the data we need
-            #load in chunks to conserve memory when we have huge inputs
-            chunks_table_data = self.load_df_chunks(self.map_input_files[source_table],
-                                                    self.chunk_size)
-        
-            #start looping over the chunks of data
-            #the default will be to have ~100k rows per chunk
-            for icounter,df_table_data in enumerate(chunks_table_data):
-                if self.max_chunks > 0 :
-                    if icounter >= self.max_chunks :
-                        self.logger.info('youve had enough')
-                        break
-                
-                #use lower case to be safe because of WhiteRabbit Issues...
-                df_table_data.columns = df_table_data.columns.str.lower()
-                nrows = len(df_table_data)
-                self.logger.info(f'Processing {icounter} with length {nrows}')
-
-                primary_key = None
-                if destination_table in self.map_indexer:
-                    indices = list(self.map_indexer[destination_table].values())
-                    if len(indices)> 1:
-                        self.logger.error('too many indices set')
-                        raise BadPrimaryKeyDefined('Youve set multiple primary keys.'
-                                                   ' Not allowed yet!')
-                    elif len(indices) ==1 :
-                        primary_key = indices[0]
-                        if primary_key in df_table_data.columns:
-                            #clone the index to be this column
-                            df_table_data.index = df_table_data[primary_key]
-                            self.logger.info(f'Managed to set the index {primary_key} for {source_table}')
-                        else:
-                            self.logger.warning(f'Attempting to set {primary_key}, which is not in {df_table_data.columns}')
-                            self.logger.warning(self.map_indexer)
-                            self.logger.warning(f'Currently working on {self.map_input_files[source_table]}')
-                            self.logger.warning(f"No primary key defined for {destination_table} "
-                                                f"in {source_table}")
-                            #raise BadPrimaryKeyDefined(f'Not able to find primary key in the table')
-                else:
-                    raise NoPrimaryKeyDefined(f"No primary key defined for {destination_table} "
-                                             f"in {source_table}")
-                            
-                columns_output = {}
-                
-                mapped_fields_for_current_source_table = df_mapping.index.unique().to_list()
-                if self.skip_fields:
-                     mapped_fields_for_current_source_table = [
-                         field
-                         for field in mapped_fields_for_current_source_table
-                         if field not in self.skip_fields
-                     ]
-                     self.logger.info(f'Removed {self.skip_fields} ')
 
-                
-                #now start the real work of making new columns based on the mapping rules
-                for destination_field in mapped_fields_for_current_source_table:
-                    self.logger.info(f'Working on {destination_field}')
+            mapped_fields_for_current_source_table = df_mapping.index.unique().to_list()
+            if self.skip_fields:
+                 mapped_fields_for_current_source_table = [
+                     field
+                     for field in mapped_fields_for_current_source_table
+                     if field not in self.skip_fields
+                 ]
+                 self.logger.info(f'Removed {self.skip_fields} ')
+
+            fields = []
+            for destination_field in mapped_fields_for_current_source_table:
+                #get all rules associated with the current field in the cdm 
+                rules = []
+                for _,rule in df_mapping.loc[[destination_field]].iterrows():
+                    term_mapping = rule['term_mapping'] != 'n'
+
+                    #perform a check to see if a source value is being mapped still
+                    if "_source_value" in destination_field\
+                       and not '_source_concept_id' in destination_field:
+
+                        if rule['term_mapping'] == 'y':
+                            self.logger.error('You have term mapping applied for'
+                                              f' the field {destination_field}'
+                                              ' are you sure!?'
+                                              ' This should be a source value!')
+                            if self.override_source_term_mapping:
+                                term_mapping = False
+
+                    rules.append(Rule(rule_id=rule['rule_id'],
+                                      source_field=rule['source_field'].lower(),
+                                      term_mapping=term_mapping,
+                                      operation=rule['operation']))
+                fields.append(FieldPlan(destination_field,tuple(rules)))
+            sources.append(SourcePlan(source_table,tuple(fields)))
+
+        return TablePlan(destination_table,primary_key,tuple(sources))
+
+    def compile_plan(self):
+        """
+        Compile the structural and term mapping into an execution plan for all the destination tables.
+        If a plan cache has been set, the plan is loaded from there if it was compiled from the same mapping,
+        otherwise it is compiled and saved there.
 
-                    
-                    #get all rules associated with the current field in the cdm 
-                    rules = df_mapping.loc[[destination_field]]
-                    #loop over all rules
-                    for irule in range(len(rules)):
-                        rule = rules.iloc[irule]
-                        source_field = rule['source_field'].lower()
-
-                        ret = None
-                        
-                        #perform a check to see if a source value is being mapped still
-                        if "_source_value" in destination_field\
-                           and not '_source_concept_id' in destination_field:
-
-                            if rule['term_mapping'] == 'y':
-                                self.logger.error('You have term mapping applied for'
-                                                  f' the field {destination_field}'
-                                                  ' are you sure!?'
-                                                  ' This should be a source value!')
-                                if self.override_source_term_mapping:
-                                    rule['term_mapping'] = 'n'
-                        
-                        #handle when no term mapping
-                        if rule['term_mapping'] == 'n':
-                            self.logger.debug("No mapping term defined for this rule")
-                            self.logger.debug(rule)
-                            #map one-to-one if there isn't a rule
-                            if rule['operation'] == 'n' or rule['operation'] == 'NONE' :
-                                self.logger.debug("No operation set. Mapping one-to-one")
-
-                                if self.use_auto_functions\
-                                   and destination_field in self.allowed_operations.auto_functions:
-                                    
-                                    self.logger.debug("But found an auto function to use!")
-                                    ret = self.map_auto_extract(df_table_data,
-                                                                source_field,
-                                                                destination_field)
-                                else:
-                                    ret = self.map_one_to_one(df_table_data,
-                                                              source_field,
-                                                              destination_field)
-                            #there is an operation defined,
-                            #so look it up in the list of allowed operations
-                            #and apply it
-                            else:
-                                operation = rule['operation']
-                            
-                                if operation not in self.allowed_operations.keys():
-                                    raise ValueError(f'Unknown Operation {operation}')
-                                self.logger.debug(f'Applying {operation}')
-                                self.logger.debug(self.allowed_operations[operation])
-                                self.logger.debug(df_table_data[source_field])
-                                ret = self.allowed_operations[operation](df_table_data,
-                                                                         column=source_field,
-                                                                         orig_column=source_field)
-
-                                ret = ret.to_frame(destination_field)
-                        #apply term mapping
-                        else:
-                            rule_id = rule['rule_id']
-                            self.logger.debug(f'Mapping term found. Applying..')
-                            self.logger.debug(f'{rule.to_dict()}')
-                            df_map = self.df_term_mapping.loc[[rule_id]]
-                            ret = self.map_via_rule(df_table_data,
-                                                    df_map,
-                                                    source_field,
-                                                    destination_field)
-
-                            operation = rule['operation']
-                            if operation in  self.allowed_operations and len(ret.dropna())>0:
-                                ret = self.allowed_operations[operation](ret,
-                                                                         column=destination_field,
-                                                                         orig_column=source_field)
-                                ret = ret.to_frame(destination_field)
+        Returns:
+           ExecutionPlan: the plan of how to make all the destination tables
+        """
+        key = make_key(self.df_structural_mapping,
+                       self.df_term_mapping,
+                       sorted(self.map_input_files.keys()),
+                       self.skip_fields,
+                       self.override_source_term_mapping,
+                       self.use_auto_functions)
+
+        if self.plan_cache is not None:
+            plan = ExecutionPlan.load(self.plan_cache,key)
+            if plan is not None:
+                self.logger.info(f'Loaded the execution plan from {self.plan_cache}')
+                return plan
+
+        tables = {
+            destination_table:self.compile_table(destination_table)
+            for destination_table in self.destination_tables
+        }
 
-                                
+        #look up the term mapping of each rule once
+        term_maps = {}
+        for table in tables.values():
+            for source in table.sources:
+                for field in source.fields:
+                    for rule in field.rules:
+                        if rule.term_mapping and rule.rule_id not in term_maps:
+                            term_maps[rule.rule_id] = self.df_term_mapping.loc[[rule.rule_id]]
+
+        plan = ExecutionPlan(tables,term_maps,key=key)
+        if self.plan_cache is not None:
+            plan.save(self.plan_cache)
+            self.logger.info(f'Saved the execution plan to {self.plan_cache}')
+        return plan
+
+    def make_rule_function(self,destination_field,rule):
+        """
+        Make the function that applies a rule to a chunk of the source table
 
-                        ret = ret.sort_index()
-                        ret['irule'] = irule
-                        
-                        self.logger.debug(ret)
+        Args:
+           destination_field (str): name of the field in the cdm
+           rule (Rule): the rule to apply
+        Returns:
+           function: takes the source dataframe, and returns a dataframe of the destination field
+        """
+        source_field = rule.source_field
+        operation = rule.operation
+        
+        #handle when no term mapping
+        if not rule.term_mapping:
+            #map one-to-one if there isn't a rule
+            if operation == 'n' or operation == 'NONE' :
+                if self.use_auto_functions\
+                   and destination_field in self.allowed_operations.auto_functions:
+                    return lambda df: self.map_auto_extract(df,
+                                                            source_field,
+                                                            destination_field)
+                return lambda df: self.map_one_to_one(df,
+                                                      source_field,
+                                                      destination_field)
+            #there is an operation defined,
+            #so look it up in the list of allowed operations
+            #and apply it
+            if operation not in self.allowed_operations.keys():
+                raise ValueError(f'Unknown Operation {operation}')
+            function = self.allowed_operations[operation]
+            return lambda df: function(df,
+                                       column=source_field,
+                                       orig_column=source_field).to_frame(destination_field)
+
+        #apply term mapping
+        def apply_term_mapping(df):
+            ret = self.map_via_rule(df,
+                                    self.plan.get_term_index(rule.rule_id),
+                                    source_field,
+                                    destination_field)
+            if operation in self.allowed_operations and len(ret.dropna())>0:
+                ret = self.allowed_operations[operation](ret,
+                                                         column=destination_field,
+                                                         orig_column=source_field)
+                ret = ret.to_frame(destination_field)
+            return ret
+        return apply_term_mapping
+
+    def build_executors(self):
+        """
+        Make the functions for all the rules in the plan, for each destination and source table
+        """
+        self.executors = {
+            table.destination_table: {
+                source.source_table: tuple(
+                    (field.destination_field,
+                     tuple(self.make_rule_function(field.destination_field,rule) for rule in field.rules))
+                    for field in source.fields
+                )
+                for source in table.sources
+            }
+            for table in self.plan
+        }
 
-                        
+    def map_chunk(self,destination_table,source_table,df_table_data,icounter=0):
+        """
+        Apply the rules of the plan to a chunk of a source table, to make a chunk of a destination table
+
+        Args:
+           destination_table (str): name of the cdm table
+           source_table (str): name of the source table the chunk is from
+           df_table_data (pandas.DataFrame): the chunk of the source table, with lower case column names
+           icounter (int): the number of the chunk
+        Returns:
+           pandas.DataFrame: the chunk of the destination table
+        """
+        primary_key = self.plan.tables[destination_table].primary_key
+        field_functions = self.executors[destination_table][source_table]
+
+        if primary_key is not None:
+            if primary_key in df_table_data.columns:
+                #clone the index to be this column
+                df_table_data.index = df_table_data[primary_key]
+                self.logger.info(f'Managed to set the index {primary_key} for {source_table}')
+            else:
+                self.logger.warning(f'Attempting to set {primary_key}, which is not in {df_table_data.columns}')
+                self.logger.warning(f'Currently working on {self.map_input_files[source_table]}')
+                self.logger.warning(f"No primary key defined for {destination_table} "
+                                    f"in {source_table}")
                     
-                        if irule < 1:
-                            columns_output[destination_field] = ret
-                        else:
-                            columns_output[destination_field] = pd.concat(
-                                [columns_output[destination_field],ret])
-                                                        
-                            
+        columns_output = {}
+        
+        #now start the real work of making new columns based on the mapping rules
+        for destination_field,functions in field_functions:
+            self.logger.info(f'Working on {destination_field}')
+
+            #loop over all rules
+            columns_output[destination_field] = []
+            for function in functions:
+                ret = function(df_table_data)
+                self.logger.debug(ret)
+                columns_output[destination_field].append(
+                    self.get_rule_values(ret,df_table_data.index))
+
+        #expand the fields with multiple rules into one row per rule
+        self.logger.info('Now setting up the inputs to merge')
+        df_destination = self.expand_rules(columns_output,df_table_data.index)
+        if primary_key in self.numeric_keys.get(source_table,()):
+            #the same order in every chunk, any keys that aren't numbers are put last
+            keys = pd.to_numeric(df_destination.index.to_series(),errors='coerce').values
+            df_destination = df_destination.iloc[np.argsort(keys,kind='stable')]
+        else:
+            df_destination = df_destination.sort_index(kind='stable')
 
-                #concat all columns we created
-                self.logger.info('Now setting up the inputs to merge')
+        self.logger.debug(df_destination)
 
+        self.logger.info(f'chunk[{icounter}] completed: Final dataframe with {len(df_destination)} rows and {len(df_destination.columns)} columns created')
+        return df_destination
 
-                shapes = list(set([x.shape[0] for x in columns_output.values()]))
-                min_shape = min(shapes)
+    def get_rule_values(self,ret,index):
+        """
+        Get the values a rule has made for the rows of a chunk
 
-                concat_list = [x for x in columns_output.values() if x.shape[0] == min_shape]
-                                
-                df_destination = pd.concat(concat_list,axis=1).drop('irule',axis=1)
+        Args:
+           ret (pandas.DataFrame): the output of the rule
+           index (pandas.Index): the index of the chunk of the source table
+        Returns:
+           pandas.Series: the values, with a default index
+           numpy.array: the position in the chunk of the row of each value,
+                        or None if the values are in the same order as the rows
+        """
+        series = ret.iloc[:,0]
+        if len(series) == len(index) and series.index.equals(index):
+            return series.reset_index(drop=True),None
+        #e.g. rows were dropped, or a term mapping has the same source term more than once
+        if index.is_unique:
+            positions = index.get_indexer(series.index)
+        else:
+            #rows with the same index are matched in turn
+            positions = pd.MultiIndex.from_arrays([index,self.count_occurrences(index)]).get_indexer(
+                pd.MultiIndex.from_arrays([series.index,self.count_occurrences(series.index)]))
+        found = positions >= 0
+        return series[found].reset_index(drop=True),positions[found]
+
+    @staticmethod
+    def count_occurrences(index):
+        """
+        Number each label of an index by how many times it has appeared before
+        """
+        return pd.Series(index).groupby(index.values,dropna=False).cumcount().values
 
-                join_list = [
-                    x.reset_index().set_index([x.index.name,'irule'])
-                    for x in columns_output.values()
-                    if x.shape[0] > min_shape
-                ]
+    def expand_rules(self,columns_output,index):
+        """
+        Make the destination fields of a chunk, from the values of each of their rules.
 
-                if len(join_list)>0:
-                    try:
-                        df = pd.concat(join_list,axis=1)
-                    except ValueError as err:
-                        self.logger.error(err)
-                        names = [x.columns[0] for x in join_list]
-                        self.logger.error(f'Bad Merge for {names}')
-                        self.logger.error('The most likely reason is that '
-                                          'you have missed or duplicated a structural mapping'
-                        )
-                        self.logger.error('One or more of the following have a different number of rules set')
-                        for x in join_list:
-                            name = x.columns[0]
-                            nunique = len(x.reset_index()['irule'].unique())
-                            self.logger.error(f'col "{name}" has {nunique} unique rules')
-                        raise BadJoin('Bad join of multiple mapping rules')
-                    
-                    
-                    df.index = df.index.droplevel(1)
-                    df = df.sort_index().dropna()
+        If any field has more than one rule, each row of the chunk is expanded into one row per rule
+        (e.g. one per question of a questionnaire), where the rules of each field are taken in turn
+        and the fields with one rule are repeated on every row.
+        If fields have different numbers of rules, the rows where any field with more rules
+        than the fewest is null are dropped (a row of the chunk that would be dropped completely
+        is kept once, with these fields null), and then any row without at least two values is dropped.
 
-                    df_destination = df_destination.join(df)
-                    df_destination = df_destination.dropna(thresh=2)
-                df_destination = df_destination.sort_index()
+        Args:
+           columns_output (dict): the values (and positions) of each rule, in order, for each destination field
+           index (pandas.Index): the index of the chunk of the source table
+        Returns:
+           pandas.DataFrame: the destination fields, indexed by the index of the chunk
+        """
+        nrows = len(index)
+        nrules = {field:len(values) for field,values in columns_output.items()}
+        max_rules = max(nrules.values())
+        min_rules = min(nrules.values())
+        #fields that are expanded by the rules with the most rules
+        expanded = [field for field,n in nrules.items() if n > min_rules]
+
+        aligned = all(
+            positions is None
+            for values in columns_output.values()
+            for _,positions in values
+        )
+        if aligned:
+            #the position in the chunk of each row, going through all rows of one rule at a time
+            positions = np.tile(np.arange(nrows),max_rules)
+            rules = np.repeat(np.arange(max_rules),nrows)
+            df = pd.DataFrame(index=pd.RangeIndex(nrows*max_rules))
+            for field,values in columns_output.items():
+                values = [series for series,_ in values]
+                if len(values) == 1:
+                    df[field] = values[0].take(positions).reset_index(drop=True)
+                else:
+                    missing = pd.Series(np.nan,index=pd.RangeIndex(nrows))
+                    values = values + [missing]*(max_rules - len(values))
+                    df[field] = pd.concat(values,ignore_index=True)
+        else:
+            df = self.join_rules(columns_output,max_rules)
+            positions = df.pop('_position').values
+            rules = df.pop('_rule').values
+            df.index = pd.RangeIndex(len(df))
+
+        if min_rules < max_rules:
+            #other fields with the fewest rules come first
+            df = df[[field for field in df.columns if field not in expanded] + expanded]
+
+            keep = df[expanded].notnull().all(axis=1).values
+            kept = np.zeros(nrows,dtype=bool)
+            kept[positions[keep]] = True
+            #rows of the chunk with none of their rules kept, are kept once
+            dropped = ~kept[positions] & ~pd.Series(positions).duplicated().values
+            if dropped.any():
+                df.loc[dropped,expanded] = np.nan
+            df = df[keep | dropped].dropna(thresh=2)
+
+        #order the rows by the row of the chunk they come from, then by the rule
+        order = np.lexsort((rules[df.index.values],positions[df.index.values]))
+        positions = positions[df.index.values][order]
+        df = df.iloc[order]
+        df.index = index.take(positions)
+        return df
 
-                self.logger.debug(df_destination)
+    def join_rules(self,columns_output,max_rules):
+        """
+        Join the values of the rules of each field on the row of the chunk and the rule they are for,
+        for when the values of some rules are not in the same order as the rows of the chunk
 
-                self.logger.info(f'chunk[{icounter}] completed: Final dataframe with {len(df_destination)} rows and {len(df_destination.columns)} columns created')
+        Returns:
+           pandas.DataFrame: the destination fields, with the _position in the chunk and the _rule of each row
+        """
+        def to_frame(field,values):
+            frames = []
+            for irule,(series,positions) in enumerate(values):
+                if positions is None:
+                    positions = np.arange(len(series))
+                frames.append(pd.DataFrame({
+                    '_position':positions,
+                    '_rule':irule,
+                    field:series.values
+                }))
+            return pd.concat(frames,ignore_index=True)
+
+        #fields with one rule are repeated for every rule
+        single = [field for field,values in columns_output.items() if len(values) == 1]
+        df_single = None
+        if max_rules > 1 and len(single) > 0:
+            for field in single:
+                df = to_frame(field,columns_output[field]).drop('_rule',axis=1)
+                df_single = df if df_single is None else df_single.merge(df,on='_position',how='outer')
+
+        df_rules = None
+        for field,values in columns_output.items():
+            if df_single is not None and field in single:
+                continue
+            df = to_frame(field,values)
+            df_rules = df if df_rules is None else df_rules.merge(df,on=['_position','_rule'],how='outer')
+
+        if df_rules is None:
+            return df_single.assign(_rule=0)
+        if df_single is None:
+            return df_rules
+
+        rules = pd.DataFrame({
+            '_position':np.repeat(df_single['_position'].unique(),max_rules),
+            '_rule':np.tile(np.arange(max_rules),df_single['_position'].nunique())
+        })
+        df_rules = rules.merge(df_rules,on=['_position','_rule'],how='outer')
+        df = df_single.merge(df_rules,on='_position',how='outer')
+        return df[['_position','_rule'] + [field for field in columns_output]]
+
+    def save_chunk(self,df_destination,destination_table,source_table,icounter=0):
+        """
+        Save a chunk of a destination table made from a source table
 
-                
-                #since we are looping over chunks
-                #- for the first chunk, save the headers and set the write mode to write
-                #- for the rest of the chunks, dont save the headers and set the write mode to append
-                mode = 'w'
-                header = True
-                if icounter > 0:
-                    mode = 'a'
-                    header = False
-                    
-                self.logger.debug(f'writing mode:"{mode}", save headers="{header}')
+        Returns:
+           str: the name of the file the chunk was saved to
+        """
+        #since we are looping over chunks
+        #- for the first chunk, save the headers and set the write mode to write
+        #- for the rest of the chunks, dont save the headers and set the write mode to append
+        mode = 'w'
+        header = True
+        if icounter > 0:
+            mode = 'a'
+            header = False
             
-                
-                #save the data into new csvs
-                outname = f'{self.output_data_folder}/cdm_split/{destination_table}/'
+        self.logger.debug(f'writing mode:"{mode}", save headers="{header}')
+    
+        
+        #save the data into new csvs
+        outname = f'{self.output_data_folder}/cdm_split/{destination_table}/'
+
+        if not os.path.exists(outname):
+            self.logger.info(f'Creating a new folder: {outname}')
+            os.makedirs(outname)
 
-                if not os.path.exists(outname):
-                    self.logger.info(f'Creating a new folder: {outname}')
-                    os.makedirs(outname)
+        #clean up the name to save as a csv file
+        outname = f'{outname}/{source_table}'
+        if outname[-4:]!='.csv':
+            outname += '.csv'
+        df_destination.to_csv(outname,index=False,\
+                              mode=mode,header=header)
 
-                #clean up the name to save as a csv file
-                outname = f'{outname}/{source_table}'
-                if outname[-4:]!='.csv':
-                    outname += '.csv'
-                df_destination.to_csv(outname,index=False,\
-                                      mode=mode,header=header)
+        self.logger.info(f'Saved final csv with data mapped to CDM5.3.1 here: {outname}')
+        return outname
 
-                self.logger.info(f'Saved final csv with data mapped to CDM5.3.1 here: {outname}')
+    def stage_chunk(self,df_destination,staged):
+        """
+        Stage a chunk of a destination table in a feather file until it is merged
+        """
+        try:
+            staged.append(df_destination)
+        except (TypeError,ValueError) as err:
+            #columns of mixed types cannot be saved as a column of one type
+            #which would have been read back from the split csv files as strings
+            self.logger.warning(f'Staging {staged.name} as strings: {err}')
+            columns = df_destination.select_dtypes('object').columns
+            df_destination = df_destination.astype({
+                col:str for col in columns
+            }).where(df_destination.notnull(),None)
+            staged.append(df_destination)
+
+    def get_staging_folder(self,destination_table,source_table):
+        """
+        Get the folder the outputs of a source table for a destination table are staged in
+        """
+        return f'{self.output_data_folder}/staging/{destination_table}/{source_table}'
+
+    def save_chunks(self,dfs,destination_tables,source_table,icounter,output_files,nrows=0):
+        """
+        Save the chunk of each destination table made from a chunk of a source table (of nrows rows),
+        record the files created in output_files, and record the chunk as complete in the manifest
+        """
+        staged = {}
+        split = {}
+        for destination_table,df_destination in zip(destination_tables,dfs):
+            outname = None
+            if self.save_split_files or not self.stage_split_files:
+                outname = self.save_chunk(df_destination,destination_table,source_table,icounter)
+                split[destination_table] = outname
+
+            if self.stage_split_files:
+                if destination_table not in output_files:
+                    output_files[destination_table] = SpilledTable(
+                        f'{destination_table}_{source_table}',
+                        folder=self.get_staging_folder(destination_table,source_table))
+                    #remove anything left from a run that didnt complete its first chunk
+                    output_files[destination_table].restore(0,0)
+                self.stage_chunk(df_destination,output_files[destination_table])
+                staged[destination_table] = {
+                    'nfiles':len(output_files[destination_table].files),
+                    'nrows':len(output_files[destination_table])
+                }
+            #only need to do this one, since for icounter>0 the file is in append mode
+            #rather than in write mode
+            elif destination_table not in output_files:
+                output_files[destination_table] = outname
+
+        if self.manifest is not None:
+            self.manifest.commit_source_chunk(source_table,icounter+1,staged,split,nrows)
+
+    def restore_outputs(self,source_table,record):
+        """
+        Restore the outputs of a source table that were completed by the run that is being resumed
+
+        Args:
+           source_table (str): name of the source table
+           record (dict): what the manifest recorded for the source table
+        Returns:
+           dict: the output for each destination table
+        """
+        output_files = dict(record['split'])
+        for destination_table,staged in record['staged'].items():
+            output = SpilledTable(f'{destination_table}_{source_table}',
+                                  folder=self.get_staging_folder(destination_table,source_table))
+            output.restore(staged['nfiles'],staged['nrows'])
+            output_files[destination_table] = output
+        return output_files
 
-                #only need to do this one, since for icounter>0 the file is in append mode
-                #rather than in write mode
-                if icounter == 0 :
-                    output_files.append(outname)
+    def process_source_table(self,source_table,destination_tables,pool=None):
+        """
+        Process a source table (an input file), reading it once
+        and passing each chunk to all of the destination tables that need it
 
+        Args:
+           source_table (str): name of the source table
+           destination_tables (list): names of the cdm tables made from the source table
+           pool (ProcessPoolExecutor): pool of workers to map the chunks with,
+                                       the chunks are still saved here in the order they were read
+        Returns:
+           dict: the file created for each destination table, if the source table had any data
+        """
+        self.logger.info(f'Now reading the source table "{source_table}" for {destination_tables}')
+
+        output_files = {}
+        start = 0
+        if self.manifest is not None:
+            record = self.manifest.get_source(source_table)
+            output_files = self.restore_outputs(source_table,record)
+            if record['complete']:
+                self.logger.info(f'Already completed the source table "{source_table}", skipping it')
+                return output_files
+            start = record['nchunks']
+            if start > 0:
+                self.logger.info(f'Resuming the source table "{source_table}" from chunk {start}')
+            
+        #chunks sent to the workers, waiting to be saved in order
+        pending = collections.deque()
+
+        #when reading ahead, also save the chunks in the background
+        #the writer saves them one at a time, in the order they are submitted
+        writer = _noop()
+        save_chunks = self.save_chunks
+        if self.read_ahead > 0:
+            writer = BackgroundWriter(self.read_ahead)
+            save_chunks = lambda *args: writer.submit(self.save_chunks,*args)
+        
+        #load the data we need
+        #load in chunks to conserve memory when we have huge inputs
+        columns,dtype = None,None
+        if self.typed_reads:
+            columns,dtype = self.get_source_table_dtypes(source_table)
+        chunks_table_data = self.load_df_chunks(self.map_input_files[source_table],
+                                                self.chunk_size,
+                                                columns=columns,
+                                                dtype=dtype,
+                                                skip_chunks=start,
+                                                skip_rows=self.start_rows.get(source_table,0))
+        with writer:
+            try:
+                #start looping over the chunks of data
+                #the default will be to have ~100k rows per chunk
+                for icounter,df_table_data in enumerate(chunks_table_data,start):
+                    if self.max_chunks > 0 :
+                        if icounter >= self.max_chunks :
+                            self.logger.info('youve had enough')
+                            break
+                
+                    #use lower case to be safe because of WhiteRabbit Issues...
+                    df_table_data.columns = df_table_data.columns.str.lower()
+                    nrows = len(df_table_data)
+                    self.logger.info(f'Processing {icounter} with length {nrows}')
+
+                    if pool is None:
+                        dfs = [
+                            self.map_chunk(destination_table,source_table,df_table_data,icounter)
+                            for destination_table in destination_tables
+                        ]
+                        save_chunks(dfs,destination_tables,source_table,icounter,output_files,nrows)
+                        continue
+
+                    pending.append((icounter,nrows,pool.submit(_map_chunk,source_table,destination_tables,
+                                                               df_table_data,icounter)))
+                    #limit how many chunks are held in memory, by saving the oldest
+                    #once every worker has a chunk queued up behind the one it is mapping
+                    while len(pending) > 2*self.workers:
+                        i,n,future = pending.popleft()
+                        save_chunks(future.result(),destination_tables,source_table,i,output_files,n)
+
+                while pending:
+                    i,n,future = pending.popleft()
+                    save_chunks(future.result(),destination_tables,source_table,i,output_files,n)
+            finally:
+                if isinstance(chunks_table_data,ReadAhead):
+                    chunks_table_data.close()
+
+        if self.manifest is not None:
+            self.manifest.commit_source(source_table)
         return output_files
 
+    def process_destination_table(self,destination_table):
+        """
+        Process a destination table (an output table in the cdm)
+        """
+        self.logger.info(f'Now running on Table "{destination_table}"')
 
-    def merge_destination_table(self,destination_table,outputs):
+        #create a list that will help track the output files we create
+        output_files = []
+        for source in self.plan.tables[destination_table].sources:
+            outputs = self.process_source_table(source.source_table,[destination_table])
+            if destination_table in outputs:
+                output_files.append(outputs[destination_table])
+        return output_files
+
+
+    def load_staged_chunks(self,output):
+        """
+        Load the output of a source table back in chunks of chunk_size rows, to be merged
+
+        Args:
+           output (str or SpilledTable): the split csv file or the staged feather files
+        Returns:
+           iterator: of pandas.DataFrame chunks, indexed by the row number in the whole output
+        """
+        if not isinstance(output,SpilledTable):
+            return iter(self.load_df_chunks(output))
+        return self.rechunk(output,self.chunk_size)
+
+    def rechunk(self,staged,chunk_size):
+        """
+        Load a staged output in chunks of chunk_size rows,
+        rather than in the chunks that it was staged in
+        """
+        buffer = []
+        nrows = 0
+        offset = 0
+        for df in staged:
+            buffer.append(df)
+            nrows += len(df)
+            while nrows >= chunk_size:
+                df = pd.concat(buffer,ignore_index=True)
+                chunk = df.iloc[:chunk_size]
+                chunk.index = pd.RangeIndex(offset,offset+chunk_size)
+                offset += chunk_size
+                yield chunk
+                buffer = [df.iloc[chunk_size:]]
+                nrows -= chunk_size
+        if nrows > 0:
+            chunk = pd.concat(buffer,ignore_index=True)
+            chunk.index = pd.RangeIndex(offset,offset+nrows)
+            yield chunk
+
+    def merge_destination_table(self,destination_table,outputs,append=False):
         self.logger.info(f'Merging {destination_table}')
+
+        start = 0
+        #rows merged so far, before any are dropped
+        nmerged = 0
+        if self.manifest is not None:
+            record = self.manifest.get_merged(destination_table)
+            if record['complete']:
+                self.logger.info(f'Already merged {destination_table}, skipping it')
+                if self.map_output_data is None:
+                    self.map_output_data = {}
+                self.map_output_data[destination_table] = f'{self.output_data_folder}/cdm_merged/{destination_table}.csv'
+                return
+            start = record['nchunks']
+            nmerged = record['nrows']
+            if start > 0:
+                self.logger.info(f'Resuming the merge of {destination_table} from chunk {start}')
         
         #retrieve the fields that should be associated with this CDM
         cdm_fields = self.df_cdm.loc[destination_table]['field'].tolist()
@@ -973,7 +1644,7 @@ class ETLTool:
         #load all the output files, in chunk format, to not overload memory
         #by loading all up at the same time
         chunks_output_file_map = {
-            output_file: self.load_df_chunks(output_file)
+            output_file: self.load_staged_chunks(output_file)
             for output_file in outputs
         }
         
@@ -985,7 +1656,7 @@ class ETLTool:
             total = []
             for output_file,chunks in chunks_output_file_map.items():
                 try:
-                    df_chunk = chunks.get_chunk()
+                    df_chunk = next(chunks)
                     df_chunk.columns = df_chunk.columns.str.replace("(\.\d+)$", "")
                     total.append(df_chunk)
                 except StopIteration:
@@ -997,9 +1668,15 @@ class ETLTool:
             if complete:
                 break
 
+            if icounter < start:
+                #already merged by the run that is being resumed
+                icounter += 1
+                continue
+
             
             #make a total dataframe
             df_output = pd.concat(total,axis=1)
+            nrows = len(df_output)
 
             
             #get all unique columns
@@ -1016,9 +1693,10 @@ class ETLTool:
             #define how to save the output file again
             #- on the first loop (of chunks): write the headers and use write mode (recreate the file)
             #- on other loops: dont write the headers but write in append mode 
+            #- when appending to the output of the last run, always use append mode
             mode = 'w'
             header = True
-            if icounter > 0:
+            if icounter > 0 or append:
                 mode = 'a'
                 header = False
                 
@@ -1060,14 +1738,11 @@ class ETLTool:
                and 'person_id' in df_output \
                and not df_output['person_id'].isnull().all():
 
-                #raise NotImplementedError('need to fix masking of person_id still!')
-                masker = {
-                    x:i
-                    for i,x in enumerate(sorted(df_output['person_id'].unique()))
-                }
-                self.save_lookup_table(masker,destination_table,'person_id')
-
-                df_output['person_id'] = df_output['person_id'].replace(masker)
+                #new person_ids are given the next masked id, and appended to the lookup file
+                #so the same person has the same masked id in every chunk and table
+                df_output['person_id'] = self.person_id_masker.mask(df_output['person_id'],
+                                                                    extend=True)
+                self.person_id_masker.save()
 
            
             cdm = self.df_cdm.loc[destination_table][['field','required','type']]
@@ -1089,7 +1764,10 @@ class ETLTool:
                         if self.patch_missing_ids:
                             if i == 0:
                                 #if it's a primary key, increment index
-                                df_output[field] = df_output[field].reset_index().index
+                                #carrying on from the ids of the previous chunks (and run, when appending)
+                                #so ids are not repeated in the output
+                                first_id = self.id_offsets.get(destination_table,0) + nmerged
+                                df_output[field] = np.arange(first_id,first_id+nrows)
                             #else:
                             #    #if else, fill 0 
                             #    df_output[field] = 0
@@ -1139,6 +1817,7 @@ class ETLTool:
             if self.map_output_data is None:
                 self.map_output_data = {}
             self.map_output_data[destination_table] = outname
+            appended = [outname]
         
             
             #record duplicates
@@ -1147,12 +1826,235 @@ class ETLTool:
                 df_duplicates = pd.concat(output_duplicates,axis=1)
                 outname = f'{outfolder}/{destination_table}.duplicates.csv'
                 df_duplicates.to_csv(outname,index=False,mode=mode,header=header)
+                appended.append(outname)
+
+            if self.manifest is not None:
+                if self.person_id_masker is not None:
+                    appended.append(self.person_id_masker.fname)
+                self.manifest.commit_merged_chunk(destination_table,icounter+1,appended,nrows)
                                         
             self.logger.debug('Merge of all source tables associated with cdm object complete')
             icounter +=1
+            nmerged += nrows
+
+        #stop reading ahead any outputs that were longer than the others
+        for chunks in chunks_output_file_map.values():
+            if isinstance(chunks,ReadAhead):
+                chunks.close()
+
+        if self.manifest is not None:
+            self.manifest.commit_merged(destination_table)
 
             
     
+    @contextlib.contextmanager
+    def get_pool(self):
+        """
+        Create a pool of processes to map the chunks with, if running with more than one worker
+
+        Yields:
+           ProcessPoolExecutor: the pool, or None when running serially
+        """
+        global _worker_tool
+
+        workers = self.workers
+        if workers is not None and workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            self.logger.warning("running with multiple workers needs the 'fork' start method,"
+                                " which isn't available here, so running serially instead")
+            workers = 1
+            
+        if workers is None or workers <= 1:
+            yield None
+            return
+
+        self.logger.info(f'mapping chunks with {workers} workers')
+        _worker_tool = self
+        #fork so the workers inherit the compiled plan and the functions for each rule
+        context = multiprocessing.get_context('fork')
+        try:
+            with ProcessPoolExecutor(max_workers=workers,mp_context=context) as pool:
+                yield pool
+        finally:
+            _worker_tool = None
+
+    def get_input_fingerprints(self):
+        """
+        Returns:
+           list: the name, size and modification time of each input file
+        """
+        return [
+            (name,os.path.getsize(fname),os.path.getmtime(fname))
+            for name,fname in sorted(self.map_input_files.items())
+        ]
+
+    def get_table_modes(self,previous):
+        """
+        Find what needs to be done for each destination table, from how its source tables
+        have changed since they were recorded in the state of the last run
+        - skip: none of its source tables have changed, so its output is kept
+        - append: its only source table has had rows appended, so only they are mapped and appended to its output
+        - replace: otherwise, the whole table is made again
+        A source table is read from the start if any of the tables made from it are replaced,
+        in which case all of them are.
+
+        Args:
+           previous (InputState): the state of the last run, or None to replace everything
+        Returns:
+           dict: the mode of each destination table
+        """
+        source_tables = self.plan.get_source_tables()
+        self.start_rows = {source_table:0 for source_table in source_tables}
+        self.id_offsets = {}
+        modes = {table.destination_table:'replace' for table in self.plan}
+        if previous is None:
+            return modes
+
+        for table in self.plan:
+            destination_table = table.destination_table
+            statuses = [self.changes[source.source_table].status for source in table.sources]
+            if destination_table not in previous.outputs:
+                continue
+            if all(status == 'unchanged' for status in statuses):
+                modes[destination_table] = 'skip'
+            elif statuses == ['appended']:
+                modes[destination_table] = 'append'
+
+        for source_table,destination_tables in source_tables.items():
+            if any(modes[destination_table] == 'replace' for destination_table in destination_tables):
+                for destination_table in destination_tables:
+                    if modes[destination_table] == 'append':
+                        modes[destination_table] = 'replace'
+            elif self.changes[source_table].status == 'appended':
+                self.start_rows[source_table] = self.changes[source_table].nrows
+
+        for destination_table,mode in modes.items():
+            if mode == 'append':
+                self.id_offsets[destination_table] = previous.outputs[destination_table]
+        return modes
+
+    def plan_increment(self):
+        """
+        When running incrementally, fingerprint the inputs and compare them with the state of the last run
+        to find what needs to be done for each destination table
+
+        Returns:
+           dict: the mode of each destination table
+        """
+        self.input_state = None
+        if not self.incremental:
+            return self.get_table_modes(None)
+        if self.max_chunks > 0:
+            self.logger.warning('Cannot run incrementally when only processing some of the chunks (max_chunks),'
+                                ' so everything will be processed')
+            return self.get_table_modes(None)
+
+        fname = f'{self.output_data_folder}/input_state.json'
+        key = make_key(self.plan.key,
+                       self.chunk_size,
+                       self.typed_reads,
+                       self.perform_person_id_mask)
+        previous = InputState.load(fname,key)
+        self.input_state = InputState(fname,key)
+        if previous is None:
+            self.logger.info(f'There is no record ({fname}) of a previous run with the same mapping'
+                             ' and settings, so everything will be processed')
+            previous = self.input_state
+        
+        self.changes = previous.get_changes({
+            source_table:self.map_input_files[source_table]
+            for source_table in self.plan.get_source_tables()
+        })
+        for source_table,change in self.changes.items():
+            self.logger.info(f'Source table "{source_table}" is {change.status}')
+
+        self.table_modes = self.get_table_modes(previous)
+        #a run that didnt complete may have left some outputs part of the way through being made
+        #so unless it is being resumed, they all need to be made again
+        last_run = RunManifest.load(f'{self.output_data_folder}/run_manifest.json')
+        if last_run is not None and not last_run.complete \
+           and (not self.resume or last_run.key != self.get_manifest_key()):
+            self.logger.warning('The last run did not complete, so everything will be processed')
+            self.table_modes = self.get_table_modes(None)
+        else:
+            #the outputs of tables that are skipped are kept
+            self.input_state.outputs = dict(previous.outputs)
+
+        self.logger.info(f'Destination tables will be: {self.table_modes}')
+        return self.table_modes
+
+    def save_input_state(self):
+        """
+        Record the inputs that have been processed by the run, and the rows saved to each output,
+        so that the next run only has to process what has changed
+        """
+        for source_table,change in self.changes.items():
+            nrows = change.nrows
+            if source_table in self.manifest.sources:
+                nrows = self.start_rows[source_table] + self.manifest.sources[source_table]['nrows']
+            self.input_state.update_input(source_table,change,nrows)
+
+        for destination_table,mode in self.table_modes.items():
+            if mode != 'skip':
+                self.input_state.outputs[destination_table] = self.id_offsets.get(destination_table,0) \
+                    + self.manifest.get_merged(destination_table)['nrows']
+        self.input_state.save()
+
+    def get_manifest_key(self):
+        """
+        Returns:
+           str: hash of the mapping, inputs and settings of the run, which a run can only be resumed with
+        """
+        return make_key(self.plan.key,
+                       self.get_input_fingerprints(),
+                       self.chunk_size,
+                       self.max_chunks,
+                       self.typed_reads,
+                       self.stage_split_files,
+                       self.save_split_files,
+                       self.perform_person_id_mask,
+                       self.table_modes,
+                       self.start_rows)
+
+    def start_manifest(self):
+        """
+        Start recording the chunks that are completed by the run in a manifest,
+        or, when resuming, load the manifest of the last run and truncate its incomplete outputs
+
+        Returns:
+           RunManifest: the manifest of the run
+        """
+        fname = f'{self.output_data_folder}/run_manifest.json'
+        key = self.get_manifest_key()
+        
+        if self.resume:
+            manifest = RunManifest.load(fname,key)
+            if manifest is not None:
+                self.logger.info(f'Resuming the run recorded in {fname}')
+                manifest.truncate()
+                return manifest
+            self.logger.warning(f'Cannot resume the run, as there is no manifest ({fname}) for a run'
+                                ' with the same mapping, inputs and settings. Starting from the beginning.')
+
+        #remove the outputs staged by any previous run
+        shutil.rmtree(f'{self.output_data_folder}/staging',ignore_errors=True)
+        manifest = RunManifest(fname,key)
+        if self.perform_person_id_mask:
+            #the lookup of person_ids is kept from previous runs when running incrementally,
+            #otherwise it is started again
+            fname_lookup = f'{self.output_data_folder}/masks/person_id_lookup.csv'
+            if not self.incremental and os.path.exists(fname_lookup):
+                os.remove(fname_lookup)
+            manifest.record_offsets([fname_lookup])
+        #as are the outputs that are appended to
+        manifest.record_offsets([
+            f'{self.output_data_folder}/cdm_merged/{destination_table}{suffix}.csv'
+            for destination_table,mode in self.table_modes.items()
+            if mode == 'append'
+            for suffix in ['','.duplicates']
+        ])
+        manifest.save()
+        return manifest
+
     def run(self):
         """
         Start the program running by looping over the CDM destination tables defined by the user
@@ -1164,21 +2066,96 @@ class ETLTool:
             self.initialise()
         
         self.logger.info('Starting ETL to CDM')
+        #the formats of the date columns are inferred again for these inputs
+        dates.parser.clear()
 
+        if self.stage_split_files is None:
+            try:
+                import pyarrow
+                self.stage_split_files = True
+            except ImportError:
+                self.logger.info('pyarrow is not installed, so the outputs of each source table'
+                                 ' will be staged in cdm_split csv files before they are merged')
+                self.stage_split_files = False
+
+        self.table_modes = self.plan_increment()
+        if self.input_state is None:
+            #the outputs will all be replaced, so wont match any state recorded by an incremental run
+            fname = f'{self.output_data_folder}/input_state.json'
+            if os.path.exists(fname):
+                os.remove(fname)
+
+        self.manifest = self.start_manifest()
+        if self.manifest.complete:
+            self.logger.info('The run has already completed, there is nothing to resume')
+            self.manifest = None
+            return
+
+        #loop over all source tables, reading each one once
+        #and making all the CDM tables (e.g. person etc.) that need it
+        source_output_files = {}
+        #decided before the workers are started, so they have it
+        self.numeric_keys = self.get_numeric_keys()
+        with self.get_pool() as pool:
+            for source_table,destination_tables in self.plan.get_source_tables().items():
+                #the outputs of tables whose sources havent changed since the last run are kept
+                destination_tables = [
+                    destination_table
+                    for destination_table in destination_tables
+                    if self.table_modes[destination_table] != 'skip'
+                ]
+                if len(destination_tables) == 0:
+                    self.logger.info(f'Source table "{source_table}" has not changed, skipping it')
+                    source_output_files[source_table] = {}
+                    continue
+                source_output_files[source_table] = self.process_source_table(source_table,
+                                                                              destination_tables,
+                                                                              pool)
+
+        #collect the files created for each CDM table, in the order of its source tables
         map_output_files = {}
-        #loop over all CDM tables (e.g. person etc.)
-        for destination_table in self.destination_tables:
-            #process the table
-            output_files = self.process_destination_table(destination_table)
-            map_output_files[destination_table] =  output_files
+        for table in self.plan:
+            map_output_files[table.destination_table] = [
+                source_output_files[source.source_table][table.destination_table]
+                for source in table.sources
+                if table.destination_table in source_output_files[source.source_table]
+            ]
+
+        #the lookup of person_ids is only loaded from the previous run when its outputs are kept
+        #(i.e. when running incrementally or resuming) so the masked ids are the same in the appended rows,
+        #otherwise the lookup starts empty and replaces the one saved by the previous run
+        if self.perform_person_id_mask and self.person_id_masker is None:
+            self.person_id_masker = PersonIdMasker(f'{self.output_data_folder}/masks/person_id_lookup.csv',
+                                                   load=self.incremental or self.resume)
 
         #merge output tables
         #for each CDM destination table
-        #- get all new csv files we created
+        #- get all new outputs we created
         #- we'll have one per source table
         #- merge them together
         for destination_table,outputs in map_output_files.items():
-            self.merge_destination_table(destination_table,outputs)
+            mode = self.table_modes[destination_table]
+            if mode == 'skip' or (mode == 'append' and len(outputs) == 0):
+                self.logger.info(f'Keeping the output of {destination_table} from the last run')
+                if self.map_output_data is None:
+                    self.map_output_data = {}
+                self.map_output_data[destination_table] = f'{self.output_data_folder}/cdm_merged/{destination_table}.csv'
+                continue
+            self.merge_destination_table(destination_table,outputs,append=(mode == 'append'))
+
+        #the staged outputs are kept until the run completes, so that a failed run can be resumed
+        for outputs in map_output_files.values():
+            for output in outputs:
+                if isinstance(output,SpilledTable):
+                    output.cleanup()
+        shutil.rmtree(f'{self.output_data_folder}/staging',ignore_errors=True)
+
+        if self.input_state is not None:
+            self.save_input_state()
+        
+        self.manifest.complete = True
+        self.manifest.save()
+        self.manifest = None
 
 
 
@@ -0,0 +1,158 @@
+import os
+import json
+
+
+class RunManifest:
+    """
+    Record of the work a run of the ETLTool has completed, saved after every chunk
+    so that a run that fails part of the way through can be resumed.
+
+    For each source table it records how many chunks (and rows) have been mapped, and the outputs for each
+    destination table (the number of staged files and rows, or the split csv file).
+    For each destination table it records how many chunks (and rows) have been merged.
+    The size of every file that is appended to is recorded with each chunk, so anything written
+    after the last chunk that was completed can be truncated when the run is resumed.
+    """
+    def __init__(self,fname,key=None):
+        """
+        Args:
+           fname (str): .json file to save the manifest to
+           key (str): hash of the mapping, inputs and settings of the run,
+                      a run can only be resumed with the same key
+        """
+        self.fname = fname
+        self.key = key
+        self.sources = {}
+        self.merged = {}
+        self.offsets = {}
+        self.complete = False
+
+    @classmethod
+    def load(cls,fname,key=None):
+        """
+        Load the manifest of a previous run
+
+        Returns:
+           RunManifest: the manifest, or None if there isn't one with the same key
+        """
+        if not os.path.exists(fname):
+            return None
+        with open(fname) as f:
+            data = json.load(f)
+        if key is not None and data.get('key') != key:
+            return None
+        manifest = cls(fname,data['key'])
+        manifest.sources = data['sources']
+        manifest.merged = data['merged']
+        manifest.offsets = data['offsets']
+        manifest.complete = data['complete']
+        return manifest
+
+    def save(self):
+        """
+        Save the manifest, replacing the previous one in one step,
+        so there is always a complete manifest if the run is killed
+        """
+        folder = os.path.dirname(self.fname)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        data = {
+            'key':self.key,
+            'sources':self.sources,
+            'merged':self.merged,
+            'offsets':self.offsets,
+            'complete':self.complete
+        }
+        tmp = f'{self.fname}.tmp'
+        with open(tmp,'w') as f:
+            json.dump(data,f,indent=6)
+        os.replace(tmp,self.fname)
+
+    def record_offsets(self,fnames):
+        """
+        Record the current size of files that are being appended to
+        """
+        for fname in fnames:
+            self.offsets[fname] = os.path.getsize(fname) if os.path.exists(fname) else 0
+
+    def truncate(self):
+        """
+        Truncate all files that have been appended to, to their size when the last chunk was completed
+        """
+        for fname,offset in self.offsets.items():
+            if not os.path.exists(fname):
+                continue
+            if offset == 0:
+                os.remove(fname)
+            elif os.path.getsize(fname) > offset:
+                with open(fname,'r+b') as f:
+                    f.truncate(offset)
+
+    def get_source(self,source_table):
+        """
+        Returns:
+           dict: what has been completed for a source table
+        """
+        return self.sources.setdefault(source_table,{
+            'nchunks':0,
+            'nrows':0,
+            'complete':False,
+            'staged':{},
+            'split':{}
+        })
+
+    def commit_source_chunk(self,source_table,nchunks,staged,split,nrows=0):
+        """
+        Record that a chunk of a source table has been mapped and saved
+
+        Args:
+           source_table (str): name of the source table
+           nchunks (int): the number of chunks completed
+           staged (dict): the number of files and rows staged for each destination table
+           split (dict): the split csv file for each destination table
+           nrows (int): the number of rows of the source table in the chunk
+        """
+        source = self.get_source(source_table)
+        source['nchunks'] = nchunks
+        source['nrows'] += nrows
+        source['staged'].update(staged)
+        source['split'].update(split)
+        self.record_offsets(split.values())
+        self.save()
+
+    def commit_source(self,source_table):
+        """
+        Record that all chunks of a source table have been mapped
+        """
+        self.get_source(source_table)['complete'] = True
+        self.save()
+
+    def get_merged(self,destination_table):
+        """
+        Returns:
+           dict: what has been merged for a destination table
+        """
+        return self.merged.setdefault(destination_table,{'nchunks':0,'nrows':0,'complete':False})
+
+    def commit_merged_chunk(self,destination_table,nchunks,fnames,nrows=0):
+        """
+        Record that a chunk of a destination table has been merged and saved
+
+        Args:
+           destination_table (str): name of the cdm table
+           nchunks (int): the number of chunks completed
+           fnames (list): the files that were appended to
+           nrows (int): the number of rows in the chunk, before any were dropped
+        """
+        merged = self.get_merged(destination_table)
+        merged['nchunks'] = nchunks
+        merged['nrows'] += nrows
+        self.record_offsets(fnames)
+        self.save()
+
+    def commit_merged(self,destination_table):
+        """
+        Record that a destination table has been completely merged
+        """
+        self.get_merged(destination_table)['complete'] = True
+        self.save()
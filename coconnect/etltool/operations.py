@@ -1,6 +1,6 @@
 import pandas as pd
-import datetime
 from collections import OrderedDict
+from coconnect.tools import dates
 
 class ETLOperations(OrderedDict):
     """ETLOperations"""
@@ -18,7 +18,7 @@ class ETLOperations(OrderedDict):
         if 'column' not in kwargs:
             raise ValueError(f'column not found in kwargs: {kwargs}')
         series = df[kwargs['column']]
-        return pd.to_datetime(series).dt.year#.fillna(0).astype(int)
+        return dates.parse(series).dt.year#.fillna(0).astype(int)
 
         
     def get_month_from_date(self,df,**kwargs):
@@ -35,7 +35,7 @@ class ETLOperations(OrderedDict):
         if 'column' not in kwargs:
             raise ValueError(f'column not found in kwargs: {kwargs}')
         series = df[kwargs['column']]
-        return pd.to_datetime(series).dt.month#.fillna(0).astype(int)
+        return dates.parse(series).dt.month#.fillna(0).astype(int)
     
     def get_day_from_date(self,df,**kwargs):
         """
@@ -51,25 +51,21 @@ class ETLOperations(OrderedDict):
         if 'column' not in kwargs:
             raise ValueError(f'column not found in kwargs: {kwargs}')
         series = df[kwargs['column']]
-        return pd.to_datetime(series).dt.day#.fillna(0).astype(int)
+        return dates.parse(series).dt.day#.fillna(0).astype(int)
 
     def age_to_datetime(self,df,**kwargs):
         if 'column' not in kwargs:
             raise ValueError(f'column not found in kwargs: {kwargs}')
         series = df[kwargs['column']]
 
-        #set normalisation to middle of 2020
-        norm = datetime.datetime(2020, 7, 1)
-
-        series = series.fillna(0).apply(lambda x: norm - datetime.timedelta(days=365*x))
-
-        return series
+        #normalised to the middle of 2020
+        return dates.get_datetime_from_age(series)
     
     def to_datetime(self,df,**kwargs):
         if 'column' not in kwargs:
             raise ValueError(f'column not found in kwargs: {kwargs}')
         series = df[kwargs['column']]
-        series = pd.to_datetime(series)
+        series = dates.parse(series)
         return series
 
     def get_field_name(self,df,**kwargs):
@@ -0,0 +1,210 @@
+import os
+import pickle
+import hashlib
+import collections
+from types import MappingProxyType
+import numpy as np
+import pandas as pd
+
+
+#a structural mapping rule, for one source field going to a destination field
+Rule = collections.namedtuple('Rule',['rule_id','source_field','term_mapping','operation'])
+
+#all the rules for one destination field, from one source table
+FieldPlan = collections.namedtuple('FieldPlan',['destination_field','rules'])
+
+#the destination fields to make from one source table
+SourcePlan = collections.namedtuple('SourcePlan',['source_table','fields'])
+
+#everything needed to make one destination (cdm) table
+TablePlan = collections.namedtuple('TablePlan',['destination_table','primary_key','sources'])
+
+
+class TermIndex:
+    """
+    Hash index of the term mapping of one rule, for looking up the destination term of each source term.
+
+    The index of the source terms is built once for each dtype of source field it is used with,
+    and the position of every value looked up so far is kept,
+    so each chunk of data only needs to look up values it has not seen before.
+    """
+    #stop remembering values looked up once there are this many, e.g. for high cardinality ids
+    max_cached = 10**6
+    
+    def __init__(self,df_map):
+        """
+        Args:
+           df_map (pandas.DataFrame): the term mapping of the rule, with columns source_term and destination_term
+        """
+        self.df_map = df_map
+        self.source_terms = df_map['source_term']
+        self.destination_terms = df_map['destination_term'].values
+        self.is_truncation = any(self.source_terms.str.contains('List truncated'))
+        #values can only be looked up directly when each source term maps to one destination term
+        self.is_unique = self.source_terms.is_unique and not self.source_terms.isnull().any()
+        self._indexes = {}
+        self._cache = {}
+
+    def get_index(self,dtype):
+        """
+        Get the index of the source terms, converted to the dtype of the source field they are compared with
+
+        Raises:
+           ValueError: if the source terms cannot be converted to this dtype
+        """
+        key = str(dtype)
+        if key not in self._indexes:
+            source_terms = self.source_terms
+            if dtype != source_terms.dtype:
+                source_terms = source_terms.astype(dtype)
+            self._indexes[key] = pd.Index(source_terms)
+        return self._indexes[key]
+
+    def get_df_map(self,dtype):
+        """
+        Get the term mapping with the source terms converted to a dtype
+        """
+        df_map = self.df_map.copy()
+        if dtype != df_map['source_term'].dtype:
+            df_map['source_term'] = df_map['source_term'].astype(dtype)
+        return df_map
+
+    def lookup(self,series):
+        """
+        Look up the destination term of each value of a series
+
+        Args:
+           series (pandas.Series): the source field
+        Returns:
+           numpy.array: the destination terms, NaN where a value has no mapping
+        """
+        if isinstance(series.dtype,pd.CategoricalDtype):
+            #only the categories need looking up
+            terms = self.lookup(pd.Series(series.cat.categories))
+            return pd.api.extensions.take(terms,series.cat.codes.values,allow_fill=True)
+
+        key = str(series.dtype)
+        index = self.get_index(series.dtype)
+        
+        codes,uniques = pd.factorize(series)
+        if key in self._cache:
+            seen,positions = self._cache[key]
+        else:
+            seen,positions = pd.Index(uniques[:0]),np.array([],dtype=np.intp)
+        
+        found = seen.get_indexer(uniques)
+        new = found == -1
+        if new.any():
+            new_values = pd.Index(uniques[new])
+            found[new] = np.arange(len(seen),len(seen)+len(new_values))
+            seen = seen.append(new_values)
+            positions = np.concatenate([positions,index.get_indexer(new_values)])
+            if len(seen) <= self.max_cached:
+                self._cache[key] = (seen,positions)
+
+        #missing values in the series are not mapped
+        rows = np.full(len(codes),-1,dtype=np.intp)
+        mapped = codes != -1
+        rows[mapped] = positions[found][codes[mapped]]
+        return pd.api.extensions.take(self.destination_terms,rows,allow_fill=True)
+
+    
+class ExecutionPlan:
+    """
+    The structural and term mapping, compiled into what needs to be done for each destination table:
+    which source tables to load, the field of each one to index on (the primary key),
+    and the rules to apply to make each of the destination fields.
+
+    The plan doesn't change once it has been compiled, so it can be saved to disk
+    and loaded again by the next run with the same mapping.
+    """
+    def __init__(self,tables,term_maps,key=None):
+        """
+        Args:
+           tables (dict): the TablePlan of each destination table
+           term_maps (dict): the term mapping (source_term to destination_term) of each rule_id
+           key (str): hash of everything the plan was compiled from
+        """
+        self._tables = dict(tables)
+        self._term_maps = dict(term_maps)
+        self.tables = MappingProxyType(self._tables)
+        self.term_maps = MappingProxyType(self._term_maps)
+        self.key = key
+        #built when they are first used, so are not saved with the plan
+        self._term_indexes = {}
+
+    def __reduce__(self):
+        return (self.__class__,(self._tables,self._term_maps,self.key))
+
+    def __iter__(self):
+        return iter(self.tables.values())
+
+    def get_source_tables(self):
+        """
+        Get the destination tables that are made from each source table
+
+        Returns:
+           dict: list of destination tables for each source table, in the order they are first needed
+        """
+        source_tables = {}
+        for table in self:
+            for source in table.sources:
+                source_tables.setdefault(source.source_table,[]).append(table.destination_table)
+        return source_tables
+
+    def get_term_map(self,rule_id):
+        """
+        Get a copy of the term mapping of a rule, that can be modified when it is applied
+        """
+        return self.term_maps[rule_id].copy()
+
+    def get_term_index(self,rule_id):
+        """
+        Get the hash index of the term mapping of a rule
+        """
+        if rule_id not in self._term_indexes:
+            self._term_indexes[rule_id] = TermIndex(self.term_maps[rule_id])
+        return self._term_indexes[rule_id]
+
+    def save(self,fname):
+        """
+        Save the plan to disk
+        """
+        folder = os.path.dirname(fname)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(fname,'wb') as f:
+            pickle.dump(self,f)
+
+    @classmethod
+    def load(cls,fname,key=None):
+        """
+        Load a plan from disk
+
+        Args:
+           fname (str): file the plan was saved to
+           key (str): the key the plan needs to have been compiled with
+        Returns:
+           ExecutionPlan: the plan, or None if there isn't one that matches the key
+        """
+        if not os.path.exists(fname):
+            return None
+        with open(fname,'rb') as f:
+            plan = pickle.load(f)
+        if not isinstance(plan,cls) or (key is not None and plan.key != key):
+            return None
+        return plan
+
+
+def make_key(*objects):
+    """
+    Make a hash of the dataframes and settings a plan is compiled from
+    """
+    sha = hashlib.sha1()
+    for obj in objects:
+        if isinstance(obj,pd.DataFrame):
+            sha.update(pd.util.hash_pandas_object(obj.astype(str)).values.tobytes())
+            sha.update(repr(list(obj.columns)).encode())
+        else:
+            sha.update(repr(obj).encode())
+    return sha.hexdigest()
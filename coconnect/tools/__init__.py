@@ -9,6 +9,7 @@ from . import mapping_pipeline_helpers
 from . import omop_db_inspect
 #from omop_db_inspect import OMOPDetails
 from . import extract
+from .partitioned_inputs import PartitionedInputs
 
 _DEBUG = False
 
@@ -63,7 +64,15 @@ def get_classes(format=False):
 
 
 
-def load_csv(_map,nrows=None,load_path=""):
+def load_csv(_map,nrows=None,load_path="",chunksize=None,skip_rows=None):
+
+    #stream the inputs in partitions of person_id, rather than loading them all
+    if chunksize is not None:
+        return PartitionedInputs(_map,chunksize,nrows=nrows,load_path=load_path,skip_rows=skip_rows)
+
+    #the number of rows at the start of each input to skip, e.g. ones processed by a previous run
+    if skip_rows is None:
+        skip_rows = {}
 
     for key,obj in _map.items():
         fields = None
@@ -73,7 +82,8 @@ def load_csv(_map,nrows=None,load_path=""):
             fname = obj['file']
             fields = obj['fields']
 
-        df = pd.read_csv(load_path+fname,nrows=nrows,dtype=str)
+        skiprows = range(1,skip_rows.get(key,0)+1)
+        df = pd.read_csv(load_path+fname,nrows=nrows,dtype=str,skiprows=skiprows)
         for col in df.columns:
             df[col].fname = fname
         df.columns = df.columns.str.lower()
@@ -0,0 +1,72 @@
+import os
+import functools
+import pandas as pd
+
+_data_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),'..','data','cdm'))
+
+
+class CdmTable:
+    """
+    Details of all the fields of a single CDM table, e.g. person
+
+    Attributes:
+       df (pandas.DataFrame): 'required', 'type' and 'is_source' for each field (the index)
+       fields (numpy.ndarray): the names of the fields, in CDM order
+       types (dict): lookup of field to datatype
+       required (dict): lookup of field to whether it is required (Yes/No)
+    """
+    def __init__(self,name,df):
+        self.name = name
+        self.df = df
+        self.fields = df.index.values
+        self.types = df['type'].to_dict()
+        self.required = df['required'].to_dict()
+
+
+def get_path(_version='v5_3_1'):
+    """
+    Get the path of the csv file for a version of the CDM
+    """
+    return f'{_data_dir}/OMOP_CDM_{_version}.csv'
+
+
+@functools.lru_cache(maxsize=None)
+def read_cdm(f_cdm):
+    """
+    Read a CDM csv file, indexed by the table. This is only ever done once per file,
+    so the returned dataframe is shared and should not be modified, use .copy() if it needs to be.
+
+    Args:
+       f_cdm (str): path to the csv file
+    Returns:
+       pandas.DataFrame: all fields in the CDM
+    """
+    f_cdm = os.path.abspath(f_cdm)
+    return pd.read_csv(f_cdm,encoding="ISO-8859-1").set_index('table')
+
+
+def load_cdm(_version='v5_3_1'):
+    """
+    Load a version of the CDM, see read_cdm()
+    """
+    return read_cdm(get_path(_version))
+
+
+@functools.lru_cache(maxsize=None)
+def get_table(table,_version='v5_3_1'):
+    """
+    Get the details of a CDM table, these are cached so each table is only set up once
+
+    Args:
+       table (str): name of the table, e.g. "person"
+       _version (str): the CDM version
+    Returns:
+       CdmTable: the fields, types and if they're required for this table
+    """
+    # - set the table (e.g. person, condition_occurrence,...)  as the index
+    #   so that all values associated with the object (name) can be retrieved
+    # - then set the field (e.g. person_id, birth_datetime,,) to help with future lookups
+    # - just keep information on if the field is required (Yes/No) and what the datatype is (INTEGER,..)
+    df = load_cdm(_version).loc[table].set_index('field')[['required', 'type']]
+    df['is_source'] = df.index.str.endswith("_source_value")
+    return CdmTable(table,df)
@@ -0,0 +1,210 @@
+import datetime
+import numpy as np
+import pandas as pd
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:
+    #only public from pandas 2.2
+    from pandas.core.tools.datetimes import guess_datetime_format
+
+
+#ages are converted to dates of birth relative to the middle of 2020
+AGE_NORM = datetime.datetime(2020, 7, 1)
+
+
+class DateParser:
+    """
+    Parse a series of dates (e.g. strings) into datetimes with pandas.to_datetime,
+    only parsing each distinct value once.
+
+    The values of a series are factorized, so a date repeated in a column is only parsed once,
+    and the datetime of every value parsed so far is kept, so each chunk or column only needs to parse
+    values that have not been seen before, e.g. the same date of birth column being parsed for the
+    year, month and day of birth only parses it the first time.
+
+    The format of each column is inferred the first time it is parsed and then given to
+    pandas.to_datetime explicitly, so every chunk of the column is parsed with the same format.
+    Dates where the day and month could be either way around (e.g. 01/02/2020) are month first,
+    as with pandas.to_datetime, unless some of the first values of the column can only be day first.
+    When the format can't be inferred, or doesn't fit the values of a later chunk, the distinct values
+    are parsed without a format instead, and are not kept.
+    """
+    #stop remembering values once there are this many, e.g. for high cardinality datetimes
+    max_cached = 10**6
+
+    def __init__(self):
+        self._formats = {}
+        self._cache = {}
+
+    def clear(self):
+        """
+        Forget the formats and all the values parsed so far
+        """
+        self._formats = {}
+        self._cache = {}
+
+    @staticmethod
+    def infer_format(uniques):
+        """
+        Infer the format of some dates from the first one, as pandas.to_datetime does,
+        checking that all of them can be parsed with it
+
+        Args:
+           uniques (numpy.ndarray): the distinct values of a series, in the order they appear
+        Returns:
+           str: the format, or None if it can't be inferred
+           pandas.Series: the dates parsed with the format, or None
+        """
+        if len(uniques) == 0 or not isinstance(uniques[0],str):
+            return None,None
+        fmt = guess_datetime_format(uniques[0])
+        if fmt is None:
+            return None,None
+        candidates = [fmt]
+        if '%d' in fmt and '%m' in fmt and not fmt.startswith('%Y'):
+            #the day and month could be the other way around
+            candidates.append(fmt.replace('%m','%_').replace('%d','%m').replace('%_','%d'))
+        for candidate in candidates:
+            try:
+                return candidate,pd.to_datetime(pd.Series(uniques),format=candidate)
+            except (ValueError,TypeError):
+                continue
+        return None,None
+
+    def parse(self,series):
+        """
+        Parse a series into datetimes, as pandas.to_datetime(series) would
+
+        Args:
+           series (pandas.Series): the dates to parse
+        Returns:
+           pandas.Series: the datetimes, NaT where a value is missing
+        """
+        if isinstance(series.dtype,pd.CategoricalDtype):
+            #only the categories need parsing
+            dates = self.parse(pd.Series(series.cat.categories,name=series.name))
+            values = pd.api.extensions.take(dates.values,series.cat.codes.values,allow_fill=True)
+            return pd.Series(values,index=series.index,name=series.name)
+        if pd.api.types.is_datetime64_any_dtype(series.dtype):
+            return pd.to_datetime(series)
+
+        codes,uniques = pd.factorize(series)
+        key = (series.name,str(series.dtype))
+        new_parsed = None
+        if key not in self._formats:
+            self._formats[key],new_parsed = self.infer_format(uniques)
+        fmt = self._formats[key]
+        seen,parsed = self._cache.get(key,(pd.Index(uniques[:0]),np.array([],dtype='datetime64[ns]')))
+
+        found = seen.get_indexer(uniques)
+        new = found == -1
+        if new.any():
+            #the values are already parsed if the format was just inferred from them
+            if new_parsed is None and fmt is not None:
+                try:
+                    new_parsed = pd.to_datetime(pd.Series(uniques[new]),format=fmt)
+                except (ValueError,TypeError):
+                    #not all the values have the format
+                    pass
+            if new_parsed is None or new_parsed.dtype != parsed.dtype:
+                #parse the distinct values without a format, as the result depends on all of them they aren't kept
+                #(or they are e.g. dates with a timezone)
+                values = pd.to_datetime(pd.Series(uniques))
+                return pd.Series(pd.api.extensions.take(values.array,codes,allow_fill=True),
+                                 index=series.index,name=series.name)
+            found[new] = np.arange(len(seen),len(seen)+new.sum())
+            seen = seen.append(pd.Index(uniques[new]))
+            parsed = np.concatenate([parsed,new_parsed.values])
+            if len(seen) <= self.max_cached:
+                self._cache[key] = (seen,parsed)
+
+        #missing values are not parsed
+        rows = np.full(len(codes),-1,dtype=np.intp)
+        mapped = codes != -1
+        rows[mapped] = found[codes[mapped]]
+        values = pd.api.extensions.take(parsed,rows,allow_fill=True)
+        return pd.Series(values,index=series.index,name=series.name)
+
+
+#the parser shared by the operations of the cdm objects and the ETLTool
+parser = DateParser()
+
+def parse(series):
+    """
+    Parse a series into datetimes with the shared parser
+    """
+    return parser.parse(series)
+
+def _format(series,unit,nchars):
+    """
+    Format datetimes as ISO strings of a numpy datetime unit, without strftime
+
+    Each distinct datetime is only formatted once, by casting to fixed width bytes with numpy,
+    which is much faster than strftime as it isn't done one value at a time.
+    Missing values are NaN, as with strftime.
+    """
+    if series.dtype != 'datetime64[ns]':
+        #e.g. datetimes with a timezone
+        return None
+    codes,uniques = pd.factorize(series)
+    values = np.asarray(uniques,dtype='datetime64[ns]')
+    #e.g. b'2020-01-31T12:00:00'
+    text = values.astype(f'datetime64[{unit}]').astype(f'S{nchars}')
+    if nchars > 10:
+        #separate the date and the time with a space rather than a T
+        text.view(np.uint8).reshape(-1,nchars)[:,10] = ord(' ')
+    text = text.astype(f'U{nchars}').astype(object)
+    values = pd.api.extensions.take(text,codes,allow_fill=True)
+    return pd.Series(values,index=series.index,name=series.name)
+
+def format_datetime(series):
+    """
+    Format datetimes as strings, e.g. '2020-01-31 12:00:00',
+    the same as series.dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    Args:
+       series (pandas.Series): the datetimes
+    Returns:
+       pandas.Series: the strings, NaN where a datetime is missing
+    """
+    retval = _format(series,'s',19)
+    if retval is None:
+        return series.dt.strftime('%Y-%m-%d %H:%M:%S')
+    return retval
+
+def format_date(series):
+    """
+    Format datetimes as dates, e.g. '2020-01-31',
+    the same as series.dt.strftime('%Y-%m-%d')
+
+    Args:
+       series (pandas.Series): the datetimes
+    Returns:
+       pandas.Series: the strings, NaN where a datetime is missing
+    """
+    retval = _format(series,'D',10)
+    if retval is None:
+        return series.dt.strftime('%Y-%m-%d')
+    return retval
+
+
+def get_datetime_from_age(series,norm=None,whole_years=False):
+    """
+    Get the date of birth from an age, as a number of years of 365 days before a date
+
+    Args:
+       series (pandas.Series): the ages, missing ages are taken to be 0
+       norm (datetime.datetime): the date the ages are relative to, the default is the middle of 2020
+       whole_years (bool): whether to only use the whole number of years of each age
+    Returns:
+       pandas.Series: the datetimes of birth
+    """
+    if norm is None:
+        norm = AGE_NORM
+    years = pd.to_numeric(series.fillna(0)).values.astype('float64')
+    if whole_years:
+        years = np.trunc(years)
+    #to the nearest microsecond, as with datetime.timedelta
+    age = np.round(years*365*86400*10**6).astype('timedelta64[us]')
+    values = (np.datetime64(norm,'us') - age).astype('datetime64[ns]')
+    return pd.Series(values,index=series.index,name=series.name)
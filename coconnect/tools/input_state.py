@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import collections
+
+
+#how an input file has changed since it was last processed
+#- status: 'new', 'changed', 'appended' or 'unchanged'
+#- nrows: the number of rows that were processed last time, which can be skipped if the file was appended to
+#- fingerprint: the fingerprint of the file now, to record once it has been processed
+Change = collections.namedtuple('Change',['status','nrows','fingerprint'])
+
+
+def fingerprint(fname,prefix_size=None,block_size=1<<20):
+    """
+    Make a fingerprint of a file from a hash of its contents
+
+    Args:
+       fname (str): the file name
+       prefix_size (int): also hash the first prefix_size bytes, to check if the file has only been appended to
+    Returns:
+       dict: the size and sha1 of the file, whether it ends with a new line,
+             and the sha1 of the prefix (None if the file is shorter than the prefix)
+    """
+    sha = hashlib.sha1()
+    prefix_sha1 = None
+    size = 0
+    last = b''
+    with open(fname,'rb') as f:
+        for buf in iter(lambda: f.read(block_size), b''):
+            if prefix_size is not None and prefix_sha1 is None and size + len(buf) >= prefix_size:
+                prefix = sha.copy()
+                prefix.update(buf[:prefix_size-size])
+                prefix_sha1 = prefix.hexdigest()
+            sha.update(buf)
+            size += len(buf)
+            last = buf[-1:]
+    if prefix_size == 0:
+        prefix_sha1 = hashlib.sha1().hexdigest()
+    return {
+        'size':size,
+        'sha1':sha.hexdigest(),
+        'newline':last == b'\n',
+        'prefix_sha1':prefix_sha1
+    }
+
+
+class InputState:
+    """
+    State of the inputs the last time they were processed into an output folder:
+    the fingerprint of each input file and how many of its rows were processed,
+    how many rows were saved to each output table, and how many rows were dropped
+    because their person_id wasn't in the person table (so could be for people added by later rows).
+
+    This is used to find the inputs that have changed, or only had rows appended to them, since then,
+    so that the next run only needs to process what is new.
+    The state is only valid for runs with the same mapping and settings (the key).
+    """
+    def __init__(self,fname,key=None):
+        """
+        Args:
+           fname (str): .json file to save the state to
+           key (str): hash of the mapping and settings the inputs were processed with
+        """
+        self.fname = fname
+        self.key = key
+        self.inputs = {}
+        self.outputs = {}
+        self.nrows_unknown_person = 0
+
+    @classmethod
+    def load(cls,fname,key=None):
+        """
+        Load the state of the last run
+
+        Returns:
+           InputState: the state, or None if there isn't one with the same key
+        """
+        if not os.path.exists(fname):
+            return None
+        with open(fname) as f:
+            data = json.load(f)
+        if key is not None and data.get('key') != key:
+            return None
+        state = cls(fname,data['key'])
+        state.inputs = data['inputs']
+        state.outputs = data['outputs']
+        state.nrows_unknown_person = data.get('nrows_unknown_person',0)
+        return state
+
+    def save(self):
+        """
+        Save the state, replacing the previous one in one step
+        """
+        folder = os.path.dirname(self.fname)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        data = {
+            'key':self.key,
+            'inputs':self.inputs,
+            'outputs':self.outputs,
+            'nrows_unknown_person':self.nrows_unknown_person
+        }
+        tmp = f'{self.fname}.tmp'
+        with open(tmp,'w') as f:
+            json.dump(data,f,indent=6)
+        os.replace(tmp,self.fname)
+
+    def get_change(self,name,fname):
+        """
+        Find how an input file has changed since it was last processed
+
+        Args:
+           name (str): name of the input
+           fname (str): the input file
+        Returns:
+           Change: the status of the file, and the number of rows already processed
+        """
+        previous = self.inputs.get(name)
+        if previous is None:
+            return Change('new',0,fingerprint(fname))
+
+        current = fingerprint(fname,prefix_size=previous['size'])
+        if current['sha1'] == previous['sha1']:
+            return Change('unchanged',previous['nrows'],current)
+        #if the last row didnt end with a new line, the first row appended would continue it
+        if current['prefix_sha1'] == previous['sha1'] and previous['newline']:
+            return Change('appended',previous['nrows'],current)
+        return Change('changed',0,current)
+
+    def get_changes(self,files):
+        """
+        Find how each input file has changed since it was last processed
+
+        Args:
+           files (dict): map of input name to file name
+        Returns:
+           dict: the Change of each input
+        """
+        return {
+            name:self.get_change(name,fname)
+            for name,fname in files.items()
+        }
+
+    def update_input(self,name,change,nrows):
+        """
+        Record that an input has been processed
+
+        Args:
+           name (str): name of the input
+           change (Change): the change found before the input was processed
+           nrows (int): the total number of rows of the input that have now been processed
+        """
+        self.inputs[name] = {
+            'size':change.fingerprint['size'],
+            'sha1':change.fingerprint['sha1'],
+            'newline':change.fingerprint['newline'],
+            'nrows':nrows
+        }
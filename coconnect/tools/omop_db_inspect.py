@@ -5,6 +5,7 @@ import sqlalchemy as sql
 import pandas as pd
 import numpy as np
 from collections import defaultdict
+from . import cdm_schema
 
 
 class MultipleDomainsForInputConcepts(Exception):
@@ -23,10 +24,7 @@ class OMOPDetails():
     #Return the dataframe
     @classmethod
     def from_csv(self,_version = 'v5_3_1'):
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        f_path = f'{dir_path}/../data/cdm/OMOP_CDM_{_version}.csv'
-        self.cdm = pd.read_csv(f_path,encoding="ISO-8859-1")\
-                     .set_index('table')[['field']]        
+        self.cdm = cdm_schema.load_cdm(_version)[['field']]
         return self.cdm
 
     #instead get the cdm objects (destination table & field) from the OMOPDB
@@ -76,6 +74,9 @@ class OMOPDetails():
         dir_path = os.path.dirname(os.path.realpath(__file__))
         f_path = f'{dir_path}/../data/cdm/OMOP_CDM_ONLINE_LATEST.csv'
         cdm.to_csv(f_path)
+        #make sure the new dump is read, rather than a cached one
+        cdm_schema.read_cdm.cache_clear()
+        cdm_schema.get_table.cache_clear()
         
         
 
@@ -0,0 +1,150 @@
+import os
+import math
+import shutil
+import tempfile
+import pandas as pd
+from coconnect.tools.logger import Logger
+
+
+class PartitionedInputs(dict):
+    """
+    Inputs that are streamed from .csv files in partitions of person_id
+
+    Every input file is read in chunks and each row is sent to a partition based on a
+    hash of its person_id (the index set via set_indexing), so that all the rows of a person,
+    across all the inputs, end up in the same partition. The partitions are written to a temporary
+    folder and then loaded one at a time, so memory is set by the chunksize, not the size of the dataset.
+    """
+    def __init__(self,_map,chunksize,nrows=None,load_path="",tmp_dir=None,skip_rows=None):
+        """
+        Args:
+           _map (dict): map of input name to a file name, or to a dict of {'file':..,'fields':[..]}
+           chunksize (int): the number of rows to read at a time and (roughly) the size of a partition
+           nrows (int): the maximum number of rows to read from each input
+           load_path (str): path to prepend to the file names
+           tmp_dir (str): where to store the partitions, the default is the system temp folder
+           skip_rows (dict): the number of rows at the start of each input to skip
+        """
+        super().__init__()
+        self.logger = Logger(self.__class__.__name__)
+        self.chunksize = chunksize
+        self.nrows = nrows
+        self.tmp_dir = tmp_dir
+        self.npartitions = None
+        self.skip_rows = skip_rows if skip_rows is not None else {}
+        #the number of rows read from each input
+        self.nrows_read = {}
+
+        self.files = {}
+        self.fields = {}
+        self.columns = {}
+        for key,obj in _map.items():
+            if isinstance(obj,str):
+                self.files[key] = load_path+obj
+                self.fields[key] = None
+            else:
+                self.files[key] = load_path+obj['file']
+                self.fields[key] = obj['fields']
+            #nothing is loaded until the partitions are made
+            #but the keys are needed so the inputs can be checked
+            self[key] = None
+
+    def count_rows(self,fname):
+        """
+        Quickly count the number of rows in a file, without parsing it
+        """
+        nlines = 0
+        with open(fname,'rb') as f:
+            for buf in iter(lambda: f.read(1<<20), b''):
+                nlines += buf.count(b'\n')
+        return max(nlines - 1,0)
+
+    def split(self,index_map,tmp_dir):
+        """
+        Split all the inputs into partitions of person_id
+
+        Args:
+           index_map (dict): map of input name to the column that is the person_id
+           tmp_dir (str): folder to write the partitions to
+        Returns:
+           int: the number of partitions made
+        """
+        nrows = max([self.count_rows(fname) - self.skip_rows.get(key,0)
+                     for key,fname in self.files.items()] + [0])
+        if self.nrows is not None:
+            nrows = min(nrows,self.nrows)
+        self.npartitions = max(1,math.ceil(nrows/self.chunksize))
+        self.logger.info(f"splitting inputs into {self.npartitions} partitions of person_id")
+
+        for n,(key,fname) in enumerate(self.files.items()):
+            index = index_map.get(key)
+            if index is None:
+                self.logger.warning(f"no person_id index has been set for '{key}', "
+                                    "so the whole input will be loaded with the first partition")
+
+            self.nrows_read[key] = 0
+            chunks = pd.read_csv(fname,dtype=str,chunksize=self.chunksize,nrows=self.nrows,
+                                 skiprows=range(1,self.skip_rows.get(key,0)+1))
+            for df in chunks:
+                df.columns = df.columns.str.lower()
+                self.nrows_read[key] += len(df)
+
+                if index is None:
+                    ipartition = pd.Series(0,index=df.index)
+                elif index not in df.columns:
+                    self.logger.error(f"trying to partition '{key}' on '{index}', but this index is not in the columns!")
+                    ipartition = pd.Series(0,index=df.index)
+                else:
+                    ipartition = pd.util.hash_pandas_object(df[index],index=False) % self.npartitions
+
+                #filter on only the fields we need
+                if self.fields[key] is not None:
+                    df = df[self.fields[key]]
+                self.columns[key] = list(df.columns)
+
+                for i,df_partition in df.groupby(ipartition.values):
+                    outname = f'{tmp_dir}/{i}/{n}.csv'
+                    if not os.path.exists(f'{tmp_dir}/{i}'):
+                        os.makedirs(f'{tmp_dir}/{i}')
+                    exists = os.path.exists(outname)
+                    df_partition.to_csv(outname,index=False,
+                                        mode='a' if exists else 'w',
+                                        header=not exists)
+
+        return self.npartitions
+
+    def load_partition(self,tmp_dir,i):
+        """
+        Load a single partition of all the inputs
+
+        Args:
+           tmp_dir (str): folder the partitions were written to
+           i (int): the partition to load
+        Returns:
+           dict: map of input name to a pandas dataframe
+        """
+        inputs = {}
+        for n,key in enumerate(self.files):
+            fname = f'{tmp_dir}/{i}/{n}.csv'
+            if os.path.exists(fname):
+                inputs[key] = pd.read_csv(fname,dtype=str)
+            else:
+                inputs[key] = pd.DataFrame(columns=self.columns.get(key,[]),dtype=str)
+        return inputs
+
+    def partitions(self,index_map):
+        """
+        Generator over all the partitions of the inputs
+
+        Args:
+           index_map (dict): map of input name to the column that is the person_id
+        Yields:
+           dict: map of input name to a pandas dataframe for the partition
+        """
+        tmp_dir = tempfile.mkdtemp(prefix='coconnect_',dir=self.tmp_dir)
+        try:
+            npartitions = self.split(index_map,tmp_dir)
+            for i in range(npartitions):
+                yield self.load_partition(tmp_dir,i)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,132 @@
+import os
+import numpy as np
+import pandas as pd
+from coconnect.tools.logger import Logger
+
+
+class PersonIdMasker:
+    """
+    Lookup of original person_ids to masked person_ids (1,2,3...)
+
+    New person_ids are given the next masked ids in the order they are first seen.
+    The lookup can be saved to, and loaded from, a .csv file, so that the same person is given the same
+    masked id across tables, chunks and runs. Only new person_ids are appended when the lookup is saved.
+    The original person_ids are kept as strings, so they can be matched with ones loaded from file.
+
+    The person_ids loaded from file are only used to keep the same masked ids, a person_id is only
+    matched without being added (i.e. for the tables other than person) once it has been added in this run,
+    unless the run starts with keep_saved, e.g. when rows are appended to the outputs of the previous run.
+    """
+    def __init__(self,fname=None,load=True):
+        """
+        Args:
+           fname (str): .csv file to load the lookup from (if it exists) and to save it to
+           load (bool): whether to load the lookup from the file, otherwise it is replaced when saved
+        """
+        self.logger = Logger(self.__class__.__name__)
+        self.fname = fname
+        self.originals = pd.Index([],dtype=object)
+        self.ids = np.array([],dtype='int64')
+
+        if load and fname is not None and os.path.exists(fname):
+            df = pd.read_csv(fname,dtype={'original_person_id':str})
+            self.originals = pd.Index(df['original_person_id'],dtype=object)
+            self.ids = df['person_id'].values.astype('int64')
+            self.logger.info(f"loaded {len(self.ids)} person_ids from {fname}")
+
+        #how many of the person_ids have already been saved to file
+        self.nsaved = len(self.ids)
+        #whether each person_id has been added in this run
+        self.in_run = np.zeros(len(self.ids),dtype=bool)
+
+    def start_run(self,keep_saved=False):
+        """
+        Start a new run, where only the person_ids added during the run are matched
+
+        Args:
+           keep_saved (bool): also match all the person_ids already in the lookup,
+                              e.g. when the outputs of the previous run are kept and appended to
+        """
+        self.in_run = np.full(len(self.ids),keep_saved,dtype=bool)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_positions(self,uniques):
+        """
+        Look up the positions in the lookup of some unique (string) person_ids
+
+        Returns:
+           numpy.ndarray: the positions, with -1 for person_ids that aren't in the lookup
+        """
+        return self.originals.get_indexer(uniques)
+
+    def mask(self,series,extend=False):
+        """
+        Mask a series of person_ids, the series is factorized so only the unique person_ids are looked up
+
+        Args:
+           series (pandas.Series): the original person_ids
+           extend (bool): whether to add person_ids that aren't in the lookup yet,
+                          otherwise person_ids that haven't been added in this run are masked as NaN
+        Returns:
+           pandas.Series: the masked person_ids
+        """
+        codes,uniques = pd.factorize(series)
+        if len(uniques) == 0:
+            return pd.Series(np.nan,index=series.index,name=series.name)
+        uniques = pd.Index(uniques).astype(str)
+        positions = self.get_positions(uniques)
+        found = positions >= 0
+        ids = np.full(len(positions),-1,dtype='int64')
+        ids[found] = self.ids[positions[found]]
+
+        if extend:
+            self.in_run[positions[found]] = True
+        else:
+            #only the person_ids added in this run are matched
+            ids[found & ~self.in_run[np.maximum(positions,0)]] = -1
+
+        missing = ids < 0
+        if extend and missing.any():
+            start = self.ids.max()+1 if len(self.ids) > 0 else 1
+            new_ids = np.arange(start,start+missing.sum(),dtype='int64')
+            self.originals = self.originals.append(uniques[missing])
+            self.ids = np.concatenate([self.ids,new_ids])
+            self.in_run = np.concatenate([self.in_run,np.ones(len(new_ids),dtype=bool)])
+            ids[missing] = new_ids
+            missing[:] = False
+
+        values = ids[codes]
+        #rows with a NaN person_id, or one that isn't in the lookup
+        nulls = (codes < 0) | missing[codes]
+        if nulls.any():
+            values = values.astype('float64')
+            values[nulls] = np.nan
+        return pd.Series(values,index=series.index,name=series.name)
+
+    def save(self,fname=None):
+        """
+        Append any new person_ids to the lookup file
+
+        Args:
+           fname (str): file to save to, the default is the file the lookup was created with
+        """
+        if fname is None:
+            fname = self.fname
+        if fname is None or self.nsaved == len(self.ids):
+            return
+
+        folder = os.path.dirname(fname)
+        if folder and not os.path.exists(folder):
+            self.logger.info(f'making output folder {folder}')
+            os.makedirs(folder)
+
+        df = pd.DataFrame({
+            'original_person_id':self.originals[self.nsaved:],
+            'person_id':self.ids[self.nsaved:]
+        })
+        exists = os.path.exists(fname) and self.nsaved > 0
+        df.to_csv(fname,index=False,mode='a' if exists else 'w',header=not exists)
+        self.logger.info(f'saved {len(df)} new person_ids to {fname}')
+        self.nsaved = len(self.ids)
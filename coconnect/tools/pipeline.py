@@ -0,0 +1,126 @@
+import queue
+import threading
+
+
+class ReadAhead:
+    """
+    Iterate over an iterable (e.g. the chunks of a csv file) in a background thread,
+    keeping up to size items ready, so the next item is being read while the current one is used.
+    Any error raised while reading is raised again when the item it happened on is reached.
+    """
+    def __init__(self,iterable,size=1):
+        """
+        Args:
+           iterable: the items to read ahead
+           size (int): the maximum number of items to hold that have been read but not used yet
+        """
+        self.queue = queue.Queue(maxsize=max(size,1))
+        self.stopped = threading.Event()
+        self.done = False
+        self.thread = threading.Thread(target=self._read,args=(iter(iterable),),daemon=True)
+        self.thread.start()
+
+    def _put(self,item):
+        #give up if the items are not needed anymore
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item,timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self,iterator):
+        try:
+            for item in iterator:
+                if not self._put((True,item)):
+                    return
+        except Exception as err:
+            self._put((False,err))
+            return
+        self._put((False,None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        ok,item = self.queue.get()
+        if ok:
+            return item
+        self.done = True
+        if item is None:
+            raise StopIteration
+        raise item
+
+    def close(self):
+        """
+        Stop reading ahead, e.g. when not all of the items are needed
+        """
+        self.done = True
+        self.stopped.set()
+
+
+class BackgroundWriter:
+    """
+    Run functions that save data (e.g. writing a chunk to a file) in a background thread,
+    in the order they were submitted, so the saving overlaps with the next piece of work.
+    At most size functions are queued, after which submitting waits for the oldest to start.
+    """
+    def __init__(self,size=1):
+        """
+        Args:
+           size (int): the maximum number of functions waiting to be run
+        """
+        self.queue = queue.Queue(maxsize=max(size,1))
+        self.error = None
+        self.thread = threading.Thread(target=self._write,daemon=True)
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            #skip everything after an error, which is raised in the main thread
+            if self.error is not None:
+                continue
+            function,args,kwargs = item
+            try:
+                function(*args,**kwargs)
+            except Exception as err:
+                self.error = err
+
+    def check(self):
+        """
+        Raise an error from a function that has been run
+        """
+        if self.error is not None:
+            raise self.error
+
+    def submit(self,function,*args,**kwargs):
+        """
+        Queue a function to be run in the background
+        """
+        self.check()
+        self.queue.put((function,args,kwargs))
+
+    def close(self):
+        """
+        Wait for all the queued functions to finish
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            #dont hide the error that is already being raised
+            self.queue.put(None)
+            self.thread.join()
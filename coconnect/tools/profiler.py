@@ -0,0 +1,146 @@
+import os
+import sys
+import json
+import time
+import contextlib
+import pandas as pd
+from coconnect.tools.logger import Logger
+
+try:
+    import resource
+except ImportError:
+    #not available on windows, so the memory is not recorded
+    resource = None
+
+
+def get_peak_memory():
+    """
+    Get the peak memory (resident set size) used by this process so far
+
+    Returns:
+       float: peak memory in MB, or None if it cannot be found on this platform
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #bytes on macOS, kB on linux
+    if sys.platform == 'darwin':
+        return maxrss/1024**2
+    return maxrss/1024
+
+
+class Profiler:
+    """
+    Record the wall time, CPU time, rows in/out and memory of each stage of a run,
+    for each cdm table and object.
+
+    The memory recorded is the peak memory of the process at the end of the stage,
+    and how much the stage increased it by, i.e. the stages that set the peak memory of the run.
+    """
+    def __init__(self):
+        self.logger = Logger(self.__class__.__name__)
+        self.records = []
+        self.started = time.time()
+        #the partition of the inputs being run, when they are streamed
+        self.partition = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @contextlib.contextmanager
+    def stage(self,table,name,stage,rows_in=None):
+        """
+        Record a stage, rows_out can be set on the record that is yielded
+
+        Args:
+           table (str): name of the cdm table, e.g. "person"
+           name (str): name of the object, or None for stages run on the whole table
+           stage (str): name of the stage, e.g. "define"
+           rows_in (int): number of rows going into the stage
+        """
+        record = {
+            'table':table,
+            'object':name,
+            'stage':stage,
+            'partition':self.partition,
+            'rows_in':rows_in,
+            'rows_out':None,
+        }
+        peak_memory = get_peak_memory()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        yield record
+        record['wall_seconds'] = time.perf_counter() - wall
+        record['cpu_seconds'] = time.process_time() - cpu
+        record['peak_memory_mb'] = get_peak_memory()
+        if peak_memory is not None:
+            record['memory_increase_mb'] = record['peak_memory_mb'] - peak_memory
+        else:
+            record['memory_increase_mb'] = None
+        record['pid'] = os.getpid()
+        self.records.append(record)
+
+    def get_df(self):
+        """
+        Returns:
+           pandas.DataFrame: all the records, one row per stage
+        """
+        return pd.DataFrame(self.records)
+
+    def summarise(self):
+        """
+        Summarise the records by stage and by object
+
+        Returns:
+           dict: dataframes of the totals for each stage, and for each object
+        """
+        df = self.get_df()
+        if len(df) == 0:
+            return {'stages':df,'objects':df}
+        #rows are not known for all stages, e.g. define
+        rows_sum = lambda x: x.sum(min_count=1)
+        aggregation = {
+            'wall_seconds':'sum',
+            'cpu_seconds':'sum',
+            'rows_in':rows_sum,
+            'rows_out':rows_sum,
+            'memory_increase_mb':'sum',
+            'peak_memory_mb':'max'
+        }
+        stages = df.groupby(['table','stage'],sort=False).agg(aggregation)
+        objects = df.dropna(subset=['object'])\
+                    .groupby(['table','object'],sort=False).agg(aggregation)\
+                    .sort_values('wall_seconds',ascending=False)
+        return {'stages':stages,'objects':objects}
+
+    def log_summary(self,nobjects=10):
+        """
+        Log the time spent in each stage, and the objects that took the longest
+        """
+        summary = self.summarise()
+        self.logger.info(f"run report, time spent in each stage:\n{summary['stages'].to_string()}")
+        self.logger.info(f"the {nobjects} slowest objects:\n{summary['objects'].head(nobjects).to_string()}")
+
+    def save(self,fname):
+        """
+        Save the run report to a .json file
+
+        Args:
+           fname (str): name of the .json file
+        """
+        folder = os.path.dirname(fname)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        stages = self.summarise()['stages'].reset_index()
+        #save missing values as null rather than NaN, which isn't valid json
+        stages = stages.astype(object).where(stages.notnull(),None)
+        report = {
+            'started':time.strftime('%Y-%m-%dT%H:%M:%S',time.localtime(self.started)),
+            'wall_seconds':time.time() - self.started,
+            'peak_memory_mb':get_peak_memory(),
+            'stages':stages.to_dict(orient='records'),
+            'records':self.records
+        }
+        with open(fname,'w') as f:
+            json.dump(report,f,indent=6,default=str)
+        self.logger.info(f'saved the run report to {fname}')
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import pandas as pd
+from coconnect.tools.writers import FeatherWriter
+
+
+class SpilledTable:
+    """
+    A table that has been spilled to disk in chunks, rather than being held in memory.
+    Each chunk is saved to a temporary feather file, so the dtypes are kept when it is loaded back,
+    or to a pickle file if pyarrow isn't installed.
+    """
+    def __init__(self,name,tmp_dir=None,folder=None):
+        """
+        Args:
+           name (str): name of the table, e.g. "measurement"
+           tmp_dir (str): where to save the chunks, the default is the system temp folder
+           folder (str): a folder to save the chunks in, rather than a new temporary one,
+                         so they can be found again with restore()
+        """
+        self.name = name
+        try:
+            import pyarrow
+            self.extension = FeatherWriter.extension
+        except ImportError:
+            self.extension = 'pkl'
+        if folder is None:
+            folder = tempfile.mkdtemp(prefix=f'coconnect_{name}_',dir=tmp_dir)
+        elif not os.path.exists(folder):
+            os.makedirs(folder)
+        self.folder = folder
+        self.files = []
+        self.nrows = 0
+
+    def __len__(self):
+        return self.nrows
+
+    def __iter__(self):
+        """
+        Load the chunks back, one at a time
+        """
+        for fname in self.files:
+            if self.extension == 'pkl':
+                yield pd.read_pickle(fname)
+            else:
+                yield pd.read_feather(fname)
+
+    def append(self,df):
+        """
+        Spill a chunk of the table to disk
+        """
+        df = df.reset_index(drop=True)
+        fname = f'{self.folder}/{len(self.files)}'
+        if self.extension == 'pkl':
+            fname = f'{fname}.{self.extension}'
+            df.to_pickle(fname)
+        else:
+            writer = FeatherWriter(fname)
+            writer.write(df)
+            writer.close()
+            fname = writer.fname
+        self.files.append(fname)
+        self.nrows += len(df)
+
+    def restore(self,nfiles,nrows):
+        """
+        Pick up the first chunks that were spilled to the folder (e.g. by a run that failed),
+        deleting any later ones
+
+        Args:
+           nfiles (int): number of chunks to keep
+           nrows (int): total rows in these chunks
+        """
+        self.files = [f'{self.folder}/{i}.{self.extension}' for i in range(nfiles)]
+        self.nrows = nrows
+        for fname in os.listdir(self.folder):
+            fname = f'{self.folder}/{fname}'
+            if fname not in self.files:
+                os.remove(fname)
+
+    def load(self):
+        """
+        Load the whole table into memory
+        """
+        return pd.concat(list(self),ignore_index=True)
+
+    def cleanup(self):
+        """
+        Delete all the chunks
+        """
+        shutil.rmtree(self.folder,ignore_errors=True)
+        self.files = []
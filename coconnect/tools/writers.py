@@ -0,0 +1,180 @@
+import os
+import pandas as pd
+
+
+class Writer:
+    """
+    Common object for writing dataframes to a file, a dataframe can be written in one go
+    or in pieces (e.g. chunks) that are appended to the same file, until the writer is closed.
+    The index of the dataframe is also written.
+    """
+    extension = None
+    def __init__(self,fname,append=False,date_fields=None):
+        """
+        Args:
+           fname (str): the file name, without the extension
+           append (bool): whether to append to the file if it already exists (e.g. from a previous run),
+                          rather than replace it
+           date_fields (list): columns of datetimes that only hold dates, to be written as dates
+                               by the formats that have a date type
+        """
+        self.fname = f'{fname}.{self.extension}'
+        self.nrows = 0
+        self.append = append and os.path.exists(self.fname)
+        self.date_fields = set(date_fields or [])
+
+    def write(self,df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CsvWriter(Writer):
+    """
+    Write uncompressed .csv files
+    """
+    extension = 'csv'
+    def write(self,df):
+        mode = 'a' if self.nrows > 0 or self.append else 'w'
+        df.to_csv(self.fname,index=True,mode=mode,header=(mode=='w'))
+        self.nrows += len(df)
+
+
+class ArrowWriter(Writer):
+    """
+    Common object for the columnar formats, which are written via pyarrow
+    so that the nullable integers and dates are kept as typed columns
+
+    These files can't be appended to in place, so when appending, the rows already in the file
+    are copied to a new file, which the new rows are written to and which replaces the file when closed.
+    """
+    def __init__(self,fname,compression=None,append=False,date_fields=None):
+        super().__init__(fname,append,date_fields)
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(f"pyarrow needs to be installed to write .{self.extension} files, "
+                              "try 'pip install pyarrow'")
+        self.pa = pyarrow
+        self.compression = compression
+        self.schema = None
+        self.writer = None
+
+    def to_table(self,df):
+        #all pieces must have the schema of the first one written
+        #e.g. a column that is all null in one chunk is still written as a date
+        table = self.pa.Table.from_pandas(df,schema=self.schema,preserve_index=True)
+        if self.schema is None:
+            self.schema = self.get_schema(table.schema)
+            if self.schema != table.schema:
+                table = self.pa.Table.from_pandas(df,schema=self.schema,preserve_index=True)
+        return table
+
+    def get_schema(self,schema):
+        """
+        Get the schema to write with, from the one of the first piece,
+        with the datetime columns of the date_fields as dates
+        """
+        for i,field in enumerate(schema):
+            if field.name in self.date_fields and self.pa.types.is_timestamp(field.type):
+                schema = schema.set(i,field.with_type(self.pa.date32()))
+        return schema
+
+    def start_append(self):
+        """
+        Open a new file with the schema of the existing one, and copy the existing rows to it
+        """
+        self.schema,tables = self.read()
+        self.writer = self.open(f'{self.fname}.tmp',self.schema)
+        for table in tables:
+            self.write_table(table)
+
+    def write_table(self,table):
+        self.writer.write_table(table)
+
+    def write(self,df):
+        if self.writer is None and self.append:
+            self.start_append()
+        table = self.to_table(df)
+        if self.writer is None:
+            self.writer = self.open(self.fname,table.schema)
+        self.write_table(table)
+        self.nrows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+            if self.append:
+                os.replace(f'{self.fname}.tmp',self.fname)
+                self.append = False
+
+
+class ParquetWriter(ArrowWriter):
+    """
+    Write compressed parquet files, each write is split into row groups of at most row_group_size rows
+    """
+    extension = 'parquet'
+    def __init__(self,fname,compression='snappy',row_group_size=10**6,append=False,date_fields=None):
+        super().__init__(fname,compression,append,date_fields)
+        self.row_group_size = row_group_size
+
+    def open(self,fname,schema):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(fname,schema,compression=self.compression)
+
+    def read(self):
+        """
+        Get the schema of the existing file, and its row groups one at a time
+        """
+        import pyarrow.parquet
+        f = pyarrow.parquet.ParquetFile(self.fname)
+        return f.schema_arrow,(f.read_row_group(i) for i in range(f.num_row_groups))
+
+    def write_table(self,table):
+        self.writer.write_table(table,row_group_size=self.row_group_size)
+
+
+class FeatherWriter(ArrowWriter):
+    """
+    Write feather (v2, i.e. Arrow IPC) files, which can be loaded with pandas.read_feather
+    """
+    extension = 'feather'
+    def __init__(self,fname,compression='lz4',append=False,date_fields=None):
+        super().__init__(fname,compression,append,date_fields)
+
+    def open(self,fname,schema):
+        options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+        return self.pa.ipc.new_file(fname,schema,options=options)
+
+    def read(self):
+        """
+        Get the schema of the existing file, and its record batches one at a time
+        """
+        reader = self.pa.ipc.open_file(self.pa.memory_map(self.fname))
+        return reader.schema,(self.pa.Table.from_batches([reader.get_batch(i)])
+                              for i in range(reader.num_record_batches))
+
+
+#lookup of output format to the writer class
+writers = {
+    'csv':CsvWriter,
+    'parquet':ParquetWriter,
+    'feather':FeatherWriter
+}
+
+def get_writer(output_format,fname,**kwargs):
+    """
+    Create a writer for an output format
+
+    Args:
+       output_format (str): one of 'csv', 'parquet' or 'feather'
+       fname (str): the file name, without the extension
+    Returns:
+       Writer: the writer for this format
+    """
+    if output_format not in writers:
+        raise NotImplementedError(f"Unknown output format '{output_format}', "
+                                  f"can only write {list(writers.keys())}")
+    return writers[output_format](fname,**kwargs)
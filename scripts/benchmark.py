@@ -0,0 +1,683 @@
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import coconnect
+from coconnect import tools
+from coconnect.tools import cdm_schema, writers
+from coconnect.cdm import CommonDataModel, Measurement, Observation, define_observation
+from coconnect.cdm.objects.base import Base
+from coconnect.cdm.model import CommonDataModelTypes
+from coconnect.tools.mapping_pipeline_helpers import StructuralMapping
+
+data_dir = os.path.join(os.path.dirname(coconnect.__file__),'data','example')
+f_lion = os.path.join(data_dir,'sample_config','lion_structural_mapping.json')
+
+
+def timeit(function,*args,repeat=3):
+    """
+    Return the best wall time (in seconds) of calling a function a number of times
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_series(_type,nrows,seed=1):
+    """
+    Make a series of strings, as they would be loaded from the inputs, to convert to a given type
+    """
+    rng = np.random.default_rng(seed)
+    if _type in ['INTEGER','FLOAT']:
+        values = rng.integers(0,10**6,nrows).astype(str)
+    elif _type == 'DATE':
+        days = rng.integers(0,365*80,nrows).astype('timedelta64[D]')
+        values = (np.datetime64('1940-01-01') + days).astype(str)
+    elif _type == 'DATETIME':
+        #as made by the get_datetime operation
+        seconds = rng.integers(0,86400*365*80,nrows).astype('timedelta64[s]')
+        values = np.char.replace((np.datetime64('1940-01-01T00:00:00') + seconds).astype(str),'T',' ')
+    else:
+        values = np.array([f'source value {i} with some extra text on the end' for i in rng.integers(0,1000,nrows)])
+    series = pd.Series(values,dtype=object)
+    #blank out some values, as there often are in the inputs
+    series[rng.random(nrows) < 0.05] = np.nan
+    return series
+
+
+#how each type was converted before the conversion functions were vectorized
+legacy_types = {
+    'INTEGER': lambda x : pd.to_numeric(x,errors='coerce').astype('Int64'),
+    'FLOAT': lambda x : pd.to_numeric(x,errors='coerce').astype('Float64'),
+    'VARCHAR(50)': lambda x : x.fillna('').astype(str).apply(lambda x: x[:50]),
+    'VARCHAR(20)': lambda x : x.fillna('').astype(str).apply(lambda x: x[:20]),
+    'VARCHAR': lambda x : x.fillna('').astype(str).apply(lambda x: x),
+    'DATETIME': lambda x : pd.to_datetime(x,errors='coerce').dt.strftime('%Y-%m-%d %H:%M:%S'),
+    'DATE': lambda x : pd.to_datetime(x,errors='coerce').dt.date,
+}
+
+
+def as_csv(series):
+    """
+    Get the text a series is saved as in a .csv file, e.g. dates are the same as strings of the date
+    """
+    return series.to_csv(index=False)
+
+
+def benchmark_types(nrows,repeat):
+    """
+    Compare converting each CDM type with the legacy and current conversion functions
+    """
+    dtypes = CommonDataModelTypes()
+    results = []
+    for _type,legacy in legacy_types.items():
+        series = make_series(_type,nrows)
+        current = dtypes[_type]
+        if as_csv(legacy(series)) != as_csv(current(series)):
+            raise ValueError(f"conversion to {_type} does not give the same result as before")
+        t_legacy = timeit(legacy,series,repeat=repeat)
+        t_current = timeit(current,series,repeat=repeat)
+        results.append({
+            'type':_type,
+            'nrows':nrows,
+            'legacy_seconds':t_legacy,
+            'seconds':t_current,
+            'speed_up':t_legacy/t_current
+        })
+    return results
+
+
+def make_date_table(table,nrows,seed=1):
+    """
+    Make the DATE and DATETIME fields of a cdm table, as they are before being formatted
+    """
+    schema = cdm_schema.get_table(table)
+    df = pd.DataFrame({
+        field:make_series(_type,nrows,seed+i)
+        for i,(field,_type) in enumerate(schema.types.items())
+        if _type in ['DATE','DATETIME']
+    })
+    df.index = pd.RangeIndex(1,nrows+1,name=f'{table}_id')
+    return df,schema.types
+
+
+def format_and_save(df,types,converters,output_format,fname,date_fields):
+    """
+    Format the fields of a table with some conversion functions and save it,
+    returning the wall time of each step
+    """
+    start = time.perf_counter()
+    df = pd.DataFrame({
+        field:converters[types[field]](df[field])
+        for field in df.columns
+    },index=df.index)
+    t_format = time.perf_counter() - start
+
+    start = time.perf_counter()
+    writer = writers.get_writer(output_format,fname,date_fields=date_fields)
+    writer.write(df)
+    writer.close()
+    t_save = time.perf_counter() - start
+    return t_format,t_save,writer.fname
+
+
+def benchmark_dates(nrows,tables,output_formats,repeat,tmp_dir=None):
+    """
+    Compare formatting and saving the DATE and DATETIME fields of cdm tables with the legacy and current
+    conversion functions, the current ones keep them as datetimes for the binary formats
+    """
+    folder = tempfile.mkdtemp(prefix='coconnect_benchmark_',dir=tmp_dir)
+    results = []
+    try:
+        for table in tables:
+            df,types = make_date_table(table,nrows)
+            date_fields = [field for field in df.columns if types[field] == 'DATE']
+            for output_format in output_formats:
+                current = CommonDataModelTypes(native_dates=(output_format != 'csv'))
+                timings = {}
+                for name,converters in [('legacy',legacy_types),('current',current)]:
+                    fname = os.path.join(folder,f'{table}_{name}')
+                    times = [
+                        format_and_save(df,types,converters,output_format,fname,date_fields)
+                        for _ in range(repeat)
+                    ]
+                    timings[name] = (min(t[0] for t in times),min(t[1] for t in times),times[0][2])
+
+                if output_format == 'csv':
+                    with open(timings['legacy'][2],'rb') as f_legacy, open(timings['current'][2],'rb') as f_current:
+                        if f_legacy.read() != f_current.read():
+                            raise ValueError(f"the dates of {table} are not saved the same as before")
+
+                t_legacy = timings['legacy'][0] + timings['legacy'][1]
+                t_current = timings['current'][0] + timings['current'][1]
+                results.append({
+                    'table':table,
+                    'nrows':nrows,
+                    'nfields':len(df.columns),
+                    'output_format':output_format,
+                    'legacy_format_seconds':timings['legacy'][0],
+                    'legacy_save_seconds':timings['legacy'][1],
+                    'format_seconds':timings['current'][0],
+                    'save_seconds':timings['current'][1],
+                    'speed_up':t_legacy/t_current
+                })
+                print (json.dumps(results[-1]))
+    finally:
+        shutil.rmtree(folder,ignore_errors=True)
+    return results
+
+
+def make_observation_model(nobjects):
+    """
+    Make a CommonDataModel class with a number of observation objects,
+    each mapping a different question of a synthetic questionnaire
+    """
+    def make_define(i):
+        def define(self):
+            self.person_id = self.inputs['questions']['person_id']
+            self.observation_concept_id = self.tools.make_scalar(self.inputs['questions'][f'q{i}'],40766945+i)
+            self.observation_source_value = self.inputs['questions'][f'q{i}'].str.upper()
+            self.observation_datetime = self.inputs['questions']['date']
+        define.__name__ = f'observation_{i}'
+        return define
+
+    namespace = {
+        f'observation_{i}':define_observation(make_define(i))
+        for i in range(nobjects)
+    }
+    return type('Benchmark',(CommonDataModel,),namespace)
+
+
+def make_questions(nrows,nquestions,seed=1):
+    """
+    Make a synthetic questionnaire input, with one answer column per question
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'person_id':rng.integers(0,nrows//10+1,nrows).astype(str),
+        'date':make_series('DATE',nrows,seed),
+    })
+    for i in range(nquestions):
+        df[f'q{i}'] = rng.choice(['yes','no','maybe'],nrows)
+    df.index = df['person_id'].rename('index')
+    return df
+
+
+def benchmark_memory(nrows,nobjects):
+    """
+    Measure the peak memory of running many objects for a table, and the memory still held afterwards,
+    with and without releasing the series of each object once its dataframe has been made.
+    Note: tracing the memory makes this a lot slower than a normal run
+    """
+    cls = make_observation_model(nobjects)
+    inputs = {'questions':make_questions(nrows,nobjects)}
+
+    release = Base.release
+    results = []
+    for do_release in [False,True]:
+        if not do_release:
+            Base.release = lambda self: None
+        try:
+            cdm = cls(inputs=inputs)
+            cdm.logger.setLevel('WARNING')
+            tracemalloc.start()
+            start = time.perf_counter()
+            df = cdm.run_cdm(Observation)
+            elapsed = time.perf_counter() - start
+            nrows_out = len(df)
+            del df
+            #memory still held (by the objects) once the output has been dropped
+            retained,peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            Base.release = release
+        results.append({
+            'release':do_release,
+            'nrows':nrows,
+            'nobjects':nobjects,
+            'rows_out':nrows_out,
+            'seconds':elapsed,
+            'peak_memory_mb':peak/1024**2,
+            'retained_memory_mb':retained/1024**2
+        })
+    return results
+
+def legacy_get_df(obj):
+    """
+    How Base.get_df made the dataframe of an object, before the series were only sorted when they don't line up
+    """
+    dfs = [
+        getattr(obj,field).rename(field).sort_index()
+        for field in obj.fields
+        if getattr(obj,field) is not None
+    ]
+    df = pd.concat(dfs,axis=1)
+    for field in set(obj.fields) - set(df.columns):
+        df[field] = np.nan
+    return df[obj.fields]
+
+
+def make_wide_object(nrows,nfields,index,seed=1):
+    """
+    Make a measurement object with nfields mapped, as they would be set by the define function
+
+    Args:
+       index (str): 'unique' for one row per person_id,
+                    'duplicated' for several rows per person_id,
+                    'unaligned' for one row per person_id, in a different order in each field
+    """
+    rng = np.random.default_rng(seed)
+    if index == 'duplicated':
+        person_ids = rng.integers(0,nrows//10+1,nrows)
+    else:
+        person_ids = np.arange(nrows)
+    person_ids = pd.Index(person_ids.astype(str),name='index')
+
+    obj = Measurement()
+    obj.logger.setLevel('WARNING')
+    for i,field in enumerate(obj.fields[:nfields]):
+        series = make_series(obj.schema.types[field],nrows,seed=seed+i)
+        series.index = person_ids
+        if index == 'unaligned':
+            series = series.sample(frac=1,random_state=seed+i)
+        setattr(obj,field,series)
+    return obj
+
+
+def hash_rows(df):
+    """
+    Hash each row of a dataframe, including the index, to compare the rows regardless of their order
+    """
+    return np.sort(pd.util.hash_pandas_object(df.reset_index(),index=False).values)
+
+
+def benchmark_get_df(nrows,nfields,repeat):
+    """
+    Compare making the dataframe of a wide object with the legacy and current Base.get_df
+    """
+    results = []
+    for index in ['unique','duplicated','unaligned']:
+        obj = make_wide_object(nrows,nfields,index)
+        legacy = legacy_get_df(obj)
+        #the fields that haven't been mapped are now only added when the table is finalised
+        current = Base.get_df(obj).reindex(columns=obj.fields)
+        if not np.array_equal(hash_rows(legacy),hash_rows(current)):
+            raise ValueError(f"get_df with a {index} index does not give the same rows as before")
+
+        t_legacy = timeit(legacy_get_df,obj,repeat=repeat)
+        t_current = timeit(Base.get_df,obj,repeat=repeat)
+        results.append({
+            'index':index,
+            'nrows':nrows,
+            'nfields':nfields,
+            'legacy_seconds':t_legacy,
+            'seconds':t_current,
+            'speed_up':t_legacy/t_current,
+            'legacy_memory_mb':legacy.memory_usage(deep=False).sum()/1024**2,
+            'memory_mb':Base.get_df(obj).memory_usage(deep=False).sum()/1024**2
+        })
+    return results
+
+
+def make_rules(data):
+    """
+    Flatten the cdm objects of a structural mapping into a list of rules,
+    in the format StructuralMapping.to_json loads them.
+    Fields that are shared by objects (e.g. the person_id) are only one rule.
+    """
+    rules = {}
+    for destination_table,objects in data['cdm'].items():
+        for obj in objects:
+            for destination_field,source in obj.items():
+                rule = {
+                    'destination_table':destination_table,
+                    'destination_field':destination_field,
+                    'source_table':source['source_table'],
+                    'source_field':source['source_field'],
+                    'term_mapping':source['term_mapping'],
+                    'operations':source.get('operations')
+                }
+                rules[json.dumps(rule,sort_keys=True)] = rule
+    return list(rules.values())
+
+
+def make_lion_inputs(data,nrows,folder,seed=1):
+    """
+    Make synthetic versions of the sample inputs of the structural mapping, with nrows in each table.
+    The term mapped fields take the values that are mapped, dates are spread over 80 years
+    and the other fields take the values found in the sample inputs.
+
+    Returns:
+       dict: the name of each input table and its file
+    """
+    rng = np.random.default_rng(seed)
+    person_ids = {k.lower():v.lower() for k,v in data['metadata']['person_id'].items()}
+    terms = {}
+    for rule in make_rules(data):
+        if isinstance(rule['term_mapping'],dict):
+            key = (rule['source_table'],rule['source_field'])
+            terms.setdefault(key,set()).update(rule['term_mapping'].keys())
+
+    def make_dates():
+        #only format each day once
+        days,codes = np.unique(rng.integers(0,365*80,nrows),return_inverse=True)
+        dates = pd.to_datetime(np.datetime64('1940-01-01') + days.astype('timedelta64[D]'))
+        return dates.strftime('%d/%m/%Y').values[codes]
+
+    inputs = {}
+    for table,person_id in person_ids.items():
+        sample = pd.read_csv(os.path.join(data_dir,'sample_input_data',table),dtype=str)
+        df = pd.DataFrame(index=range(nrows))
+        for column in sample.columns:
+            field = column.lower()
+            values = sample[column].dropna().unique()
+            if field == person_id:
+                #one row per person in the person table, several rows per person in the others
+                ids = np.arange(nrows) if table == 'demo.csv' else rng.integers(0,nrows,nrows)
+                df[column] = np.char.add('pk',ids.astype(str))
+            elif (table,field) in terms:
+                df[column] = rng.choice(sorted(terms[(table,field)]),nrows)
+            elif pd.to_datetime(pd.Series(values),format='%d/%m/%Y',errors='coerce').notnull().all():
+                df[column] = make_dates()
+            else:
+                df[column] = rng.choice(values,nrows)
+        inputs[table] = os.path.join(folder,table)
+        df.to_csv(inputs[table],index=False)
+    return inputs
+
+
+class Stages:
+    """
+    Record the wall time of each stage of a benchmark
+    """
+    def __init__(self):
+        self.seconds = {}
+
+    def __call__(self,stage,function,*args,**kwargs):
+        start = time.perf_counter()
+        retval = function(*args,**kwargs)
+        self.seconds[stage] = time.perf_counter() - start
+        return retval
+
+    def results(self,rows_in,rows_out):
+        total = sum(self.seconds.values())
+        results = {
+            'rows_in':rows_in,
+            'rows_out':rows_out,
+            'seconds':total,
+            'rows_per_second':rows_in/total,
+            #peak memory of the process running the benchmark (maxrss is in kB on linux)
+            'peak_memory_mb':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        }
+        results.update({f'seconds_{name}':seconds for name,seconds in self.seconds.items()})
+        return results
+
+
+def run_cdm_engine(inputs,f_rules,person_ids,folder,workers=1,output_format='csv'):
+    """
+    Make the rules into a CommonDataModel class (StructuralMapping.to_json and extract.make_class),
+    then run it on the inputs with CommonDataModel.process
+    """
+    stages = Stages()
+    name = 'LionBenchmark'
+    data = stages('to_json',StructuralMapping.to_json,f_rules,person_id=person_ids)
+
+    #make_class saves the class in the current directory and links it in coconnect/cdm/classes
+    current_dir = os.getcwd()
+    os.chdir(folder)
+    try:
+        stages('make_class',tools.extract.make_class,data,name=name)
+    finally:
+        os.chdir(current_dir)
+        from coconnect.cdm import classes
+        link = os.path.join(os.path.dirname(classes.__file__),f'{name}.py')
+        if os.path.islink(link):
+            os.unlink(link)
+
+    spec = importlib.util.spec_from_file_location(name,os.path.join(folder,f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    def load():
+        return getattr(module,name)(inputs=tools.load_csv(inputs),
+                                    output_folder=os.path.join(folder,'output_data'))
+
+    cdm = stages('load',load)
+    cdm.logger.setLevel('WARNING')
+    stages('process',cdm.process,workers=workers,output_format=output_format)
+
+    rows_in = sum(len(df) for df in cdm.inputs.values())
+    rows_out = sum(len(df) for df in cdm.omop.values() if df is not None)
+    return stages.results(rows_in,rows_out)
+
+
+#operations of the structural mapping that the ETLTool has an equivalent for
+etl_operations = {
+    'get_datetime':'TO_DT',
+    'get_year':'EXTRACT_YEAR',
+    'get_month':'EXTRACT_MONTH',
+    'get_day':'EXTRACT_DAY',
+    'get_source_field_name_as_value':'EXTRACT_FIELD_NAME'
+}
+
+def make_etl_mapping(rules,folder):
+    """
+    Save the rules as the structural and term mapping .csv files used by the ETLTool
+    """
+    structural,terms = [],[]
+    for rule_id,rule in enumerate(rules):
+        term_mapping = rule['term_mapping']
+        operations = rule['operations'] or ['n']
+        structural.append({
+            'rule_id':rule_id,
+            'destination_table':rule['destination_table'],
+            'destination_field':rule['destination_field'],
+            'source_table':rule['source_table'],
+            'source_field':rule['source_field'],
+            'term_mapping':'n' if term_mapping is None else 'y',
+            'operation':etl_operations.get(operations[0],'n'),
+            'source_field_indexer':rule['destination_field'] == 'person_id'
+        })
+        if isinstance(term_mapping,dict):
+            terms.extend({'rule_id':rule_id,'source_term':k,'destination_term':v}
+                         for k,v in term_mapping.items())
+        elif term_mapping is not None:
+            #the ETLTool maps all values to one term when the list of terms has been truncated
+            terms.append({'rule_id':rule_id,'source_term':'List truncated','destination_term':term_mapping})
+
+    f_structural = os.path.join(folder,'structural_mapping.csv')
+    f_terms = os.path.join(folder,'term_mapping.csv')
+    pd.DataFrame(structural).to_csv(f_structural,index=False)
+    pd.DataFrame(terms).to_csv(f_terms,index=False)
+    return f_structural,f_terms
+
+
+def make_etl_inputs(inputs,rules,person_ids,folder):
+    """
+    The ETLTool indexes all the inputs by the same person_id field,
+    so copy the inputs with the person_id field of each one renamed to 'person_id'
+    """
+    person_ids = {k.lower():v.lower() for k,v in person_ids.items()}
+    etl_inputs = {}
+    for table,fname in inputs.items():
+        etl_inputs[table] = os.path.join(folder,'etl_inputs',table)
+        os.makedirs(os.path.dirname(etl_inputs[table]),exist_ok=True)
+        with open(fname) as f_in, open(etl_inputs[table],'w') as f_out:
+            header = [x if x.lower() != person_ids[table] else 'person_id'
+                      for x in f_in.readline().rstrip('\n').split(',')]
+            f_out.write(','.join(header)+'\n')
+            shutil.copyfileobj(f_in,f_out)
+
+    rules = [
+        dict(rule,source_field='person_id') if rule['source_field'].lower() == person_ids[rule['source_table']]
+        else rule
+        for rule in rules
+    ]
+    return etl_inputs,rules
+
+
+def import_etltool():
+    """
+    Import the ETLTool, which is deprecated and raises a DeprecationWarning when it is imported,
+    so it is loaded from its source without the raise to be benchmarked
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            from coconnect.etltool import ETLTool
+            return ETLTool
+        except DeprecationWarning:
+            pass
+
+        spec = importlib.util.find_spec('coconnect.etltool')
+        source = spec.loader.get_source(spec.name).replace('raise DeprecationWarning','pass #',1)
+        module = importlib.util.module_from_spec(spec)
+        #registered before it is run, so its relative imports can find it
+        sys.modules[spec.name] = module
+        exec(compile(source,spec.origin,'exec'),module.__dict__)
+        return module.ETLTool
+
+
+def run_etl_engine(inputs,rules,person_ids,folder):
+    """
+    Run the ETLTool end-to-end (ETLTool.run) on the inputs,
+    with the rules saved as structural and term mapping .csv files
+    """
+    ETLTool = import_etltool()
+
+    stages = Stages()
+    inputs,rules = make_etl_inputs(inputs,rules,person_ids,folder)
+    f_structural,f_terms = make_etl_mapping(rules,folder)
+
+    def load():
+        etl = ETLTool()
+        etl.logger.setLevel('WARNING')
+        #as etl2cdm does by default
+        etl.set_perform_person_id_mask(True)
+        etl.set_output_folder(os.path.join(folder,'etl_output'))
+        etl.load_input_data(list(inputs.values()))
+        etl.load_structural_mapping(f_structural)
+        etl.load_term_mapping(f_terms)
+        return etl
+
+    etl = stages('load',load)
+    stages('run',etl.run)
+
+    rows_in = sum(sum(1 for _ in open(fname)) - 1 for fname in inputs.values())
+    rows_out = sum(sum(1 for _ in open(fname)) - 1 for fname in etl.map_output_data.values())
+    return stages.results(rows_in,rows_out)
+
+
+def run_isolated(function,*args,**kwargs):
+    """
+    Run a benchmark in a new process, so the peak memory is only that of this benchmark
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1,mp_context=context) as pool:
+        return pool.submit(function,*args,**kwargs).result()
+
+
+def benchmark_engines(nrows_list,engines,workers=1,output_format='csv',tmp_dir=None):
+    """
+    Run the mapping engines on synthetic inputs of increasing size,
+    made from the sample structural mapping (lion_structural_mapping.json)
+    """
+    data = json.load(open(f_lion))
+    rules = make_rules(data)
+    results = []
+    for nrows in nrows_list:
+        folder = tempfile.mkdtemp(prefix='coconnect_benchmark_',dir=tmp_dir)
+        try:
+            inputs = make_lion_inputs(data,nrows,folder)
+            f_rules = os.path.join(folder,'rules.json')
+            json.dump(rules,open(f_rules,'w'))
+
+            for engine in engines:
+                if engine == 'cdm':
+                    result = run_isolated(run_cdm_engine,inputs,f_rules,data['metadata']['person_id'],
+                                          folder,workers=workers,output_format=output_format)
+                elif engine == 'etltool':
+                    result = run_isolated(run_etl_engine,inputs,rules,data['metadata']['person_id'],folder)
+                result = {'engine':engine,'nrows':nrows,**result}
+                print (json.dumps(result))
+                results.append(result)
+        finally:
+            shutil.rmtree(folder,ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the performance of the mapping tools')
+    #add_subparsers(required=True) needs python 3.7
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    types = subparsers.add_parser('types',help='benchmark converting series into the CDM types')
+    types.add_argument('--nrows',type=int,default=10**6,help='number of rows in each series')
+    types.add_argument('--repeat',type=int,default=3,help='number of times to repeat each timing')
+
+    memory = subparsers.add_parser('memory',help='benchmark the peak memory of running many objects for a table')
+    memory.add_argument('--nrows',type=int,default=10**4,help='number of rows in the input')
+    memory.add_argument('--nobjects',type=int,default=30,help='number of objects to run')
+
+    get_df = subparsers.add_parser('get_df',help='benchmark making the dataframe of an object with many fields mapped')
+    get_df.add_argument('--nrows',type=int,default=10**5,help='number of rows in the object')
+    get_df.add_argument('--nfields',type=int,default=20,help='number of fields mapped (measurement has 20)')
+    get_df.add_argument('--repeat',type=int,default=3,help='number of times to repeat each timing')
+
+    dates_parser = subparsers.add_parser('dates',help='benchmark formatting and saving the DATE and DATETIME fields of cdm tables')
+    dates_parser.add_argument('--nrows',type=int,default=10**7,help='number of rows in each table')
+    dates_parser.add_argument('--tables',nargs='+',default=['condition_occurrence','measurement'],
+                              help='the cdm tables to make the fields of')
+    dates_parser.add_argument('--output-formats',nargs='+',default=['csv','parquet'],
+                              choices=['csv','parquet','feather'],help='formats to save the tables in')
+    dates_parser.add_argument('--repeat',type=int,default=1,help='number of times to repeat each timing')
+    dates_parser.add_argument('--tmp-dir',default=None,help='where to save the tables')
+
+    engines = subparsers.add_parser('engines',help='benchmark the mapping engines on synthetic inputs made from the sample structural mapping')
+    engines.add_argument('--nrows',type=int,nargs='+',default=[10**4,10**5,10**6],
+                         help='number of rows in each input table, e.g. 10000 100000 1000000 10000000')
+    engines.add_argument('--engines',nargs='+',choices=['cdm','etltool'],default=['cdm','etltool'],
+                         help='which engines to run')
+    engines.add_argument('--workers',type=int,default=1,help='number of processes the CommonDataModel can use')
+    engines.add_argument('--output-format',default='csv',choices=['csv','parquet','feather'],
+                         help='format the CommonDataModel saves the outputs in')
+    engines.add_argument('--tmp-dir',default=None,help='where to save the synthetic inputs and the outputs')
+
+    parser.add_argument('--output','-o',default=None,help='save the results to a .json file')
+    args = parser.parse_args()
+
+    if args.benchmark == 'types':
+        results = benchmark_types(args.nrows,args.repeat)
+    elif args.benchmark == 'memory':
+        results = benchmark_memory(args.nrows,args.nobjects)
+    elif args.benchmark == 'get_df':
+        results = benchmark_get_df(args.nrows,args.nfields,args.repeat)
+    elif args.benchmark == 'dates':
+        results = benchmark_dates(args.nrows,args.tables,args.output_formats,args.repeat,args.tmp_dir)
+    elif args.benchmark == 'engines':
+        results = benchmark_engines(args.nrows,args.engines,args.workers,args.output_format,args.tmp_dir)
+
+    print (pd.DataFrame(results).to_string(index=False))
+    if args.output is not None:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=6)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+import pandas as pd
+
+from coconnect.tools.dates import DateParser
+
+
+def test_chunks_are_parsed_with_the_same_format():
+    parser = DateParser()
+    #the first chunk can only be day first, so the second is too, even though it could be either
+    first = parser.parse(pd.Series(['18/07/1962','01/03/1972'],name='dob'))
+    second = parser.parse(pd.Series(['02/03/1972','01/03/1972'],name='dob'))
+    assert list(first) == [pd.Timestamp('1962-07-18'),pd.Timestamp('1972-03-01')]
+    assert list(second) == [pd.Timestamp('1972-03-02'),pd.Timestamp('1972-03-01')]
+
+
+def test_parse_matches_to_datetime():
+    series = pd.Series(['2020-03-06','2021-01-02',None,'2020-03-06'],name='date')
+    pd.testing.assert_series_equal(DateParser().parse(series),pd.to_datetime(series))
@@ -0,0 +1,230 @@
+import importlib.util
+import os
+import sys
+import warnings
+import pandas as pd
+import pytest
+
+
+def import_etltool():
+    """
+    Import the ETLTool, which is deprecated and raises a DeprecationWarning when it is imported,
+    so it is loaded from its source without the raise to be tested
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            from coconnect.etltool import ETLTool
+            return ETLTool
+        except DeprecationWarning:
+            pass
+
+        spec = importlib.util.find_spec('coconnect.etltool')
+        source = spec.loader.get_source(spec.name).replace('raise DeprecationWarning','pass #',1)
+        module = importlib.util.module_from_spec(spec)
+        #registered before it is run, so its relative imports can find it
+        sys.modules[spec.name] = module
+        exec(compile(source,spec.origin,'exec'),module.__dict__)
+        return module.ETLTool
+
+
+ETLTool = import_etltool()
+data = os.path.join(os.path.dirname(__file__),'data')
+
+
+def run(output_folder,demo=None,typed_reads=True,chunk_size=None):
+    mapping = f'{data}/etl_numeric_ids'
+    etl = ETLTool()
+    etl.set_perform_person_id_mask(True)
+    etl.set_typed_reads(typed_reads)
+    if chunk_size is not None:
+        etl.set_chunk_size(chunk_size)
+    etl.set_output_folder(output_folder)
+    etl.load_input_data([demo or f'{mapping}/demo.csv'])
+    etl.load_structural_mapping(f'{mapping}/structural_mapping.csv')
+    etl.load_term_mapping(f'{mapping}/term_mapping.csv')
+    etl.run()
+    person = pd.read_csv(f'{output_folder}/cdm_merged/person.csv')
+    lookup = pd.read_csv(f'{output_folder}/masks/person_id_lookup.csv',dtype={'original_person_id':str})
+    return person,lookup
+
+
+def unmask(person,lookup):
+    return list(person['person_id'].map(lookup.set_index('person_id')['original_person_id']))
+
+
+def test_numeric_person_ids_are_sorted_as_numbers(tmp_path):
+    person,lookup = run(str(tmp_path/'typed'))
+
+    #the rows are ordered by the number, not the string, and masked in that order
+    assert unmask(person,lookup) == ['1','2','3','10','11','12']
+    assert list(person['person_id']) == [1,2,3,4,5,6]
+
+    #the same as when the types of the columns are inferred
+    person_untyped,lookup_untyped = run(str(tmp_path/'untyped'),typed_reads=False)
+    pd.testing.assert_frame_equal(person,person_untyped)
+    pd.testing.assert_frame_equal(lookup,lookup_untyped)
+
+
+def test_numeric_person_ids_are_sorted_as_numbers_in_every_chunk(tmp_path):
+    #a chunk with an id that isn't a number is still ordered by the numbers
+    demo = pd.read_csv(f'{data}/etl_numeric_ids/demo.csv',dtype=str)
+    demo = pd.concat([demo,pd.DataFrame({'person_id':['a7','9'],'gender':'M','dob':'1970-01-01'})])
+    fname = str(tmp_path/'demo.csv')
+    demo.to_csv(fname,index=False)
+
+    person,lookup = run(str(tmp_path/'output'),demo=fname,chunk_size=4)
+    assert unmask(person,lookup) == ['1','2','10','12','3','9','11','a7']
+
+
+def make_lion_inputs(folder,npeople=50,nvisits=120):
+    """
+    Make the inputs of the sample structural mapping (lion), with more people and visits,
+    where the ETLTool needs the person_id to be the same column in every input
+    """
+    sample = os.path.join(os.path.dirname(data),'..','coconnect','data','example','sample_input_data')
+    demo = pd.read_csv(f'{sample}/demo.csv',dtype=str)
+    demo = demo.iloc[[i%len(demo) for i in range(npeople)]].reset_index(drop=True)
+    demo = demo.drop(columns='study number')
+    demo.insert(0,'person_id',[f'pk{i}' for i in range(npeople)])
+    questions = pd.read_csv(f'{sample}/questions.csv',dtype=str)
+    questions = questions.iloc[[i%len(questions) for i in range(nvisits)]].reset_index(drop=True)
+    #including people that aren't in demo
+    questions['study id'] = [f'pk{(i*7)%(npeople+5)}' for i in range(nvisits)]
+    questions = questions.rename(columns={'study id':'person_id'})
+    os.makedirs(folder,exist_ok=True)
+    demo.to_csv(f'{folder}/demo.csv',index=False)
+    questions.to_csv(f'{folder}/questions.csv',index=False)
+
+
+def run_lion(input_folder,output_folder,**settings):
+    """
+    Run the ETLTool on the lion inputs, with some of its settings e.g. workers=2
+    """
+    mapping = f'{data}/etl_lion'
+    etl = ETLTool()
+    etl.set_perform_person_id_mask(True)
+    etl.set_chunk_size(7)
+    for name,value in settings.items():
+        getattr(etl,f'set_{name}')(value)
+    etl.set_output_folder(output_folder)
+    etl.load_input_data([f'{input_folder}/demo.csv',f'{input_folder}/questions.csv'])
+    etl.load_structural_mapping(f'{mapping}/structural_mapping.csv')
+    etl.load_term_mapping(f'{mapping}/term_mapping.csv')
+    etl.run()
+    return etl
+
+
+def load_outputs(output_folder,unmask=False):
+    """
+    Load the cdm tables made by a run, with the original person_ids if unmask
+    """
+    lookup = pd.read_csv(f'{output_folder}/masks/person_id_lookup.csv',dtype=str)
+    outputs = {}
+    for table in ['person','condition_occurrence','observation','measurement']:
+        df = pd.read_csv(f'{output_folder}/cdm_merged/{table}.csv',dtype=str)
+        if unmask:
+            df['person_id'] = df['person_id'].map(lookup.set_index('person_id')['original_person_id'])
+        outputs[table] = df
+    if not unmask:
+        outputs['lookup'] = lookup
+    return outputs
+
+
+def assert_outputs_equal(a,b):
+    assert a.keys() == b.keys()
+    for table in a:
+        pd.testing.assert_frame_equal(a[table],b[table],obj=table)
+
+
+@pytest.fixture(scope='module')
+def lion(tmp_path_factory):
+    """
+    The lion inputs, and the outputs of a serial run on them
+    """
+    folder = tmp_path_factory.mktemp('lion')
+    input_folder = str(folder/'inputs')
+    make_lion_inputs(input_folder)
+    run_lion(input_folder,str(folder/'serial'),read_ahead=0)
+    return input_folder,str(folder/'serial')
+
+
+def test_lion_outputs(lion):
+    input_folder,serial = lion
+    outputs = load_outputs(serial)
+    assert len(outputs['person']) == 50
+    #one row for each of the two conditions of each visit that has them
+    assert len(outputs['condition_occurrence']) > 120
+    assert outputs['person']['person_id'].is_unique
+    assert outputs['observation']['observation_id'].is_unique
+
+
+@pytest.mark.parametrize('settings',[
+    {'read_ahead':2},
+    {'workers':2},
+    {'workers':2,'read_ahead':2},
+    {'typed_reads':False},
+    {'save_split_files':True},
+])
+def test_settings_give_the_same_outputs(lion,tmp_path,settings):
+    input_folder,serial = lion
+    outputs = load_outputs(serial)
+    run_lion(input_folder,str(tmp_path/'run'),**settings)
+    assert_outputs_equal(load_outputs(str(tmp_path/'run')),outputs)
+
+
+def test_plan_cache_gives_the_same_outputs(lion,tmp_path):
+    input_folder,serial = lion
+    outputs = load_outputs(serial)
+    plan_cache = str(tmp_path/'plan.pickle')
+    for i in range(2):
+        run_lion(input_folder,str(tmp_path/f'run{i}'),plan_cache=plan_cache)
+        assert_outputs_equal(load_outputs(str(tmp_path/f'run{i}')),outputs)
+    assert os.path.exists(plan_cache)
+
+
+def test_resumed_run_gives_the_same_outputs(lion,tmp_path,monkeypatch):
+    input_folder,serial = lion
+    outputs = load_outputs(serial)
+    output_folder = str(tmp_path/'run')
+
+    #fail part of the way through the second source table
+    save_chunks = ETLTool.save_chunks
+    def fail(self,dfs,destination_tables,source_table,icounter,*args):
+        if source_table == 'questions.csv' and icounter == 5:
+            raise RuntimeError('interrupted')
+        return save_chunks(self,dfs,destination_tables,source_table,icounter,*args)
+    monkeypatch.setattr(ETLTool,'save_chunks',fail)
+    with pytest.raises(RuntimeError):
+        run_lion(input_folder,output_folder)
+
+    #the first source table was completed, so it isn't processed again
+    processed = []
+    def record(self,dfs,destination_tables,source_table,*args):
+        processed.append(source_table)
+        return save_chunks(self,dfs,destination_tables,source_table,*args)
+    monkeypatch.setattr(ETLTool,'save_chunks',record)
+    run_lion(input_folder,output_folder,resume=True)
+    assert set(processed) == {'questions.csv'}
+    assert_outputs_equal(load_outputs(output_folder),outputs)
+
+
+def test_incremental_runs_give_the_same_outputs(lion,tmp_path):
+    input_folder,serial = lion
+    output_folder = str(tmp_path/'run')
+    inputs = {
+        fname:pd.read_csv(f'{input_folder}/{fname}',dtype=str)
+        for fname in ['demo.csv','questions.csv']
+    }
+    #rows are appended to the inputs between the runs, on the boundaries of the chunks
+    step_folder = str(tmp_path/'steps')
+    os.makedirs(step_folder)
+    for nrows in [21,42,None]:
+        for fname,df in inputs.items():
+            df.iloc[:nrows].to_csv(f'{step_folder}/{fname}',index=False)
+        etl = run_lion(step_folder,output_folder,incremental=True)
+    assert set(etl.table_modes.values()) == {'append'}
+
+    #the people can be masked in a different order, as they are seen in a different order
+    assert_outputs_equal(load_outputs(output_folder,unmask=True),
+                         load_outputs(serial,unmask=True))
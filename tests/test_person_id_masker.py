@@ -0,0 +1,63 @@
+import pandas as pd
+
+from coconnect.cdm import CommonDataModel, define_person, define_observation
+
+
+class Example(CommonDataModel):
+    @define_person
+    def person(self):
+        self.person_id = self.inputs['demo']['person_id']
+        self.gender_concept_id = self.tools.make_scalar(self.inputs['demo']['person_id'],8507)
+        self.gender_source_value = self.inputs['demo']['gender']
+        self.birth_datetime = self.inputs['demo']['dob']
+
+    @define_observation
+    def observation(self):
+        self.person_id = self.inputs['questions']['person_id']
+        self.observation_concept_id = self.tools.make_scalar(self.inputs['questions']['answer'],40766945)
+        self.observation_source_value = self.inputs['questions']['answer']
+        self.observation_datetime = self.inputs['questions']['date']
+
+
+def make_inputs(person_ids):
+    demo = pd.DataFrame({
+        'person_id':person_ids,
+        'gender':'M',
+        'dob':'1990-01-01',
+    })
+    demo.index = demo['person_id'].rename('index')
+    #every person has two answers, including the ones that are not in demo
+    questions = pd.DataFrame({
+        'person_id':[str(i) for i in range(1,6) for _ in range(2)],
+        'answer':'yes',
+        'date':'2020-01-01',
+    })
+    questions.index = questions['person_id'].rename('index')
+    return {'demo':demo,'questions':questions}
+
+
+def run(inputs,output_folder):
+    cdm = Example(inputs=inputs,output_folder=output_folder,output_format='csv')
+    cdm.process(output_folder=output_folder)
+    person = pd.read_csv(f'{output_folder}/person.csv')
+    observation = pd.read_csv(f'{output_folder}/observation.csv')
+    lookup = pd.read_csv(f'{output_folder}/masks/person_id_lookup.csv',dtype={'original_person_id':str})
+    return person,observation,lookup
+
+
+def test_rerun_with_a_person_removed(tmp_path):
+    output_folder = str(tmp_path)
+
+    person,observation,lookup = run(make_inputs(['1','2','3','4']),output_folder)
+    assert len(person) == 4
+    assert set(observation['person_id']) == set(person['person_id'])
+    masked = dict(zip(lookup['original_person_id'],lookup['person_id']))
+
+    #rerun into the same output folder, without person 4
+    person,observation,lookup = run(make_inputs(['1','2','3']),output_folder)
+    assert len(person) == 3
+    assert masked['4'] not in set(person['person_id'])
+    assert set(observation['person_id']) == set(person['person_id'])
+    assert len(observation) == 6
+    #the people that are still there keep the same masked ids
+    assert sorted(person['person_id']) == sorted(masked[i] for i in ['1','2','3'])